@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+#   Micro-benchmark of the DAQ continuous sampling frame conversion.
+#   Compares the per-field conversion (split, strip, conv_float, tuple) with the FrameParser
+#   conversion into a SampleRing slot, and prints the records/s of each path.
+#
+#   usage: bench_parse.py [<records>]
+
+import sys
+import timeit
+from daq_server import conv_float, FrameParser, SampleRing, create_sensors
+
+def make_frame(sensors) -> str:
+    """Return a typical :TRIG:CONT:READ? response frame for the sensors."""
+    return ','.join(f'{0.123456 * (i + 1):.6f}{x.unit}' for i, x in enumerate(sensors))
+
+if __name__ == '__main__':
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    sensors = create_sensors()
+    frame = make_frame(sensors)
+    ring = SampleRing.create(4096, len(sensors))
+    parser = FrameParser()
+    idx = 0
+
+    def per_field():
+        """Baseline: the previous DAQ_process hot loop conversion."""
+        global idx
+        fields = frame.split(',')
+        record = (idx, 0.0) + tuple([conv_float(x.strip()) for x in fields])
+        idx += 1
+        return record
+
+    def ring_write():
+        """Per-field conversion, written to the ring."""
+        global idx
+        fields = frame.split(',')
+        ring.write(idx, 0.0, [conv_float(x.strip()) for x in fields])
+        idx += 1
+
+    def frame_parser():
+        """FrameParser conversion in place into the ring slot."""
+        global idx
+        nans = parser.parse(frame, ring.slot())
+        ring.commit(idx, 0.0, nans)
+        idx += 1
+
+    print(f'frame: "{frame}" ({len(sensors)} channels), {records} records')
+    for name, fn in (("per-field tuple", per_field), ("per-field ring.write", ring_write), ("FrameParser slot", frame_parser)):
+        t = min(timeit.repeat(fn, number=records, repeat=3))
+        print(f'{name:24s} {records / t:12.0f} records/s  {t / records * 1e6:8.2f} us/record')
+    ring.read()
+    ring.close()
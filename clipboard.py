@@ -2073,6 +2073,31 @@ def listen():
     finally:
         data.close()
 
+import struct
+
+def listen_bin(count, bits=32):
+    data = conn(host, data_port)
+    try:
+        data.send(f":DATA:FORM BIN, {bits}".encode())
+        print(data.recv(1024).decode())
+        data.send(":DATA:LISTEN".encode())
+        f = data.makefile('rb')
+        # header: "#BIN,<struct format>,<record size>,RECNO,TIME[s],<label>[<unit>],..."
+        hdr = f.readline().decode().strip().split(',')
+        rec = struct.Struct(hdr[1])
+        print(f'{hdr[3:]}')
+        while count:
+            b = f.read(rec.size)
+            if len(b) < rec.size:
+                break
+            (recno, wavetime, *record) = rec.unpack(b)
+            print(f'{recno},{wavetime:.6f},{record}')
+            count -= 1
+    except Exception as e:
+        print(f'Exception {e}.')
+    finally:
+        data.close()
+
 def read(t0=None, t1=None):
     data = conn(host, data_port)
     try:
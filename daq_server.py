@@ -13,7 +13,7 @@
 #           DAQ CMD PORT:       57000       Receives command requests for SCPI DAQ commands
 #           DAQ DATA PORT:      58000       Unidirectional stream for :TRIG:CONT:READ? data
 #           SYS CMD PORT:       59000       Receives system high level commands
-#           SVC CTRL PORT:      60000       Service control port and syslog messages
+#           SVC CTRL PORT:      60000       Service control port: metrics text endpoint (HTTP GET /metrics)
 #           
 #
 #   USB SERIAL PORTS SETUP
@@ -94,7 +94,10 @@ from dataclasses import dataclass, field
 from overrides import override
 from argparse import Namespace
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import math
+import bisect
+from collections import deque
 import numpy as np
 from scipy.signal import find_peaks
 import time
@@ -105,7 +108,13 @@ import traceback
 import getopt
 from instrument import Instrument
 import socket
+import select
+import struct
 import threading
+import queue
+import asyncio
+import itertools
+import heapq
 
 script_ver      = "v0.9.433"
 copyright_str   = "Copyright (c) 2023, 2024, 2025 Jonny Doin"
@@ -117,6 +126,7 @@ license_short   = "This is free software: you are free to change and redistribut
 gvsi_visa_id_1  = "USBSER::0x2341::0x0043::GVSI::*::INSTR"              # VISA id string for any GVSI instrument, any serial number, any port (ARDUINO USB)
 gvsi_visa_id_2  = "USBSER::0x10c4::0xea60::GVSI::*::INSTR"              # VISA id string for any GVSI instrument, any serial number, any port (CP2102 BRIDGE)
 baudrate        = 115200                                                # serial port baud rate
+script_dir      = os.path.dirname(os.path.abspath(__file__))            # default location of the instrument data files
 
 #===============================================================================================#
 #               COMMAMD LINE OPTIONS PROCESSING                                                 #
@@ -129,8 +139,20 @@ def defaults() -> Namespace:
     default.silent          = None                              # suppress interactive plot graph and all stdout messages
     default.verbose         = None                              # verbose mode, write all messages to stdout
     default.debug           = None                              # show SCPI messages
+    default.adaptive        = None                              # response driven instrument commands, without fixed sleeps
+    default.profile         = os.path.join(script_dir, "gvsi_profile.json")     # instrument commands latency profile file
+    default.port_cache      = os.path.join(script_dir, "gvsi_ports.json")       # instrument discovery cache file
     default.nplc            = 5.0                               # ADC NPLC integration constant
     default.bufsize         = 1200.0                            # buffer size in seconds
+    default.bufrate         = 50.0                              # maximum record rate used to preallocate the buffer
+    default.windows         = (1.0, 2.0)                        # rolling statistics window periods in seconds
+    default.stream_depth    = 1024                              # DATA stream broadcast ring depth in records
+    default.shm_depth       = 4096                              # DAQ shared memory ring depth in records
+    default.cmd_batch       = 16                                # maximum DAQ commands per sampling stop/resume cycle
+    default.scpi_line       = 128                               # maximum length of a ';' joined SCPI command line
+    default.read_chunk      = 1024                              # :DATA:READ? records per socket write
+    default.stat_period     = 0.0                               # DAQ metrics summary period in seconds, 0.0 to disable
+    default.lag_policy      = "DROP"                            # DATA stream slow listener policy: DROP records or CLOSE the connection
     default.host_addr       = "127.0.0.1"                       # socket server host address
     default.cmd_port        = 57000                             # DAQ cmd port
     default.data_port       = 58000                             # DAQ continuous data stream port
@@ -166,11 +188,20 @@ def usage() -> None:
     print( '     -q | --quiet       quiet mode. Do not show status messages, but show measurement records')
     print( '     -v | --verbose     verbose mode, show more detailed messages')
     print( '     -D | --debug       debug mode, show SCPI commands sent')
+    print( '     --adaptive         response driven DAQ commands, without fixed sleeps')
     print(f'     --nplc <>          ADC integration in NPLC (default {format_SI(default.nplc, precision = 1)})')
     print(f'     --bufsize <>       data buffers size in seconds (default {format_SI(default.bufsize, precision = 1)})')
+    print(f'     --bufrate <>       maximum records per second for buffer preallocation (default {format_SI(default.bufrate, precision = 1)})')
+    print(f'     --profile <>       instrument latency profile file (default {default.profile})')
+    print(f'     --port_cache <>    instrument discovery cache file (default {default.port_cache})')
+    print(f'     --windows <>       comma separated rolling statistics windows in seconds (default {",".join(str(x) for x in default.windows)})')
     print(f'     --host <>          Host address (default {default.host_addr})')
     print(f'     --cmd_port <>      CMD service port (default {default.cmd_port})')
     print(f'     --data_port <>     DATA service port (default {default.data_port})')
+    print(f'     --svc_port <>      SVC metrics port (default {default.svc_port})')
+    print(f'     --lag_policy <>    DROP | CLOSE, slow DATA listeners policy (default {default.lag_policy})')
+    print(f'     --stream_depth <>  DATA stream records and events queued for each listener (default {default.stream_depth})')
+    print(f'     --stat_period <>   DAQ metrics summary period in seconds, 0 to disable (default {format_SI(default.stat_period, precision = 1)})')
     print()
 
 def si_to_eng(s: str, unit: str = "") -> str:
@@ -262,8 +293,8 @@ def get_options(fconf: str | None = None) -> Namespace:
     global opts_long
     if 'opts_long' not in globals():
         opts_long = [   
-            'help', 'version', 'quiet', 'silent', 'verbose', 'debug', 'nplc=', 'bufsize=',
-            'host=', 'cmd_port=', 'data_port=',
+            'help', 'version', 'quiet', 'silent', 'verbose', 'debug', 'adaptive', 'nplc=', 'bufsize=', 'bufrate=', 'windows=', 'profile=',
+            'port_cache=', 'host=', 'cmd_port=', 'data_port=', 'svc_port=', 'lag_policy=', 'stream_depth=', 'stat_period=',
         ]
 
     opts_short = "hvqDS"
@@ -282,6 +313,8 @@ def get_options(fconf: str | None = None) -> Namespace:
                 sys.exit(0)
             elif opt in ['-D', '--debug']:
                 arg.debug = True
+            elif opt in ['--adaptive']:
+                arg.adaptive = True
             elif opt in ['-q', '--quiet']:
                 if arg.verbose: raise RuntimeError("Illegal quiet and verbose at the same time")
                 if arg.silent: raise RuntimeError("Illegal quiet and silent at the same time")
@@ -302,12 +335,30 @@ def get_options(fconf: str | None = None) -> Namespace:
                 arg.nplc = float(si_to_eng(val))
             elif opt in ['--bufsize']:
                 arg.bufsize = float(si_to_eng(val))
+            elif opt in ['--bufrate']:
+                arg.bufrate = float(si_to_eng(val))
+            elif opt in ['--profile']:
+                arg.profile = val
+            elif opt in ['--port_cache']:
+                arg.port_cache = val
+            elif opt in ['--windows']:
+                arg.windows = tuple(float(si_to_eng(x)) for x in val.split(','))
             elif opt in ['--host']:
                 arg.host_addr = val
             elif opt in ['--cmd_port']:
                 arg.cmd_port = int(val)
             elif opt in ['--data_port']:
                 arg.data_port = int(val)
+            elif opt in ['--svc_port']:
+                arg.svc_port = int(val)
+            elif opt in ['--lag_policy']:
+                if val.upper() not in ("DROP", "CLOSE"): raise ValueError(f'invalid lag policy {val}')
+                arg.lag_policy = val.upper()
+            elif opt in ['--stream_depth']:
+                arg.stream_depth = int(val)
+                if arg.stream_depth < 1: raise ValueError(f'invalid stream depth {val}')
+            elif opt in ['--stat_period']:
+                arg.stat_period = float(si_to_eng(val))
             else:
                 assert False, f'unhandled option: {opt=}, {val=}'
                 sys.exit(2)
@@ -367,6 +418,8 @@ class Sensor():
                                         derived classes overwrite this method to implement the sensor transfer function.
             .format(vadc):              format the ADC reading in Volts into a printable representaion with the format string and the unit.
                                         this method calls the instance .val() to translate the ADC reading prior to format it.
+            .val_array(vadc):           translate an array of ADC readings in one numpy call, returning a new float64 array.
+                                        derived classes that overwrite .val() also overwrite this method with the same transfer function.
         ```
         
         ### Class Methods
@@ -376,6 +429,8 @@ class Sensor():
             Sensor.sensors(plotname):   return an iterator for the sensors instances.
             Sensor.names(plotname):     return an iterator for sensor SCPI names.
             Sensor.labels(plotname):    return an iterator for sensor label strings.
+            Sensor.val_records(block):  translate a block of raw records, one record per row, converting each sensor column in one call.
+            Sensor.record_fmt():        return a format string for the waveform time followed by all the sensors values and units.
         ```
     """
     _name: str
@@ -440,6 +495,10 @@ class Sensor():
         """Return a string formatted with the sensor value from the raw adc reading."""
         return (self._fmt + '{}').format(self.val(vadc), self._unit)
 
+    def val_array(self, vadc):
+        """Return a float64 array with the sensor values from an array of raw adc readings."""
+        return np.array(vadc, dtype=np.float64)
+
     @classmethod
     def clear(cls):
         """Remove all Sensor instances."""
@@ -466,6 +525,20 @@ class Sensor():
         """Return an iterator of label strings for the sensors defined for the axes plot, if the plotname is specified, or of all sensors if not."""
         return (x.label for x in cls._sensors if (plotname is None) or (x.plot == plotname)) if hasattr(cls, '_sensors') else []
 
+    @classmethod
+    def val_records(cls, block):
+        """Return a float64 array with the sensors values for a block of raw adc records, or for a single record."""
+        block = np.asarray(block, dtype=np.float64)
+        values = np.empty(block.shape, dtype=np.float64)
+        for i, s in enumerate(cls.sensors()):
+            values[..., i] = s.val_array(block[..., i])
+        return values
+
+    @classmethod
+    def record_fmt(cls):
+        """Return a format string for a data record, with the waveform time followed by the formatted values of all sensors."""
+        return '{:.6f}s,' + ','.join(x.fmt + x.unit for x in cls.sensors())
+
 #===============================================================================================#
 #   CLASS   Sensor_ADC                                                                          #
 #===============================================================================================#
@@ -581,6 +654,14 @@ class Sensor_T10k(Sensor):
         if vadc <= 0.0: vadc = 1e-6     # saturate zero/negative values to avoid domain errors
         return (self.beta / math.log(vadc / self.vref)) - 273.15
 
+    @override
+    def val_array(self, vadc):
+        """Return the temperatures in Celsius for an array of thermistor readings."""
+        vadc = np.asarray(vadc, dtype=np.float64)
+        vadc = np.where(vadc <= 0.0, 1e-6, vadc)    # saturate zero/negative values to avoid domain errors
+        with np.errstate(divide='ignore'):
+            return (self.beta / np.log(vadc / self.vref)) - 273.15
+
 
 #===============================================================================================#
 #   CLASS   Sensor_PT100                                                                        #
@@ -681,6 +762,13 @@ class Sensor_PT100(Sensor):
         vc = (vadc - self.Eo) * self.Ec
         return (-self.a + math.sqrt(self.a**2 - (4 * self.b * (1.0 - vc/self.vref)))) / (2 * self.b)
 
+    @override
+    def val_array(self, vadc):
+        """Return the temperatures in Celsius for an array of RTD readings. Out of range readings return NaN."""
+        vc = (np.asarray(vadc, dtype=np.float64) - self.Eo) * self.Ec
+        with np.errstate(invalid='ignore'):
+            return (-self.a + np.sqrt(self.a**2 - (4 * self.b * (1.0 - vc/self.vref)))) / (2 * self.b)
+
 #===============================================================================================#
 #   CLASS   Sensor_O2_AO_03                                                                     #
 #===============================================================================================#
@@ -726,6 +814,11 @@ class Sensor_O2_AO_03(Sensor):
         """Return the percent of O2 for a given sensor mV reading."""
         return ((vadc - self.offset) * self.ref_o2) / (self.baseline - self.offset)
 
+    @override
+    def val_array(self, vadc):
+        """Return the percent of O2 for an array of sensor readings."""
+        return ((np.asarray(vadc, dtype=np.float64) - self.offset) * self.ref_o2) / (self.baseline - self.offset)
+
 #===============================================================================================#
 #   CLASS   Sensor_O2_Me2_O2                                                                    #
 #===============================================================================================#
@@ -771,6 +864,11 @@ class Sensor_O2_Me2_O2(Sensor):
         """Return the percent of O2 for a given sensor mV reading."""
         return ((vadc - self.offset) * self.ref_o2) / (self.baseline - self.offset)
 
+    @override
+    def val_array(self, vadc):
+        """Return the percent of O2 for an array of sensor readings."""
+        return ((np.asarray(vadc, dtype=np.float64) - self.offset) * self.ref_o2) / (self.baseline - self.offset)
+
 #===============================================================================================#
 #   CLASS   Sensor_H2_Fuel_Cell                                                                 #
 #===============================================================================================#
@@ -846,7 +944,7 @@ def configure_gvsi(gvsi:Instrument, arg:Namespace) -> None:
     """Configure the GVSI instrument (gvsi)."""
     # *RST;:STAT:PRES;:FORM:ASC:PREC 6;:ADC:NPLC 5.0;*CLS;:syst:beep MIN
     gvsi.write("*RST")                                          # reset to defaults
-    time.sleep(2.0)                                             # time to boot up
+    gvsi.wait_ready("*RST", timeout = 2.0)                      # time to boot up, learned in the instrument profile
     gvsi.write(":STAT:PRES")                                    # preset status enables
     gvsi.write(":FORM:ASC:PREC 6")                              # decimal digits ascii precision
     gvsi.write(f':ADC:NPLC {arg.nplc}')                         # NPLC integration
@@ -879,45 +977,335 @@ def valid_cmd(cmd):
     """Returns True for a valid command frame."""
     return cmd[0] in "*:" and len(cmd) > 1
 
+def coalescible(cmd):
+    """Returns True for a plain SCPI write that can be joined with other writes in one line."""
+    if not (hasattr(cmd, "cmd") and hasattr(cmd, "req_id") and hasattr(cmd, "wait")): return False
+    cmdstr = cmd.cmd.upper()
+    return valid_cmd(cmdstr) and (cmd.wait == 0.0) and ('?' not in cmdstr) and not any(x in cmdstr for x in("*RST",":SAV",":RCL",":CMD:"))
+
+def join_writes(pending:list, cmd, count:int, length:int) -> list:
+    """
+        Pop from the (pending) commands heap the plain writes that follow the write (cmd), and return the
+        commands to join in one SCPI line, starting with (cmd). At most (count) commands are joined, in a
+        ';' joined line of at most (length) characters.
+    """
+    cmds = [cmd]
+    n = len(cmd.cmd)
+    while pending and (len(cmds) < count) and coalescible(pending[0][2]) and (n + 1 + len(pending[0][2].cmd) <= length):
+        _, _, cmd = heapq.heappop(pending)
+        cmds.append(cmd)
+        n += 1 + len(cmd.cmd)
+    return cmds
+
+#===============================================================================================#
+#   CLASS   SampleRing                                                                          #
+#===============================================================================================#
+
+class SampleRing():
+    """
+        Shared memory ring for the DAQ records, written by the DAQ process and read by the server process.</br>
+        The records are written directly in a multiprocessing.shared_memory block, with no per-record
+        serialization. The block holds an int64 header followed by a (depth x (3 + N)) float64 array:
+        ```
+            header[0]:                  sequence counter, the number of records written.
+            header[1]:                  number of sensor channels (N).
+            header[2]:                  ring depth in records.
+            header[3]:                  reader cursor, the number of records read or lost.
+            header[4]:                  number of NaN values written, from failed conversions.
+            header[5]:                  wall clock time in ns of the last write, the writer heartbeat.
+            row[0]:                     sequence stamp of the record, -1 while the row is being written.
+            row[1]:                     record number.
+            row[2]:                     waveform time.
+            row[3:3+N]:                 raw sensor values.
+        ```
+        The writer invalidates the row stamp before writing a row, and publishes the row by writing the 
+        stamp and then incrementing the sequence counter. The reader copies the new rows, and accepts a 
+        row only if its stamp is the expected sequence before and after the copy. Rows overwritten before 
+        they are read are counted as lost.
+
+        The ring is created by the server with SampleRing.create(), and mapped by the DAQ process with 
+        SampleRing.attach() using the block name. The creator unlinks the block on close().
+
+        ## Methods
+        ```
+            .write(recno, wavetime, values):    write a record in the ring (writer).
+            .slot():                            return the values view of the next row, to fill in place (writer).
+            .commit(recno, wavetime, nans):     publish the row filled after slot(), with its NaN count (writer).
+            .read(count):                       return an array with up to (count) new records (reader).
+            .close():                           unmap the block, and unlink it if this is the creator.
+        ```
+    """
+    HEADER = 8          # int64 header words
+
+    @property
+    def name(self): return self._shm.name
+    @property
+    def channels(self): return self._channels
+    @property
+    def depth(self): return self._depth
+    @property
+    def seq(self): return int(self._header[0])
+    @property
+    def backlog(self): return int(self._header[0] - self._header[3])
+    @property
+    def nans(self): return int(self._header[4])
+    @property
+    def heartbeat(self): return self._header[5] * 1e-9
+    @property
+    def lost(self): return self._lost
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self._shm = shm
+        self._owner = owner
+        self._header = np.ndarray((self.HEADER,), dtype=np.int64, buffer=shm.buf)
+        self._channels = int(self._header[1])
+        self._depth = int(self._header[2])
+        self._rows = np.ndarray((self._depth, self._channels + 3), dtype=np.float64, buffer=shm.buf, offset=self.HEADER * 8)
+        self._cursor = int(self._header[0])     # reader: sequence of the next record to read
+        self._lost = 0                          # reader: records overwritten before read
+
+    @classmethod
+    def create(cls, depth: int, channels: int):
+        """Create a new shared memory ring, owned by the caller."""
+        shm = shared_memory.SharedMemory(create=True, size=(cls.HEADER + depth * (channels + 3)) * 8)
+        header = np.ndarray((cls.HEADER,), dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        header[1] = channels
+        header[2] = depth
+        del header
+        ring = cls(shm, owner=True)
+        ring._rows[:, 0] = -1.0
+        return ring
+
+    @classmethod
+    def attach(cls, name: str):
+        """Map an existing shared memory ring by name."""
+        return cls(shared_memory.SharedMemory(name=name), owner=False)
+
+    def write(self, recno: int, wavetime: float, values) -> None:
+        """Write a record in the ring. Missing values are written as NaN, and extra values are ignored."""
+        slot = self.slot()
+        n = min(len(values), self._channels)
+        slot[:n] = values[:n]
+        slot[n:] = np.nan
+        self.commit(recno, wavetime, int(np.count_nonzero(np.isnan(slot))))
+
+    def slot(self):
+        """Invalidate the next row, and return a view of its values, to be filled in place before commit()."""
+        self._seq = int(self._header[0])
+        self._row = self._rows[self._seq % self._depth]
+        self._row[0] = -1.0
+        return self._row[3:]
+
+    def commit(self, recno: int, wavetime: float, nans: int = 0) -> None:
+        """Publish the row returned by slot(), with the record number, waveform time and number of NaN values."""
+        row = self._row
+        row[1] = recno
+        row[2] = wavetime
+        row[0] = self._seq
+        if nans: self._header[4] += nans
+        self._header[5] = time.time_ns()
+        self._header[0] = self._seq + 1
+
+    def read(self, count: int | None = None):
+        """Return a (k x (3 + N)) array copy with up to (count) records written since the last read."""
+        seq = int(self._header[0])
+        if seq - self._cursor > self._depth:
+            # the writer lapped the reader: skip to the oldest record still in the ring
+            self._lost += seq - self._cursor - self._depth
+            self._cursor = seq - self._depth
+        n = seq - self._cursor
+        if count is not None: n = min(n, count)
+        if n <= 0:
+            return self._rows[:0].copy()
+        expected = np.arange(self._cursor, self._cursor + n, dtype=np.float64)
+        i = np.arange(self._cursor, self._cursor + n) % self._depth
+        rows = self._rows[i]
+        # accept only rows with the expected stamp, before and after the copy
+        valid = (rows[:, 0] == expected) & (self._rows[i, 0] == expected)
+        self._lost += n - int(np.count_nonzero(valid))
+        self._cursor += n
+        self._header[3] = self._cursor
+        return rows[valid]
+
+    def close(self) -> None:
+        """Unmap the shared memory block, and unlink it if this is the creator."""
+        del self._header
+        del self._rows
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+#===============================================================================================#
+#   CLASS   FrameParser                                                                         #
+#===============================================================================================#
+
+class FrameParser():
+    """
+        Parser of the continuous sampling response frames, of the form "<value><unit>,<value><unit>,...".</br>
+        The unit suffixes and whitespace are removed from the ASCII frame in a single bytes.translate() 
+        pass, and the split fields are converted and stored by numpy in one assignment into a preallocated 
+        float64 array, typically a SampleRing slot. No per-field str.replace(), strip() or try/except is
+        done, and no record tuple is built.
+
+        Malformed frames, with missing or unconvertible fields, fall back to the per-field conv_float()
+        conversion, with NaN for the invalid and missing fields.
+
+        ## Methods
+        ```
+            .parse(frame, out):     convert the (frame) string into the (out) array, and return the NaN count.
+        ```
+    """
+    DELETE = b'CV%s \t\r\n'      # unit suffixes removed from the values, as in conv_float(), and whitespace
+
+    def parse(self, frame: str, out) -> int:
+        """Convert the (frame) values into the float array (out), and return the number of invalid or missing fields, set to NaN. Extra fields are ignored."""
+        try:
+            out[:] = frame.encode(encoding="ascii", errors="replace").translate(None, self.DELETE).split(b',')
+            return 0
+        except ValueError:
+            pass
+        fields = frame.split(',')
+        for i in range(len(out)):
+            out[i] = conv_float(fields[i].strip()) if i < len(fields) else np.nan
+        return int(np.count_nonzero(np.isnan(out)))
+
+#===============================================================================================#
+#   CLASS   DAQMetrics                                                                          #
+#===============================================================================================#
+
+class DAQMetrics():
+    """
+        Acquisition loop metrics, maintained by the DAQ process.</br>
+        Counts the inter-sample intervals in a fixed histogram, with running min/max/mean/std jitter, 
+        the sampling pauses to service commands, and the stream re-sync and serial port restart events.
+        All updates are O(1).
+
+        ## Methods
+        ```
+            .sample(dt):                    account an inter-sample interval of (dt) seconds.
+            .pause(dt, ncmd, nline):        account a sampling pause of (dt) seconds, for (ncmd) commands in (nline) SCPI lines.
+            .resync():                      account a stream re-sync.
+            .restart():                     account a serial port restart.
+            .summary(**depths):             return the metrics as a "<name>=<value>,..." string, with the queue depths.
+        ```
+    """
+    EDGES = (0.002, 0.005, 0.010, 0.020, 0.050, 0.100, 0.200, 0.500, 1.0, 2.0)     # histogram bin upper edges in seconds
+
+    def __init__(self):
+        self._start = time.time()
+        self._hist = [0] * (len(self.EDGES) + 1)
+        self._n = 0
+        self._sum = 0.0
+        self._sumsq = 0.0
+        self._min = math.inf
+        self._max = 0.0
+        self._pauses = 0
+        self._pause_sum = 0.0
+        self._pause_max = 0.0
+        self._pause_last = 0.0
+        self._cmds = 0
+        self._lines = 0
+        self._resyncs = 0
+        self._restarts = 0
+
+    def sample(self, dt: float) -> None:
+        """Account an inter-sample interval of (dt) seconds."""
+        self._hist[bisect.bisect_left(self.EDGES, dt)] += 1
+        self._n += 1
+        self._sum += dt
+        self._sumsq += dt * dt
+        if dt < self._min: self._min = dt
+        if dt > self._max: self._max = dt
+
+    def pause(self, dt: float, ncmd: int, nline: int) -> None:
+        """Account a sampling pause of (dt) seconds, to execute (ncmd) commands in (nline) SCPI lines."""
+        self._pauses += 1
+        self._pause_sum += dt
+        self._pause_last = dt
+        if dt > self._pause_max: self._pause_max = dt
+        self._cmds += ncmd
+        self._lines += nline
+
+    def resync(self) -> None:
+        """Account a stream re-sync."""
+        self._resyncs += 1
+
+    def restart(self) -> None:
+        """Account a serial port restart."""
+        self._restarts += 1
+
+    def summary(self, **depths) -> str:
+        """Return the metrics as a "<name>=<value>,..." string, with the queue depths given as keywords."""
+        mean = self._sum / self._n if self._n else 0.0
+        std = math.sqrt(max(self._sumsq / self._n - mean * mean, 0.0)) if self._n else 0.0
+        fields = [
+            f'uptime={time.time() - self._start:.1f}',
+            f'samples={self._n}',
+            f'dt_mean={mean:.6f}',
+            f'dt_std={std:.6f}',
+            f'dt_min={self._min if self._n else 0.0:.6f}',
+            f'dt_max={self._max:.6f}',
+            'dt_hist=' + '/'.join(str(x) for x in self._hist),
+            f'pauses={self._pauses}',
+            f'pause_mean={self._pause_sum / self._pauses if self._pauses else 0.0:.6f}',
+            f'pause_max={self._pause_max:.6f}',
+            f'pause_last={self._pause_last:.6f}',
+            f'cmds={self._cmds}',
+            f'lines={self._lines}',
+            f'resyncs={self._resyncs}',
+            f'restarts={self._restarts}',
+        ]
+        fields += [f'{k}={v}' for k, v in depths.items()]
+        return ','.join(fields)
+
 #===============================================================================================#
 #               DATA ACQUISITION: SPAWNED PROCESS                                               #
 #===============================================================================================#
 
-def DAQ_process(ctr_Q:mp.Queue, cmd_Q:mp.Queue, data_Q:mp.Queue, msg_Q:mp.Queue, err_Q:mp.Queue, pool_Q:list[mp.Queue], arg:Namespace, sensors: tuple[Sensor]):
+def DAQ_process(ctr_Q:mp.Queue, cmd_Q:mp.Queue, ring_name:str, msg_Q:mp.Queue, err_Q:mp.Queue, resp_Q:mp.Queue, arg:Namespace, sensors: tuple[Sensor]):
     """
         Data acquisition process, interface via the serial port with the external SCPI instrument.
         This process runs in a separate processor core, and is spawned from the main program context.
         All interprocess communications are channelled through multiprocessing.Queue objects, that
-        guarantee proper multicore context locking.
+        guarantee proper multicore context locking, except the data records.
         
-        The process starts a continuous sampling query of the form ":TRIG:CONT:READ? <>", and sends the 
-        response stream through the queue data_Q. 
+        The process starts a continuous sampling query of the form ":TRIG:CONT:READ? <>", and writes the 
+        response stream records directly into the SampleRing shared memory block named (ring_name), 
+        which is read by the main program without per-record serialization. 
         It also looks for SCPI command requests via the cmd_Q stream, which is a many-to-one multiplexing 
-        stream that is written by all connection handler threads.
-        Command responses are sent to each requesting thread using a unidirectional one-to-one stream that 
-        is uniquely assigned by each requesting thread.
-        The requesting thread sends a command request on the cmd_Q stream, and then blocks on the response
-        queue waiting for the command response. 
-        All response queues are selected from a pool of preallocated mp.Queue objects in an array, and 
-        requesting threads dynamically select an available response queue from a LRU list. The response 
-        queue index is sent with the command string, and the requestor thread waits for the response on
-        the selected response queue.
-
-        This many-to-one command queue, associated to one-to-one dynamic response queues, allows effective
-        and robust multiplexing of the DAQ to N remote processes. 
+        stream that is written by all connection handlers.
+        Each command request carries a unique request id and a priority, and the command responses are 
+        sent back as (req_id, response) tuples on the single resp_Q stream, as soon as each command completes.
+        In the main program, the DAQLink dispatcher routes each response to the future awaited by the 
+        requesting handler.
+        All the commands pending between two sampling frames are executed in priority order in a single
+        stop/resume cycle of the continuous sampling.
+
+        This many-to-one command queue, associated to request ids in a single response queue, allows 
+        effective and robust multiplexing of the DAQ to any number of remote clients. 
         
+        The process keeps DAQMetrics of the sampling intervals, pauses and re-syncs, that are requested with
+        the ":CMD:STAT?" pseudo command without pausing the sampling, and optionally printed every 
+        arg.stat_period seconds.
+
         The main thread can gracefully terminate the DAQ process by sending a "DAQ_ABORT" control message.
         If the DAQ process receives an exception and unexpectedly aborts, it sends "ABORT" and "EXIT" error messages.
     """
+    # --- map the shared memory records ring --------------------------------------------------------
+    ring = SampleRing.attach(ring_name)
     # --- instantiate the instruments -------------------------------------------------------------
-    gvsi = Instrument(gvsi_visa_id_1, baudrate = baudrate, start_delay = 2.0)
-    if not gvsi:
-        if not arg.quiet: msg_Q.put(f'GVSI {gvsi_visa_id_1} not found, trying {gvsi_visa_id_2}...')
-        gvsi = Instrument(gvsi_visa_id_2, baudrate = baudrate, start_delay = 2.0)
+    gvsi = Instrument.discover((gvsi_visa_id_1, gvsi_visa_id_2), cache = arg.port_cache, 
+                               baudrate = baudrate, start_delay = 2.0, adaptive = arg.adaptive)
     if gvsi:
         if not arg.quiet: msg_Q.put(f'{gvsi.idn_str()}, found')
+        if gvsi.load_profile(arg.profile) and arg.verbose: msg_Q.put(f'Latency profile: {arg.profile}, {len(gvsi.latency)} commands')
         if arg.verbose: msg_Q.put(f'CAPABILITIES: {gvsi_capabilities(int(gvsi.ask(":SYST:CAP?")))}')
         configure_gvsi(gvsi, arg)
+        try:
+            gvsi.save_profile(arg.profile)
+        except OSError as e:
+            if not arg.silent: err_Q.put(f'DAQ process: latency profile not saved: {e}')
         if arg.verbose: msg_Q.put(f'DAQ Inputs: {tuple((x.label for x in sensors))},')
         # --- start SCPI command server -----------------------------------------
         if arg.verbose: err_Q.put("DAQ process: START")
@@ -932,94 +1320,160 @@ def DAQ_process(ctr_Q:mp.Queue, cmd_Q:mp.Queue, data_Q:mp.Queue, msg_Q:mp.Queue,
         gvsi.write(cmd_trig)        # trigger continuous sampling of the selected channel names
         cont_read = True
         idx = 0
+        pending = []        # heap of the pending commands: (prio, seqno, cmd)
+        metrics = DAQMetrics()
+        parser = FrameParser()
+        seqno = itertools.count()
+        def drain_cmds():
+            """Move all the command requests in cmd_Q to the pending commands heap."""
+            while not cmd_Q.empty():
+                cmd = cmd_Q.get()
+                heapq.heappush(pending, (getattr(cmd, "prio", DAQLink.PRIO_NORMAL), next(seqno), cmd))
+        def stat_summary():
+            """Return the metrics summary, with the commands and records queue depths."""
+            try:
+                cmd_depth = cmd_Q.qsize()
+            except NotImplementedError:
+                cmd_depth = -1          # qsize() is not implemented on some platforms
+            return metrics.summary(cmd_Q=cmd_depth, pending=len(pending), ring_backlog=ring.backlog)
         tstart_ns = time.perf_counter_ns()
         wdt_start = time.time()
+        stat_start = time.time()
+        wavetime = None
         while True:
             try:
                 # read continuous samping response
-                fields = gvsi.read().split(',')
-                wavetime = (time.perf_counter_ns() - tstart_ns) * 1e-9
-                record = (idx,wavetime) + tuple([conv_float(x.strip()) for x in fields])
+                frame = gvsi.read()
+                t = (time.perf_counter_ns() - tstart_ns) * 1e-9
+                if cont_read and (wavetime is not None):
+                    metrics.sample(t - wavetime)
+                wavetime = t
+                # convert the frame directly into the shared memory ring row
+                nans = parser.parse(frame, ring.slot())
+                ring.commit(idx, wavetime, nans)
                 idx += 1
-                data_Q.put(record)
                 if not cmd_Q.empty():
-                    cmd = cmd_Q.get()
-                    if hasattr(cmd, "cmd") and hasattr(cmd, "resp_Qn") and hasattr(cmd, "wait"):
-                        # break continuous sampling to send the async command, and resume sampling
+                    # stop continuous sampling once, execute all pending commands in priority order, and resume
+                    # sampling once. Commands received while the batch executes join the same cycle, up to
+                    # arg.cmd_batch commands. Each response is sent as soon as the command completes.
+                    # Consecutive plain writes are joined with ';' in a single SCPI line.
+                    drain_cmds()
+                    ncmd = 0
+                    nline = 0
+                    tpause = time.perf_counter()
+                    while pending and (ncmd < arg.cmd_batch):
+                        _, _, cmd = heapq.heappop(pending)
+                        ncmd += 1
+                        if not (hasattr(cmd, "cmd") and hasattr(cmd, "req_id") and hasattr(cmd, "wait")):
+                            continue
                         cmdstr = cmd.cmd.upper()
-                        resp_Q = pool_Q[cmd.resp_Qn]
-                        if valid_cmd(cmdstr):
-                            if any(x in cmdstr for x in(":CMD:TIME:RST",)):
-                                tstart_ns = time.perf_counter_ns()
-                                response = f'{wavetime}'
-                                resp_Q.put(response)
-                            else:
+                        if not valid_cmd(cmdstr):
+                            resp_Q.put((cmd.req_id, "NOK"))
+                        elif any(x in cmdstr for x in(":CMD:TIME:RST",)):
+                            # the acquisition time is monotonic: return the raw time of the new time base origin
+                            response = f'{wavetime}'
+                            resp_Q.put((cmd.req_id, response))
+                        elif any(x in cmdstr for x in(":CMD:STAT?",)):
+                            # acquisition metrics, without pausing the sampling
+                            resp_Q.put((cmd.req_id, stat_summary()))
+                        else:
+                            cmds = [cmd]
+                            if coalescible(cmd):
+                                # join the following plain writes, up to the SCPI line length
+                                cmds = join_writes(pending, cmd, arg.cmd_batch - ncmd + 1, arg.scpi_line)
+                                ncmd += len(cmds) - 1
+                                cmdstr = ';'.join(x.cmd.upper() for x in cmds)
+                            if cont_read:
                                 # stop continuous sampling
                                 if arg.debug: msg_Q.put(f'SCPI: \"Q\"')
                                 gvsi.write("Q")
+                                if arg.adaptive: gvsi.drain()   # discard the frames sent before the stop
                                 cont_read = False
-                                # send async command and get response if query
-                                response = "OK"
-                                time.sleep(cmd.wait)
-                                if arg.debug: msg_Q.put(f'SCPI: \"{cmdstr}\"')
+                                tpause = time.perf_counter()
+                            nline += 1
+                            # send async command and get response if query
+                            response = "OK"
+                            time.sleep(cmd.wait)
+                            if arg.debug: msg_Q.put(f'SCPI: \"{cmdstr}\"')
+                            if '?' in cmdstr:
+                                response = gvsi.ask(cmdstr)
+                                if arg.debug: msg_Q.put(f'RESPONSE: \"{response}\"')
+                            elif any(x in cmdstr for x in("*RST",":SAV",":RCL")):
+                                # reset and EEPROM commands: wait for the firmware completion, learned in the instrument profile
+                                gvsi.write(cmdstr)
+                                gvsi.wait_ready(cmdstr, timeout = 2.0)
+                            elif arg.adaptive:
+                                try:
+                                    gvsi.write(cmdstr, opc=True)    # confirm the completion, and learn the command latency
+                                except RuntimeError as e:
+                                    response = f'ERR: {e}'
+                            else:
+                                gvsi.write(cmdstr)
+                            # test length of response, if too large the :TRIG:CONT:READ? is probably still running
+                            if len(response) > 100:
+                                # --- RE-SYNC THE STREAM ---
+                                metrics.resync()
+                                print(f'Unexpected response length = {len(response)}: {response}')
+                                time.sleep(0.6)
+                                gvsi.write("Q")
+                                time.sleep(0.6)
+                                gvsi.write("Q")
+                                time.sleep(0.6)
+                                gvsi.write("Q")
+                                time.sleep(0.6)
+                                gvsi.write("*cls")
+                                print(f'Retrying {cmdstr}...')
+                                time.sleep(1.0)
                                 if '?' in cmdstr:
                                     response = gvsi.ask(cmdstr)
                                     if arg.debug: msg_Q.put(f'RESPONSE: \"{response}\"')
                                 else:
                                     gvsi.write(cmdstr)
-                                # test length of response, if too large the :TRIG:CONT:READ? is probably still running
                                 if len(response) > 100:
-                                    # --- RE-SYNC THE STREAM ---
-                                    print(f'Unexpected response length = {len(response)}: {response}')
-                                    time.sleep(0.6)
-                                    gvsi.write("Q")
+                                    print(f'Restarting the serial port...')
+                                    metrics.restart()
+                                    sav_visa_str = gvsi.get_visa_str()
+                                    sav_baudrate = gvsi.get_baudrate()
+                                    gvsi.close()
+                                    gvsi = Instrument(sav_visa_str, baudrate = sav_baudrate, start_delay = 2.0, adaptive = arg.adaptive)
+                                    if not gvsi:
+                                        print(f'Attempt to restart the serial port failed: {sav_visa_str}, {sav_baudrate}')
+                                        raise(Exception("DAQ RESTART ERROR"))
                                     time.sleep(0.6)
-                                    gvsi.write("Q")
-                                    time.sleep(0.6)
-                                    gvsi.write("Q")
-                                    time.sleep(0.6)
-                                    gvsi.write("*cls")
-                                    print(f'Retrying {cmdstr}...')
-                                    time.sleep(1.0)
-                                    if '?' in cmdstr:
-                                        response = gvsi.ask(cmdstr)
-                                        if arg.debug: msg_Q.put(f'RESPONSE: \"{response}\"')
-                                    else:
-                                        gvsi.write(cmdstr)
-                                    if len(response) > 100:
-                                        print(f'Restarting the serial port...')
-                                        sav_visa_str = gvsi.get_visa_str()
-                                        sav_baudrate = gvsi.get_baudrate()
-                                        gvsi.close()
-                                        gvsi = Instrument(sav_visa_str, baudrate = sav_baudrate, start_delay = 2.0)
-                                        if not gvsi:
-                                            print(f'Attempt to restart the serial port failed: {sav_visa_str}, {sav_baudrate}')
-                                            raise(Exception("DAQ RESTART ERROR"))
-                                        time.sleep(0.6)
-                                        response = gvsi.ask(":SYST:CAP?")
-                                        if len(response) > 6:
-                                            print(f'Failed attempt of resync: {response=}')
-                                            raise(Exception("DAQ SYNC ERROR"))
-                                        response = "NOK"
-                                        cont_read = False
-                                resp_Q.put(response)
-                                # resume continuous sampling
-                                # time.sleep(0.2)
-                                if arg.debug: msg_Q.put(f'SCPI: \"{cmd_trig}\"')
-                                gvsi.write(cmd_trig)
-                                cont_read = True
-                        else:
-                            resp_Q.put("NOK")
+                                    response = gvsi.ask(":SYST:CAP?")
+                                    if len(response) > 6:
+                                        print(f'Failed attempt of resync: {response=}')
+                                        raise(Exception("DAQ SYNC ERROR"))
+                                    response = "NOK"
+                                    cont_read = False
+                            for cmd in cmds:
+                                resp_Q.put((cmd.req_id, response))
+                        drain_cmds()
+                    if not cont_read:
+                        # resume continuous sampling
+                        if arg.debug: msg_Q.put(f'SCPI: \"{cmd_trig}\"')
+                        gvsi.write(cmd_trig)
+                        cont_read = True
+                        wavetime = None         # the sample gap across the pause is not an inter-sample interval
+                        tpause = time.perf_counter() - tpause
+                        metrics.pause(tpause, ncmd, nline)
+                        if arg.debug: msg_Q.put(f'DAQ: {ncmd} commands in {nline} SCPI lines, sampling paused {tpause * 1e3:.1f}ms')
+                if arg.stat_period and ((time.time() - stat_start) > arg.stat_period):
+                    stat_start = time.time()
+                    msg_Q.put(f'DAQ STAT: {stat_summary()}')
                 if not ctr_Q.empty():
                     if "DAQ_ABORT" in ctr_Q.get():
                         if cont_read:
                             if arg.debug: msg_Q.put(f'SCPI: \"Q\"')
                             gvsi.write("Q")
                             cont_read = False
-                        time.sleep(1000e-3)
+                        if arg.adaptive:
+                            gvsi.drain()
+                        else:
+                            time.sleep(1000e-3)
                         if arg.debug: msg_Q.put(f'SCPI: \"*RST\"')
                         gvsi.write("*RST")
-                        time.sleep(2000e-3)
+                        gvsi.wait_ready("*RST", timeout = 2.0)
                         break
                 if cont_read and ((time.time() - wdt_start) > 10.0):
                     # watchdog keepalive during continuous reading
@@ -1031,18 +1485,597 @@ def DAQ_process(ctr_Q:mp.Queue, cmd_Q:mp.Queue, data_Q:mp.Queue, msg_Q:mp.Queue,
                 break
         time.sleep(0.1)
         if not arg.silent: gvsi.write(":syst:beep MIN")
+        try:
+            gvsi.save_profile(arg.profile)
+        except OSError as e:
+            if not arg.silent: err_Q.put(f'DAQ process: latency profile not saved: {e}')
         gvsi.close()
         if not arg.silent: err_Q.put("DAQ process: EXIT")
     else:
         if arg.verbose: msg_Q.put("Gridvortex GVSI NOT_FOUND!")
         if not arg.silent: err_Q.put("DAQ process: EXIT")
+    ring.close()
+
+#===============================================================================================#
+#   CLASS   RingBuffer                                                                          #
+#===============================================================================================#
+
+class RingBuffer():
+    """
+        Fixed capacity ring buffer for the DAQ records.</br>
+        The buffer is a preallocated 2-D float64 numpy array, where each row holds one record: column 0 is
+        the waveform time, and columns 1..N hold the raw ADC readings of each Sensor, in the Sensor instances
+        order. The record numbers are held in a parallel int64 vector.
+
+        The storage is mirrored: each record is written at row (i) and at row (i + capacity), so that any
+        window of up to (capacity) consecutive records is always contiguous in memory. All slices are returned
+        as zero-copy numpy views, and readers never handle the wraparound.
+
+        Records older than (span) seconds from the most recent record are evicted on append. If the buffer
+        capacity is reached before the time span, the oldest record is overwritten. Both operations are O(1).
+
+        The time column holds the raw monotonic acquisition time, and the waveform time is the raw time minus
+        the epoch of the current time base (toffs). A waveform time reset only appends a new epoch to the
+        time bases history, and stored timestamps are never rewritten. Times can be converted between any of
+        the time bases in the history, with base 0 being the raw acquisition time.
+        The monotonic time column allows O(log n) binary search of time subscripts.
+
+        ## Methods
+        ```
+            .append(recno, wavetime, record):  append a record, evicting the records older than the time span.
+            .reset_time(t0):                   start a new time base with origin at the raw time (t0).
+            .epoch(base):                      raw time origin of the time base (base), default the current base.
+            .rebase(t, src, dst):              convert the time (t) from the time base (src) to the time base (dst).
+            .index(t):                         binary search the subscript of the waveform time (t).
+            .raw_times():                      view of the monotonic time column for all valid records.
+            .times(p0, p1):                    array of waveform times for the [p0:p1] records.
+            .column(s):                        view of the sensor (s) column for all valid records.
+            .rows(p0, p1):                     view of the [p0:p1] records, with the monotonic time and sensors columns.
+            .record(p):                        view of the sensors values of the record (p).
+            .time(p):                          waveform time of the record (p).
+            .recno(p):                         record number of the record (p).
+            .seq(p):                           absolute write sequence of the record (p).
+            .rows_seq(q0, q1):                 view of the records with write sequence [q0:q1], while not overwritten.
+        ```
+        The record subscripts (p) are logical, with 0 for the oldest valid record, and accept negative values.
+        The returned views are valid while the buffer lock is held.
+
+        Each appended record also gets an absolute write sequence number, that is never reused. A reader can 
+        snapshot a window as a sequence range, release the lock, and later copy the window in chunks with 
+        rows_seq(), which fails only if the records were overwritten in the meantime. Records evicted by the
+        time span remain readable until overwritten.
+    """
+
+    @property
+    def capacity(self): return self._capacity
+    @property
+    def channels(self): return self._data.shape[1] - 1
+    @property
+    def span(self): return self._span
+    @property
+    def toffs(self): return self._epochs[-1]
+    @property
+    def bases(self): return len(self._epochs)
+    @property
+    def tmin(self): return self.time(0)
+    @property
+    def tmax(self): return self.time(-1)
+    @property
+    def written(self): return self._written
+
+    def __init__(self, capacity: int, channels: int, span: float):
+        """
+            ### Parameters
+            ```
+                capacity: int
+                    maximum number of records.
+                channels: int
+                    number of sensor channels per record.
+                span: float
+                    time span in seconds retained in the buffer.
+            ```
+        """
+        if capacity < 1: raise ValueError("'capacity': expected >= 1")
+        self._capacity = capacity
+        self._span = span
+        self._data = np.zeros((2 * capacity, channels + 1), dtype=np.float64)
+        self._recno = np.zeros(2 * capacity, dtype=np.int64)
+        self._head = 0          # physical row of the oldest record
+        self._count = 0         # number of valid records
+        self._written = 0       # number of records ever appended, the sequence of the next record
+        self._epochs = [0.0]    # raw time origin of each time base, the last is the current time base
+
+    def __len__(self):
+        return self._count
+
+    def _pos(self, p: int) -> int:
+        """Return the physical row for the logical subscript (p)."""
+        if p < 0: p += self._count
+        if (p < 0) or (p >= self._count): raise IndexError("RingBuffer index out of range")
+        return self._head + p
+
+    def append(self, recno: int, wavetime: float, record) -> None:
+        """Append a record, overwriting the oldest record if full, and evict the records older than the time span."""
+        if self._count == self._capacity:
+            self._head = (self._head + 1) % self._capacity
+            self._count -= 1
+        i = (self._head + self._count) % self._capacity
+        t = wavetime
+        self._data[i, 0] = t
+        self._data[i, 1:] = record
+        self._data[i + self._capacity] = self._data[i]
+        self._recno[i] = self._recno[i + self._capacity] = recno
+        self._count += 1
+        self._written += 1
+        while (self._count > 1) and ((t - self._data[self._head, 0]) > self._span):
+            self._head = (self._head + 1) % self._capacity
+            self._count -= 1
+
+    def reset_time(self, t0: float) -> None:
+        """Start a new time base, with the waveform time 0.0 at the raw acquisition time (t0)."""
+        self._epochs.append(t0)
+
+    def epoch(self, base: int | None = None) -> float:
+        """Return the raw time origin of the time base (base), or of the current time base if not specified."""
+        return self._epochs[-1 if base is None else base]
+
+    def rebase(self, t: float, src: int | None = None, dst: int | None = None) -> float:
+        """Convert the waveform time (t) from the time base (src) to the time base (dst). None selects the current time base."""
+        return t + self.epoch(src) - self.epoch(dst)
+
+    def index(self, t: float) -> int:
+        """Return the first subscript with waveform time greater than or equal to (t), or the extreme subscripts if (t) is out of the buffer."""
+        if self._count == 0:
+            return 0
+        if not (t + self.toffs <= self._data[self._head + self._count - 1, 0]):
+            return self._count - 1
+        return int(np.searchsorted(self.raw_times(), t + self.toffs, side='left'))
+
+    def clear(self) -> None:
+        """Remove all records."""
+        self._head = self._written % self._capacity
+        self._count = 0
+
+    def raw_times(self):
+        """Return a view of the monotonic time column for all valid records."""
+        return self._data[self._head:self._head + self._count, 0]
+
+    def times(self, p0: int = 0, p1: int | None = None):
+        """Return an array with the waveform times of the [p0:p1] records."""
+        return self.rows(p0, p1)[:, 0] - self.toffs
+
+    def column(self, s: int, p0: int = 0, p1: int | None = None):
+        """Return a view of the sensor (s) column for the [p0:p1] records."""
+        return self.rows(p0, p1)[:, s + 1]
+
+    def rows(self, p0: int = 0, p1: int | None = None):
+        """Return a view of the [p0:p1] records, with the monotonic time in column 0 and the sensors in columns 1..N."""
+        p0, p1, _ = slice(p0, p1).indices(self._count)
+        return self._data[self._head + p0:self._head + max(p0, p1)]
+
+    def record(self, p: int):
+        """Return a view of the sensors values of the record (p)."""
+        return self._data[self._pos(p), 1:]
+
+    def time(self, p: int) -> float:
+        """Return the waveform time of the record (p)."""
+        return float(self._data[self._pos(p), 0] - self.toffs)
+
+    def recno(self, p: int) -> int:
+        """Return the record number of the record (p)."""
+        return int(self._recno[self._pos(p)])
+
+    def seq(self, p: int) -> int:
+        """Return the absolute write sequence of the record (p). (p) may be equal to the length, for the next record."""
+        if p < 0: p += self._count
+        if (p < 0) or (p > self._count): raise IndexError("RingBuffer index out of range")
+        return self._written - self._count + p
+
+    def rows_seq(self, q0: int, q1: int):
+        """Return a view of the records with write sequence [q0:q1]. Raise IndexError if any of the records was overwritten."""
+        if (q0 < self._written - self._capacity) or (q1 > self._written) or (q0 > q1):
+            raise IndexError("RingBuffer records overwritten")
+        i = q0 % self._capacity
+        return self._data[i:i + q1 - q0]
+
+#===============================================================================================#
+#   CLASS   RollingWindow                                                                       #
+#===============================================================================================#
+
+class RollingWindow():
+    """
+        Incremental statistics of one channel over a rolling time window.</br>
+        The window holds the samples with time greater than or equal to the newest sample time minus the 
+        window period, the same samples selected by median_avg() at the end of the buffer.
+
+        The samples are kept in arrival order in a deque, and in value order in a sorted list, so that the
+        median, min and max are read in O(1). The sum and the sum of squares are updated on each sample for
+        the mean and the standard deviation, and recomputed periodically to bound the rounding error.
+        NaN samples are counted but not sorted, and all statistics are NaN while the window holds a NaN, 
+        as with np.median().
+
+        ## Properties
+        ```
+            .period: (float):           window period in seconds.
+            .count: (int):              number of samples in the window.
+            .median: (float):           median of the samples.
+            .mean: (float):             mean of the samples.
+            .min: (float):              minimum sample.
+            .max: (float):              maximum sample.
+            .std: (float):              population standard deviation of the samples.
+        ```
+    """
+    RESUM = 1024        # samples between recomputation of the running sums
+
+    @property
+    def period(self): return self._period
+    @property
+    def count(self): return len(self._samples)
+    @property
+    def median(self):
+        n = len(self._sorted)
+        if self._nans or (n == 0): return float('nan')
+        return self._sorted[n // 2] if n % 2 else (self._sorted[n // 2 - 1] + self._sorted[n // 2]) / 2.0
+    @property
+    def mean(self):
+        if self._nans or (len(self._sorted) == 0): return float('nan')
+        return self._sum / len(self._sorted)
+    @property
+    def min(self): return float('nan') if self._nans or (len(self._sorted) == 0) else self._sorted[0]
+    @property
+    def max(self): return float('nan') if self._nans or (len(self._sorted) == 0) else self._sorted[-1]
+    @property
+    def std(self):
+        n = len(self._sorted)
+        if self._nans or (n == 0): return float('nan')
+        mean = self._sum / n
+        return math.sqrt(max(self._sumsq / n - mean * mean, 0.0))
+
+    def __init__(self, period: float):
+        self._period = period
+        self._samples = deque()     # (time, value) in arrival order
+        self._sorted = []           # values in ascending order, without NaN
+        self._nans = 0              # number of NaN values in the window
+        self._sum = 0.0
+        self._sumsq = 0.0
+        self._updates = 0
+
+    def update(self, t: float, v: float) -> None:
+        """Add the sample (v) at time (t), and remove the samples older than the window period."""
+        self._samples.append((t, v))
+        if math.isnan(v):
+            self._nans += 1
+        else:
+            bisect.insort(self._sorted, v)
+            self._sum += v
+            self._sumsq += v * v
+        while self._samples[0][0] < (t - self._period):
+            _, x = self._samples.popleft()
+            if math.isnan(x):
+                self._nans -= 1
+            else:
+                del self._sorted[bisect.bisect_left(self._sorted, x)]
+                self._sum -= x
+                self._sumsq -= x * x
+        self._updates += 1
+        if self._updates >= self.RESUM:
+            self._updates = 0
+            self._sum = math.fsum(self._sorted)
+            self._sumsq = math.fsum(x * x for x in self._sorted)
+
+    def clear(self) -> None:
+        """Remove all samples."""
+        self.__init__(self._period)
+
+#===============================================================================================#
+#   CLASS   RollingStats                                                                        #
+#===============================================================================================#
+
+class RollingStats():
+    """
+        Rolling window statistics engine for all DAQ channels.</br>
+        Maintains one RollingWindow per channel for each configured window period, updated with each 
+        record as it is appended to the buffer. The statistics are computed on the raw ADC readings.
+
+        ## Methods
+        ```
+            .update(t, record):         add a record with the raw time (t) to all windows.
+            .window(s, period):         return the RollingWindow for the sensor (s) and period, or None if not configured.
+            .periods():                 return the tuple of configured window periods.
+        ```
+    """
+    def __init__(self, channels: int, periods):
+        self._windows = {float(p): tuple(RollingWindow(float(p)) for _ in range(channels)) for p in periods}
+
+    def update(self, t: float, record) -> None:
+        """Add the record with raw acquisition time (t) to all windows."""
+        for windows in self._windows.values():
+            for w, v in zip(windows, record):
+                w.update(t, float(v))
+
+    def window(self, s: int, period: float) -> RollingWindow | None:
+        """Return the RollingWindow for the sensor subscript (s) and the window period, or None if not configured."""
+        windows = self._windows.get(period)
+        return windows[s] if windows else None
+
+    def periods(self) -> tuple[float]:
+        """Return the configured window periods."""
+        return tuple(self._windows.keys())
+
+#===============================================================================================#
+#   CLASS   Condition                                                                           #
+#===============================================================================================#
+
+class Condition():
+    """
+        Channel condition, evaluated incrementally on each record received from the DAQ process.</br>
+        The condition is given as a list of fields "<kind> <fieldname>, <args>", in the channel units:
+        ```
+            LEVEL <fieldname>, <target>, <tol>      |value - target| < tol
+            ABOVE <fieldname>, <level>[, <hyst>]    value > level, until value < level - hyst
+            BELOW <fieldname>, <level>[, <hyst>]    value < level, until value > level + hyst
+            DRIFT <fieldname>, <max>[, <interval>]  |baseline drift| <= max units/minute, over the interval (default 60s)
+            PEAK <fieldname>, <prominence>          true on the record where a peak is detected: the value rose by 
+                                                    (prominence) from the last valley, and fell back by (prominence).
+        ```
+        The baseline drift is the same computation as :CMD:BASE:DRIFT?, evaluated every DRIFT_PERIOD seconds 
+        of acquisition time. The last evaluated value is kept in (value), and the condition state in (state).
+        For PEAK the value is the level of the last peak detected.
+
+        ## Methods
+        ```
+            .update(t, record):         evaluate the condition on the raw record with raw time (t), with buf_lock held. Return the state.
+            .event(state):              return the event name of a state change, or None if the change is not an event.
+        ```
+    """
+    KINDS = ("LEVEL", "ABOVE", "BELOW", "DRIFT", "PEAK")
+    EVENTS = {                  # event names of the (False, True) states
+        "LEVEL": ("OUT", "IN"),
+        "ABOVE": ("BELOW", "ABOVE"),
+        "BELOW": ("ABOVE", "BELOW"),
+        "DRIFT": ("UNSTABLE", "STABLE"),
+        "PEAK": (None, "PEAK"),
+    }
+    DRIFT_PERIOD = 1.0          # drift evaluation period in seconds
+
+    def __init__(self, fields: list[str]):
+        """Parse the condition (fields), raising ValueError if invalid."""
+        if (len(fields) < 3) or (fields[0] not in self.KINDS): raise ValueError(f'invalid condition: {" ".join(fields)}')
+        if fields[1] not in Sensor.labels(): raise ValueError(f'invalid fieldname: {fields[1]}')
+        self.kind = fields[0]
+        self.label = fields[1]
+        self._s = tuple(Sensor.labels()).index(fields[1])
+        self._sensor = tuple(Sensor.sensors())[self._s]
+        args = [conv_float(x) for x in fields[2:]]
+        if any(math.isnan(x) for x in args): raise ValueError(f'invalid condition arguments: {" ".join(fields)}')
+        if self.kind == "LEVEL":
+            if len(args) < 2: raise ValueError(f'missing LEVEL tolerance: {" ".join(fields)}')
+            self.target, self.tol = args[0], args[1]
+        elif self.kind == "DRIFT":
+            self.limit = args[0]
+            self.interval = args[1] if len(args) > 1 and args[1] != 0.0 else 60.0
+        elif self.kind == "PEAK":
+            self.prominence = args[0]
+            self._rising = False        # a rise from the valley was detected, tracking the peak
+            self._extreme = math.inf    # valley level while falling, peak level while rising
+        else:
+            self.level = args[0]
+            self.hyst = args[1] if len(args) > 1 else 0.0
+        self._next = 0.0            # acquisition time of the next drift evaluation
+        self.value = float('nan')
+        self.state = False
+
+    def update(self, t: float, record) -> bool:
+        """Evaluate the condition on the raw (record) with raw acquisition time (t), with buf_lock held. Return the state."""
+        if self.kind == "DRIFT":
+            if (t >= self._next) or (t < self._next - self.DRIFT_PERIOD):
+                self._next = t + self.DRIFT_PERIOD
+                self.value = baseline_drift(self._s, self.interval)
+                self.state = abs(self.value) <= self.limit
+            return self.state
+        v = float(self._sensor.val_array(record[self._s]))      # NaN for out of domain readings
+        if self.kind == "PEAK":
+            self.state = False
+            if not self._rising:
+                self._extreme = min(self._extreme, v)
+                if v > self._extreme + self.prominence:
+                    self._rising, self._extreme = True, v
+            else:
+                self._extreme = max(self._extreme, v)
+                if v < self._extreme - self.prominence:
+                    self.value, self.state = self._extreme, True
+                    self._rising, self._extreme = False, v
+            return self.state
+        self.value = v
+        if self.kind == "LEVEL":
+            self.state = abs(v - self.target) < self.tol
+        elif self.kind == "ABOVE":
+            self.state = (v > self.level) or (self.state and (v >= self.level - self.hyst))
+        else:
+            self.state = (v < self.level) or (self.state and (v <= self.level + self.hyst))
+        return self.state
+
+    def event(self, state: bool) -> str | None:
+        """Return the event name of the change to (state), or None if the change is not an event."""
+        return self.EVENTS[self.kind][int(state)]
+
+#===============================================================================================#
+#   CLASS   ConditionMonitor                                                                    #
+#===============================================================================================#
+
+class ConditionMonitor():
+    """
+        Registry of condition watches, evaluated on each record appended to the buffer by the main loop.</br>
+        A watch is a set of Conditions and a callback, called from the main loop thread as 
+        callback(t, state, values), with the raw record time (t), the state of all the conditions and the 
+        condition values. A (once) watch is called when all the conditions are true on the same record, and is 
+        then removed. A persistent watch is called on each change of state, starting with the first record.
+        With no watches, an update costs nothing.
+
+        A watch that raises an exception, in a condition or in its callback, is removed with the error message 
+        in (watch.error), and its (errback) is called as errback(message). The other watches are evaluated, 
+        and update() never raises, so a failing watch never stops the buffering of the records.
+
+        ## Methods
+        ```
+            .add(conditions, callback, once, errback): register a watch, and return its handle.
+            .remove(watch):             remove a watch, if not yet fired.
+            .update(t, record):         evaluate all watches on the raw record with raw time (t), with buf_lock held.
+            .watches:                   number of registered watches.
+            .errors:                    number of watches removed by an exception.
+        ```
+    """
+    @property
+    def watches(self): return len(self._watches)
+    @property
+    def errors(self): return self._errors
+
+    def __init__(self):
+        self._watches = []
+        self._errors = 0
+        self._lock = threading.Lock()
+
+    def add(self, conditions: list[Condition], callback, once: bool = True, errback = None) -> Namespace:
+        """Register a watch for all the (conditions), and return its handle. The (errback) is called with the error message if the watch fails."""
+        watch = Namespace(conditions=tuple(conditions), callback=callback, once=once, state=None, errback=errback, error=None)
+        with self._lock:
+            self._watches.append(watch)
+        return watch
+
+    def remove(self, watch: Namespace) -> None:
+        """Remove the (watch), if not yet fired."""
+        with self._lock:
+            if watch in self._watches: self._watches.remove(watch)
+
+    def update(self, t: float, record) -> None:
+        """Evaluate all watches on the raw (record) with raw time (t), and fire the watches with all conditions true."""
+        if not self._watches: return
+        with self._lock:
+            for watch in tuple(self._watches):
+                try:
+                    state = all([c.update(t, record) for c in watch.conditions])
+                    if watch.once:
+                        if state:
+                            self._watches.remove(watch)
+                            watch.callback(t, state, [c.value for c in watch.conditions])
+                    elif state != watch.state:
+                        watch.state = state
+                        watch.callback(t, state, [c.value for c in watch.conditions])
+                except Exception as e:
+                    # drop only the failing watch
+                    if watch in self._watches: self._watches.remove(watch)
+                    self._errors += 1
+                    watch.error = f'{type(e).__name__}: {e}'
+                    if watch.errback is not None:
+                        try:
+                            watch.errback(watch.error)
+                        except Exception:
+                            pass
+
+#===============================================================================================#
+#   CLASS   DAQLink                                                                             #
+#===============================================================================================#
+
+class DAQLink():
+    """
+        Asynchronous request/response link to the DAQ process.</br>
+        The command requests are sent on the cmd_Q stream as Namespace(cmd, req_id, wait, prio) objects, with a 
+        unique request id. The DAQ process executes the pending requests in (prio) order, lowest first. The DAQ process sends every response as a (req_id, response) tuple on the single
+        resp_Q stream. A dispatcher thread reads resp_Q and resolves the asyncio future registered for the 
+        request id, in the event loop of the requester.
+
+        No response queue or thread is bound to a client connection, and any number of requests can be 
+        pending at the same time.
+
+        ## Methods
+        ```
+            await .request(cmdstr, wait, prio): send the command request, and return the DAQ response.
+            .latencies():                   return the recent request latencies for each command mnemonic.
+            .close():                       stop the dispatcher, cancelling the pending requests.
+        ```
+        The request latency, from the request to the response, is kept for the last LATENCY_DEPTH requests
+        of each command mnemonic (the command header, without the parameters).
+    """
+
+    PRIO_HIGH = 0           # time critical requests, e.g. the time base reset
+    PRIO_NORMAL = 1         # SCPI commands and queries
+    PRIO_LOW = 2            # slow commands, e.g. EEPROM access
+    LATENCY_DEPTH = 256     # latencies kept for each command mnemonic
+
+    @property
+    def pending(self): return len(self._pending)
+
+    def __init__(self, cmd_Q: mp.Queue, resp_Q: mp.Queue):
+        """
+            ### Parameters
+            ```
+                cmd_Q: mp.Queue
+                    DAQ process command requests stream.
+                resp_Q: mp.Queue
+                    DAQ process (req_id, response) stream.
+            ```
+        """
+        self._cmd_Q = cmd_Q
+        self._resp_Q = resp_Q
+        self._req_id = itertools.count(1)
+        self._pending = {}                  # req_id: (loop, future)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._latency = {}                  # mnemonic: deque of the recent latencies in seconds
+        self._thread = threading.Thread(target=self._dispatch, name="DAQLink", daemon=True)
+        self._thread.start()
+
+    async def request(self, cmdstr: str, wait: float = 0.0, prio: int = PRIO_NORMAL) -> str:
+        """Send the command (cmdstr) to the DAQ process with priority (prio), waiting (wait) seconds before sending it to the instrument, and return the response."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        req_id = next(self._req_id)
+        with self._lock:
+            self._pending[req_id] = (loop, future)
+        t0 = time.perf_counter()
+        try:
+            self._cmd_Q.put(Namespace(cmd=cmdstr, req_id=req_id, wait=wait, prio=prio))
+            response = await future
+            mnemonic = cmdstr.split()[0].upper() if cmdstr.strip() else ""
+            with self._lock:
+                self._latency.setdefault(mnemonic, deque(maxlen=self.LATENCY_DEPTH)).append(time.perf_counter() - t0)
+            return response
+        finally:
+            with self._lock:
+                self._pending.pop(req_id, None)
+
+    def latencies(self) -> dict[str, tuple[float]]:
+        """Return a dict with the recent request latencies in seconds, for each command mnemonic."""
+        with self._lock:
+            return {k: tuple(v) for k, v in self._latency.items()}
+
+    def close(self) -> None:
+        """Stop the dispatcher thread, and cancel all pending requests."""
+        self._stop.set()
+        self._thread.join(1.0)
+        with self._lock:
+            for loop, future in self._pending.values():
+                loop.call_soon_threadsafe(future.cancel)
+            self._pending.clear()
+
+    def _dispatch(self) -> None:
+        """Dispatcher thread: resolve the pending request futures with the DAQ responses."""
+        while not self._stop.is_set():
+            try:
+                req_id, response = self._resp_Q.get(timeout=0.5)
+            except Exception:
+                continue
+            with self._lock:
+                pending = self._pending.get(req_id)
+            if pending:
+                loop, future = pending
+                loop.call_soon_threadsafe(lambda f=future, r=response: f.done() or f.set_result(r))
 
 #===============================================================================================#
 #               CMD SOCKET SERVER                                                               #
 #===============================================================================================#
 
 evt_terminate = threading.Event()           # All event loops terminate when set to True
-cmd_lock = threading.Lock()                 # locks other command handlers
 buf_lock = threading.Lock()                 # locks buffer access
 
 def conv_float(x):
@@ -1052,353 +2085,500 @@ def conv_float(x):
         print(f'conv_float({x}): nan!')
         return float('nan')
     
+def capture_rows(rows) -> list:
+    """
+        Append the SampleRing (rows) to the buffer, the rolling statistics and the condition watches, and return 
+        the list of (recno, wavetime, record) tuples for the DATA stream, in the current time base. 
+        The caller holds buf_lock. The condition watches never raise, so every row is captured.
+    """
+    records = []
+    for row in rows:
+        recno, wavetime, record = int(row[1]), float(row[2]), row[3:]
+        buf.append(recno, wavetime, record)
+        stats.update(wavetime, record)
+        monitor.update(wavetime, record)
+        records.append((recno, wavetime - buf.toffs, record))
+    return records
+
 def find_time_index(t:float):
-    """scans the time index and returns the next valid subscript greater than or equal to (t) if the time is found, or the extreme indexes if not. """
-    try:
-        while len(bufidx[0]) < 2:
-            bufidx.pop(0)
-        while len(bufidx[-1]) < 2:
-            bufidx.pop(-1)
-        if (t >= bufidx[0][1]) and (t <= bufidx[-1][1]):
-            for p in range(len(bufidx)):
-                if len(bufidx[p]) > 1:
-                    if t <= bufidx[p][1]:
-                        return p
-                else:
-                    print(f'find_time_index(): Removed orphan tuple p={p}')
-                    bufidx.pop(p)
-            else:
-                return len(bufidx)-1
-        elif t < bufidx[0][1]:
-            return 0
-        else:
-            return len(bufidx)-1
-    except IndexError:
-        return 0
+    """searches the time index and returns the next valid subscript greater than or equal to (t) if the time is found, or the extreme indexes if not. """
+    return buf.index(t)
 
 def median_avg(s, p1, period):
     """Compute the median average for a buffer slice. s = sensor index, pos = ending position, period = integration length."""
-    p0 = find_time_index(bufidx[p1][1] - period)
-    # print(f'{p0=}, {bufidx[p0][1]}')
-    if p0 == -1:
-        p0 = 0
-    # extract the tuple of sensors values from the slice, and index the sensor tuple to extract only the value of that sensor. 
-    X = tuple(t[s] for t in bufadc[p0:p1+1])
-    m = np.median(X)
+    if p1 < 0: p1 += len(buf)
+    if p1 == len(buf) - 1:
+        # at the end of the buffer, use the incremental rolling window if the period is configured
+        w = stats.window(s, period)
+        if w is not None and w.count:
+            return w.median
+    p0 = find_time_index(buf.time(p1) - period)
+    # print(f'{p0=}, {buf.time(p0)}')
+    # the sensor column slice is a view into the buffer, no values are copied.
+    m = np.median(buf.column(s, p0, p1+1))
     return m
 
-def cmd_handler(client_socket, addr, daq_cmd_clients:list, cmd_Q:mp.Queue, msg_Q:mp.Queue, err_Q:mp.Queue, pool_Q:list[mp.Queue], free_Qn:list[int]):
+def baseline_drift(s, interval):
+    """Compute the baseline drift of the sensor (s) over the last (interval) seconds, in units/minute. The caller holds buf_lock."""
+    # get the time interval
+    t1 = buf.tmax
+    t0 = t1 - interval
+    if (t0 < buf.tmin): t0 = buf.tmin
+    # find the datapoints indexes for the time coordinates
+    p0 = find_time_index(t0)
+    p1 = find_time_index(t1)
+    # compute the median baseline value at the 2 interval ends with 1.0s of integration time
+    sensor = tuple(Sensor.sensors())[s]
+    b0 = sensor.val(median_avg(s, p0, 1.0))
+    b1 = sensor.val(median_avg(s, p1, 1.0))
+    # compute the drift and differentiate in 1 minute
+    drift = b1 - b0
+    return drift / interval * 60.0
+
+async def cmd_handler(reader:asyncio.StreamReader, writer:asyncio.StreamWriter, daq_cmd_clients:list, daq:DAQLink, cmd_lock:asyncio.Lock, msg_Q:mp.Queue, err_Q:mp.Queue):
     """
-        This is the DAQ cmd socket handler thread.
-        It runs until the connection is closed by the client.
-        The daq_cmd_clients[] list is maintained with all active connections.
+        This is the DAQ cmd socket handler coroutine.
+        It runs in the cmd server event loop until the connection is closed by the client.
+        The daq_cmd_clients[] list is maintained with the StreamWriter of all active connections.
         IPC is done via Queues:
-            cmd_Q:  channel remote commands to the DAQ_process, shared by handlers.
+            daq:    DAQLink request/response link to the DAQ_process, shared by handlers.
             msg_Q:  async stream for print messages.
             err_Q:  async stream for error messages.
-        IPC for response data:
-            resp_X: pool of preallocated async stream Queues.
-            resp_L: list of available resp_X queues.
             
-        Each handler dynamically binds a response queue from the pool of available
-        response queues, to be used for the response stream sent by the DAQ_process.
-        Each command is sent with a unique associated response queue, ton allow 
-        multiplexing of commands and responses.
+        Each command sent to the DAQ_process is a DAQLink request with a unique request id, 
+        and the handler awaits the response future. All connections are multiplexed in the 
+        same event loop, with no thread or response queue bound to a connection. The buffer is read
+        with buf_lock held in an executor thread, and the responses are formatted from the copies, so
+        the event loop never waits on the main thread buffer updates.
+
+        By default each socket read is one command, and the response is sent with no delimiter. 
+        After ":CMD:FRAME ON" the connection is framed: each request is a line "<id> <command>\n", 
+        and each response is a line "<id> <response>\n" echoing the request id, so the client can 
+        pipeline requests and read the responses with no delays.
 
         CMDs: 
             ":CMD:HMC:SHUTDOWN"                                         Force server shutdown.
             ":CMD:VERS?"                                                Request server version.
+            ":CMD:FRAME ON | OFF"                                       Select the framed "<id> <command>\n" protocol for this connection.
+            ":CMD:FRAME?"                                               Request the framed protocol state, "ON" or "OFF".
             ":CMD:BUFSZ?"                                               Request buffer size.
             ":CMD:NAMES?"                                               Request DATA field names.
-            ":CMD:TIME:RST"                                             Reset waveform time to 0.000000s, adjusting all datapoints in the buffers. 
+            ":CMD:TIME:RST"                                             Reset waveform time to 0.000000s, starting a new time base. 
+            ":CMD:TIME:BASE <n> | LAST"                                 Select the time base for the times sent and received in this connection.
+            ":CMD:TIME:BASE?"                                           Request the selected time base and the number of time bases.
+            ":CMD:TIME:HIST?"                                           Request the raw acquisition time origin of each time base.
             ":CMD:TIME:MIN?"                                            Request minimum buffer timestamp.
             ":CMD:TIME:MAX?"                                            Request maximum buffer timestamp.
             ":CMD:DROP <speed>"                                         Droplets collector. Command the droplets servo to a full excursion at the specified speed.
             ":CMD:READ? ALL | {<fieldname>[[, <time>], <avg_period>]}"  Request current value for a given channel, or value at <time>. Optionally give an averaging period. 
             ":CMD:BASE:DRIFT? <fieldname>[, <interval>]"                Request the specified channel baseline drift for the specified period or for the last minute, and report in units/minute.
+            ":CMD:ROLL? <fieldname>[, <period>]"                        Request the rolling window statistics "<median>,<mean>,<min>,<max>,<std>" of the raw channel readings.
             ":CMD:PEAK? <fieldname>, <time>, <interval>"                Request find first peak for the specified channel, in the time window provided.
+            ":CMD:STAT?"                                                Request the DAQ acquisition metrics "<name>=<value>,...".
+            ":CMD:WAIT? <timeout>; <condition> {; <condition>}"         Wait until all the conditions are true, and report "OK | TIMEOUT,<time>,<value>,...".
+
+        :CMD:READ? and :CMD:BASE:DRIFT? accept a list of items separated by ';', as in ":CMD:READ? ch4, max, 2.0; h2, max, 2.0", 
+        and answer all the items from the same buffer snapshot, in a single comma separated response.
     """
 
     # ----------------- inner functions ---------------------
 
-    def send_cmd(cmdstr, wait=0.0):
-        """Helper function to send a cmd through the cmd Queue."""
-        cmd.cmd = cmdstr
-        cmd.wait = wait
-        cmd_Q.put(cmd)
-        return pool_Q[cmd.resp_Qn].get()
+    async def send_cmd(cmdstr, wait=0.0, prio=DAQLink.PRIO_NORMAL):
+        """Helper function to send a cmd to the DAQ process and await the response."""
+        return await daq.request(cmdstr, wait, prio)
+
+    async def send(response):
+        """Helper function to send a response to the client, framed with the request id in framed mode."""
+        if framed: response = f'{req_id} {response}\n'
+        writer.write(response.encode(encoding="ascii",errors="replace"))
+        await writer.drain()
+
+    async def locked(fn, *args):
+        """Helper function to call fn(*args) with buf_lock held in an executor thread, so the event loop never blocks on buf_lock."""
+        def call():
+            with buf_lock:
+                return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, call)
+
+    def to_cur(t):
+        """Helper function to convert a time received in the selected time base to the current time base."""
+        return buf.rebase(t, tbase, None)
+
+    def to_sel(t):
+        """Helper function to convert a time in the current time base to the selected time base."""
+        return buf.rebase(t, None, tbase)
+
+    def items(cmdstr):
+        """Helper function to split the ';' separated argument items of a command into lists of fields."""
+        return [x.upper().replace(',',' ').split() for x in cmdstr.split(None, 1)[1].split(';')]
+
+    def read_item(item):
+        """Helper function to read a "<fieldname>[, <time>[, <avg_period>]]" item, with buf_lock held. Return None if not available."""
+        if item[0] not in Sensor.labels(): return None
+        sns = tuple(Sensor.labels()).index(item[0])
+        if len(item) > 1:
+            t = buf.tmax if item[1] == "MAX" else buf.tmin if item[1] == "MIN" else to_cur(conv_float(item[1]))
+        else:
+            t = buf.tmax
+        if not ((t >= buf.tmin) and (t <= buf.tmax)): return None
+        pos = find_time_index(t)
+        if len(item) > 2:
+            return tuple(Sensor.sensors())[sns].format(median_avg(sns, pos, conv_float(item[2])))
+        return tuple(Sensor.sensors())[sns].format(buf.record(pos)[sns])
+
+    def drift_item(item):
+        """Helper function to compute a "<fieldname>[, <interval>]" baseline drift item in units/minute, with buf_lock held. Return None if not available."""
+        if item[0] not in Sensor.labels(): return None
+        sns = tuple(Sensor.labels()).index(item[0])
+        interval = conv_float(item[1]) if len(item) > 1 else 60.0
+        if interval == 0.0: interval = 60.0
+        return f'{baseline_drift(sns, interval)}'
 
     # --------------------------------------------------------
 
-    # Allocate a free response queue from the pool, and associate the queue in the cmd object.
-    if len(free_Qn):
-        daq_cmd_clients.append(client_socket)
-        resp_Qn = free_Qn.pop()
-        if arg.verbose: msg_Q.put(f'Accepted cmd connection from {addr}, using queue {resp_Qn}.')
-        cmd = Namespace(cmd="", resp_Qn=resp_Qn, wait=0.0)
-        # continue serving the connection until it is closed by the peer or the termination event is set.
-        while not evt_terminate.is_set():
-            try:
-                # blocks until command arrives
-                data = client_socket.recv(2048)
-                if not data:
-                    if arg.verbose: msg_Q.put(f'Client {addr} disconnected.')
-                    break
-                # parse the command string to isolate arguments
-                cmdstr = data.decode().strip()
-                fields = [x for x in cmdstr.upper().replace(',',' ').split()]
-                # ---- handle pseudo commands -----------------------------------------------------
-                if any(x == fields[0] for x in(":CMD:HMC:SHUTDOWN",)): 
-                    # ":CMD:HMC:SHUTDOWN"
-                    if arg.verbose: msg_Q.put(f'Client {addr}: Received {fields[0]}! Terminating the application.')
-                    client_socket.sendall("ABORT".encode(encoding="ascii",errors="replace"))
-                    evt_terminate.set()
-                elif any(x == fields[0] for x in(":CMD:DROP",)):
-                    # ":CMD:DROP <NRf>"
-                    # perform the DROP pseudo command to collect droplets, and return the servo to MIN position.
-                    response = "ERR"
-                    try:
-                        speed = float(fields[1]) if len(fields) > 1 else 0.0
-                        min = 0.0
-                        max = 0.0
-                        with cmd_lock:
-                            send_cmd(f':pwm1:val min')
-                        time.sleep(0.5)
-                        with cmd_lock:
-                            min = float(send_cmd(":pwm1:min?"))
-                            max = float(send_cmd(":pwm1:max?"))
-                            send_cmd(f':pwm1:move max, {speed}')
-                        if speed != 0.0:
-                            wait = (max - min) / speed
-                            time.sleep(wait + 0.5)
-                        with cmd_lock:
-                            send_cmd(f':pwm1:move min, max')
+    addr = writer.get_extra_info('peername')
+    daq_cmd_clients.append(writer)
+    if arg.verbose: msg_Q.put(f'Accepted cmd connection from {addr}.')
+    tbase = None        # time base selected for this connection, None for the current time base
+    framed = False      # framed "<id> <command>\n" protocol selected for this connection
+    req_id = ''         # request id of the framed command being served
+    # continue serving the connection until it is closed by the peer or the termination event is set.
+    while not evt_terminate.is_set():
+        try:
+            # blocks until command arrives
+            data = await (reader.readline() if framed else reader.read(2048))
+            if not data:
+                if arg.verbose: msg_Q.put(f'Client {addr} disconnected.')
+                break
+            # parse the command string to isolate arguments
+            cmdstr = data.decode().strip()
+            if framed:
+                req_id, _, cmdstr = cmdstr.partition(' ')
+                if not cmdstr:
+                    if req_id: await send("ERR: empty command")
+                    continue
+            fields = [x for x in cmdstr.upper().replace(',',' ').split()]
+            # ---- handle pseudo commands -----------------------------------------------------
+            if any(x == fields[0] for x in(":CMD:HMC:SHUTDOWN",)): 
+                # ":CMD:HMC:SHUTDOWN"
+                if arg.verbose: msg_Q.put(f'Client {addr}: Received {fields[0]}! Terminating the application.')
+                await send("ABORT")
+                evt_terminate.set()
+            elif any(x == fields[0] for x in(":CMD:DROP",)):
+                # ":CMD:DROP <NRf>"
+                # perform the DROP pseudo command to collect droplets, and return the servo to MIN position.
+                response = "ERR"
+                try:
+                    speed = float(fields[1]) if len(fields) > 1 else 0.0
+                    min = 0.0
+                    max = 0.0
+                    async with cmd_lock:
+                        await send_cmd(f':pwm1:val min')
+                    await asyncio.sleep(0.5)
+                    async with cmd_lock:
+                        min = float(await send_cmd(":pwm1:min?"))
+                        max = float(await send_cmd(":pwm1:max?"))
+                        await send_cmd(f':pwm1:move max, {speed}')
+                    if speed != 0.0:
+                        wait = (max - min) / speed
+                        await asyncio.sleep(wait + 0.5)
+                    async with cmd_lock:
+                        await send_cmd(f':pwm1:move min, max')
+                    response = "OK"
+                except Exception as e:
+                    response = f'ERR: {e}'
+                finally:
+                    await send(response)
+            elif any(x == fields[0] for x in(":CMD:VERS?",)):
+                # ":CMD:VERS?"
+                # Request server version
+                response = f'{script_ver}'
+                await send(response)
+            elif any(x == fields[0] for x in(":CMD:FRAME",)):
+                # ":CMD:FRAME ON | OFF"
+                # Select the framed protocol. The response is sent in the protocol of the request.
+                if len(fields) > 1 and any(x == fields[1] for x in("ON", "OFF")):
+                    await send("OK")
+                    framed = fields[1] == "ON"
+                else:
+                    await send("ERR")
+            elif any(x == fields[0] for x in(":CMD:FRAME?",)):
+                # ":CMD:FRAME?"
+                # Request the framed protocol state.
+                response = "ON" if framed else "OFF"
+                await send(response)
+            elif any(x == fields[0] for x in(":CMD:BUFSZ?",)):
+                # ":CMD:BUFSZ?"
+                # Request buffer size.
+                response = f'{arg.bufsize}'
+                await send(response)
+            elif any(x == fields[0] for x in(":CMD:TIME:MIN?",)):
+                # ":CMD:TIME:MIN?"
+                # Request minimum buffer timestamp.
+                tmin = to_sel(buf.tmin)
+                response = f'{tmin}'
+                await send(response)
+            elif any(x == fields[0] for x in(":CMD:TIME:MAX?",)):
+                # ":CMD:TIME:MAX?"
+                # Request maximum buffer timestamp.
+                tmax = to_sel(buf.tmax)
+                response = f'{tmax}'
+                await send(response)
+            elif any(x == fields[0] for x in(":CMD:NAMES?",)):
+                # ":CMD:NAMES?"
+                # Request DATA field names
+                response = f'TIME,' + ','.join(Sensor.labels())
+                await send(response)
+            elif any(x == fields[0] for x in(":CMD:TIME:RST",)):
+                # ":CMD:TIME:RST"
+                # Reset waveform time to 0.000000s, starting a new time base at the current acquisition time.
+                # Returns the reset time in the previous time base. 
+                resp = await send_cmd(cmdstr.upper(), prio=DAQLink.PRIO_HIGH)
+                try:
+                    t0 = float(resp)
+                    def reset():
+                        t = buf.toffs
+                        buf.reset_time(t0)
+                        return t
+                    resp = f'{t0 - await locked(reset)}'
+                except ValueError:
+                    resp = "ERR"
+                await send(resp)
+            elif any(x == fields[0] for x in(":CMD:TIME:BASE",)):
+                # ":CMD:TIME:BASE <n> | LAST"
+                # Select the time base for this connection. Base 0 is the raw acquisition time, LAST follows the current time base.
+                response = "ERR"
+                try:
+                    if fields[1] == "LAST":
+                        tbase = None
                         response = "OK"
-                    except Exception as e:
-                        response = f'ERR: {e}'
-                    finally:
-                        client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
-                elif any(x == fields[0] for x in(":CMD:VERS?",)):
-                    # ":CMD:VERS?"
-                    # Request server version
-                    response = f'{script_ver}'
-                    client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
-                elif any(x == fields[0] for x in(":CMD:BUFSZ?",)):
-                    # ":CMD:BUFSZ?"
-                    # Request buffer size.
-                    response = f'{arg.bufsize}'
-                    client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
-                elif any(x == fields[0] for x in(":CMD:TIME:MIN?",)):
-                    # ":CMD:TIME:MIN?"
-                    # Request minimum buffer timestamp.
-                    tmin = bufidx[0][1]
-                    response = f'{tmin}'
-                    client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
-                elif any(x == fields[0] for x in(":CMD:TIME:MAX?",)):
-                    # ":CMD:TIME:MAX?"
-                    # Request maximum buffer timestamp.
-                    tmax = bufidx[-1][1]
-                    response = f'{tmax}'
-                    client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
-                elif any(x == fields[0] for x in(":CMD:NAMES?",)):
-                    # ":CMD:NAMES?"
-                    # Request DATA field names
-                    response = f'TIME,' + ','.join(Sensor.labels())
-                    client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
-                elif any(x == fields[0] for x in(":CMD:TIME:RST",)):
-                    # ":CMD:TIME:RST"
-                    # Reset waveform time to 0.000000s, adjusting all datapoints in the buffers. 
-                    cmd.cmd = cmdstr.upper()
-                    with cmd_lock:
-                        cmd_Q.put(cmd)
-                        resp = pool_Q[cmd.resp_Qn].get()
-                        try:
-                            toffs = float(resp)
-                        except:
-                            toffs = 0.0
-                    with buf_lock:
-                        for i in range(len(bufidx)):
-                            bufidx[i][1] -= toffs
-                    client_socket.sendall(resp.encode(encoding="ascii",errors="replace"))
-                elif any(x == fields[0] for x in(":CMD:READ?",)):
-                    # ":CMD:READ? ALL | {<fieldname> [[, <time>], <avg_period>]}"
-                    # Request current value for a given channel, or value at <time>. Optionally give an averaging period. 
-                    # If ALL is specified, retrieve the most current record with all DAQ channels
-                    response = "ERR"
-                    try:
-                        if fields[1] == "ALL":
-                            with buf_lock:
-                                wavetime = bufidx[-1][1]
-                                record = bufadc[-1]
-                            strings = tuple((s.format(record[i]) for i, s in enumerate(Sensor.sensors())))
-                            response = f'{wavetime:.6f}s,' + ','.join(strings)
-                        if fields[1] in Sensor.labels():
-                            sns = tuple(Sensor.labels()).index(fields[1])
-                            if len(fields) > 2:
-                                t = bufidx[-1][1] if fields[2].upper() == "MAX" else bufidx[0][1] if fields[2].upper() == "MIN" else conv_float(fields[2])
-                            else:
-                                t = bufidx[-1][1]
-                            with buf_lock:
-                                if (t >= bufidx[0][1]) and (t <= bufidx[-1][1]):
-                                    pos = find_time_index(t)
-                                    if len(fields) > 3:
-                                        avg_period = conv_float(fields[3])
-                                        response = tuple(Sensor.sensors())[sns].format(median_avg(sns, pos, avg_period))
-                                    else:
-                                        response = tuple(Sensor.sensors())[sns].format(bufadc[pos][sns])
-                    except Exception as e:
-                        response = f'ERR: {e}'
-                    finally:
-                        client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
-                elif any(x == fields[0] for x in(":CMD:BASE:DRIFT?",)):
-                    # ":CMD:BASE:DRIFT? <fieldname>[, <interval>]"
-                    # Request the specified channel baseline drift for the specified period or for the last minute, and report in units/minute.
-                    response = "ERR"
-                    try:
-                        if fields[1] in Sensor.labels():
-                            sns = tuple(Sensor.labels()).index(fields[1])
-                            # print(f'{sns=}')
-                            if len(fields) > 2:
-                                interval = conv_float(fields[2])
-                            else:
-                                interval = 60.0
-                            # print(f'{interval=}')
-                            if interval == 0.0: interval = 60.0
-                            with buf_lock:
-                                # get the time interval
-                                t1 = bufidx[-1][1]
-                                t0 = t1 - interval
-                                if (t0 < bufidx[0][1]): t0 = bufidx[0][1]
+                    elif 0 <= int(fields[1]) < buf.bases:
+                        tbase = int(fields[1])
+                        response = "OK"
+                except Exception as e:
+                    response = f'ERR: {e}'
+                finally:
+                    await send(response)
+            elif any(x == fields[0] for x in(":CMD:TIME:BASE?",)):
+                # ":CMD:TIME:BASE?"
+                # Request "<selected base>,<number of bases>". The selected base is the current base if following LAST.
+                response = f'{buf.bases - 1 if tbase is None else tbase},{buf.bases}'
+                await send(response)
+            elif any(x == fields[0] for x in(":CMD:TIME:HIST?",)):
+                # ":CMD:TIME:HIST?"
+                # Request the raw acquisition time origin of each time base, from base 0 to the current base.
+                response = ','.join(f'{buf.epoch(i)}' for i in range(buf.bases))
+                await send(response)
+            elif any(x == fields[0] for x in(":CMD:READ?",)):
+                # ":CMD:READ? ALL | {<fieldname> [[, <time>], <avg_period>]} {; <fieldname> [[, <time>], <avg_period>]}"
+                # Request current value for a given channel, or value at <time>. Optionally give an averaging period. 
+                # If ALL is specified, retrieve the most current record with all DAQ channels
+                response = "ERR"
+                try:
+                    if fields[1] == "ALL":
+                        wavetime, record = await locked(lambda: (buf.time(-1), buf.record(-1).copy()))
+                        response = Sensor.record_fmt().format(to_sel(wavetime), *Sensor.val_records(record).tolist())
+                    else:
+                        # one or more ';' separated items, all read from the same buffer snapshot
+                        values = await locked(lambda: [read_item(x) for x in items(cmdstr)])
+                        if all(x is not None for x in values):
+                            response = ','.join(values)
+                except Exception as e:
+                    response = f'ERR: {e}'
+                finally:
+                    await send(response)
+            elif any(x == fields[0] for x in(":CMD:BASE:DRIFT?",)):
+                # ":CMD:BASE:DRIFT? <fieldname>[, <interval>] {; <fieldname>[, <interval>]}"
+                # Request the specified channel baseline drift for the specified period or for the last minute, and report in units/minute.
+                response = "ERR"
+                try:
+                    # one or more ';' separated items, all computed from the same buffer snapshot
+                    values = await locked(lambda: [drift_item(x) for x in items(cmdstr)])
+                    if all(x is not None for x in values):
+                        response = ','.join(values)
+                except Exception as e:
+                    response = f'ERR: {e}'
+                finally:
+                    await send(response)
+            elif any(x == fields[0] for x in(":CMD:ROLL?",)):
+                # ":CMD:ROLL? <fieldname>[, <period>]"
+                # Request the rolling window statistics of the raw channel readings, for one of the configured window periods.
+                # returns "<median>,<mean>,<min>,<max>,<std>"
+                response = "ERR"
+                try:
+                    if fields[1] in Sensor.labels():
+                        sns = tuple(Sensor.labels()).index(fields[1])
+                        period = conv_float(fields[2]) if len(fields) > 2 else stats.periods()[0]
+                        def roll():
+                            w = stats.window(sns, period)
+                            return None if w is None else (w.median, w.mean, w.min, w.max, w.std)
+                        w = await locked(roll)
+                        if w is not None:
+                            response = ','.join(f'{x}' for x in w)
+                except Exception as e:
+                    response = f'ERR: {e}'
+                finally:
+                    await send(response)
+            elif any(x == fields[0] for x in(":CMD:PEAK?",)):
+                # ":CMD:PEAK? <fieldname>, <time>, <interval>"
+                # returns "<pktim>,<pkval>"
+                # Request find first peak for the specified channel, in the time window provided.
+                response = "ERR"
+                try:
+                    if fields[1] in Sensor.labels():
+                        sns = tuple(Sensor.labels()).index(fields[1])
+                        # print(f'{sns=}')
+                        # print(f'{fields=}')
+                        if len(fields) > 3:
+                            t0 = to_cur(conv_float(fields[2]))
+                            interval = conv_float(fields[3])
+                            # print(f'{t0=}, {interval=}')
+                            def window(t0):
+                                # get the [t0:t1] time interval
+                                t1 = t0 + interval
+                                if (t0 < buf.tmin): t0 = buf.tmin
+                                if (t1 > buf.tmax): t1 = buf.tmax
                                 # print(f'{t0=},{t1=}')
-                                # find the datapoints indexes for the time coordinates
+                                # find the [p0:p1] datapoints indexes for the time coordinates
                                 p0 = find_time_index(t0)
                                 p1 = find_time_index(t1)
                                 # print(f'{p0=},{p1=}')
-                                # compute the median baseline value at the 2 interval ends with 1.0s of integration time
-                                b0 = tuple(Sensor.sensors())[sns].val(median_avg(sns, p0, 1.0))
-                                b1 = tuple(Sensor.sensors())[sns].val(median_avg(sns, p1, 1.0))
-                                # print(f'{b0=},{b1=}')
-                                # compute the drift and differentiate in 1 minute
-                                drift = b1 - b0
-                                diff = drift / interval * 60.0
-                                response = f'{diff}'
-                    except Exception as e:
-                        response = f'ERR: {e}'
-                    finally:
-                        client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
-                elif any(x == fields[0] for x in(":CMD:PEAK?",)):
-                    # ":CMD:PEAK? <fieldname>, <time>, <interval>"
-                    # returns "<pktim>,<pkval>"
-                    # Request find first peak for the specified channel, in the time window provided.
-                    response = "ERR"
-                    try:
-                        if fields[1] in Sensor.labels():
-                            sns = tuple(Sensor.labels()).index(fields[1])
-                            # print(f'{sns=}')
-                            # print(f'{fields=}')
-                            if len(fields) > 3:
-                                t0 = conv_float(fields[2])
-                                interval = conv_float(fields[3])
-                                # print(f'{t0=}, {interval=}')
-                                with buf_lock:
-                                    # get the [t0:t1] time interval
-                                    t1 = t0 + interval
-                                    if (t0 < bufidx[0][1]): t0 = bufidx[0][1]
-                                    if (t1 > bufidx[-1][1]): t1 = bufidx[-1][1]
-                                    # print(f'{t0=},{t1=}')
-                                    # find the [p0:p1] datapoints indexes for the time coordinates
-                                    p0 = find_time_index(t0)
-                                    p1 = find_time_index(t1)
-                                    # print(f'{p0=},{p1=}')
-                                    # find the highest peak in the interval
-                                    b0 = (tuple(Sensor.sensors())[sns].val(median_avg(sns, p0, 1.0))) + 1e-3
-                                    # print(f'{b0=}')
-                                    x = tuple(t[1] for t in bufidx[p0:p1+1])
-                                    y = tuple(tuple(Sensor.sensors())[sns].val(t[sns]) for t in bufadc[p0:p1+1])
-                                    peaks, _ = find_peaks(np.array(y), height = b0, distance = (p1-p0) / 2.0)
-                                    if len(peaks) > 0:
-                                        pkval: float = -1e6
-                                        pktim: float = 0.0
-                                        for i in peaks:
-                                            if y[i] > pkval:
-                                                pkval = y[i]
-                                                pktim = x[i]
-                                            elif (pkval - y[i]) > 1000e-6:
-                                                break
-                                        # print(f'{pktim=},{pkval=}')
-                                        if pkval > b0:
-                                            response = f'{pktim},{pkval}'
-                    except Exception as e:
-                        response = f'ERR: {e}'
-                    finally:
-                        client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
-                elif any(x == fields[0] for x in(":TRIG:CONT:READ?",)):
-                    # remove the CONT read from SCPI trigger command, and issue a single read instead.
-                    cmd.cmd = cmdstr.upper().replace(":CONT", "")
-                    with cmd_lock:
-                        cmd_Q.put(cmd)
-                        resp = pool_Q[cmd.resp_Qn].get()
-                    client_socket.sendall(resp.encode(encoding="ascii",errors="replace"))
-                elif any(x in fields[0] for x in("*RST",":SAV",":RCL")):
-                    # intercept the *RST command any EEPROM read/write command and insert a 2.0s delay to account for firmware response time.
-                    cmd.cmd = cmdstr
-                    cmd.wait = 2.0
-                    with cmd_lock:
-                        cmd_Q.put(cmd)
-                        resp = pool_Q[cmd.resp_Qn].get()
-                    client_socket.sendall(resp.encode(encoding="ascii",errors="replace"))
-                else:
-                    # send the SCPI command to the ACQ process and wait on the response
-                    cmd.cmd = cmdstr
-                    with cmd_lock:
-                        cmd_Q.put(cmd)
-                        resp = pool_Q[cmd.resp_Qn].get()
-                    client_socket.sendall(resp.encode(encoding="ascii",errors="replace"))
-            except OSError as e:
-                if not arg.silent: err_Q.put(f'cmd_handelr: Client {addr} Socket error: {e}')
-                break
-            except Exception as e:
-                if not arg.silent: err_Q.put(f'cmd_handelr: Error handling client {addr}: {e}')
-                break
-        free_Qn.append(resp_Qn)
-        if arg.verbose: msg_Q.put(f'CMD Handler {addr}: releasing queue {resp_Qn}.')
-    else:
-        if not arg.silent: err_Q.put(f'CMD Handler {addr} ERROR: out of queue resources. Closing connection.')
-    if client_socket: 
-        client_socket.close()
-        if client_socket in daq_cmd_clients: daq_cmd_clients.remove(client_socket)
-        if arg.verbose: msg_Q.put(f'Connection with {addr} closed.')
-    if arg.verbose: msg_Q.put(f'CMD Handler {addr}: thread stopped.')
-
-def cmd_server_listener(server_socket, daq_cmd_clients:list, cmd_Q:mp.Queue, msg_Q:mp.Queue, err_Q:mp.Queue, pool_Q:list[mp.Queue], free_Qn:list[int]):
-    """
-        This thread runs forever the cmd server socket listener, and starts 
-        a new handler thread for each accepted connection.
-        The main thread sets the evt_terminate event and closes the 
-        cmd socket server to terminate the listener thread.
-    """
-    client_socket = None
-    while not evt_terminate.is_set():
-        try:
-            # blocks until an incoming connection is received
-            client_socket, addr = server_socket.accept()
-            # runs each client handler in a thread
-            cmd_handler_thread = threading.Thread(target=cmd_handler, args=(client_socket, addr, daq_cmd_clients, cmd_Q, msg_Q, err_Q, pool_Q, free_Qn))
-            cmd_handler_thread.daemon = True
-            cmd_handler_thread.start()
+                                b0 = (tuple(Sensor.sensors())[sns].val(median_avg(sns, p0, 1.0))) + 1e-3
+                                return p0, p1, b0, buf.times(p0, p1+1).copy(), buf.column(sns, p0, p1+1).copy()
+                            # copy the window with buf_lock held, and find the highest peak in the copy
+                            p0, p1, b0, x, y = await locked(window, t0)
+                            # print(f'{b0=}')
+                            y = tuple(Sensor.sensors())[sns].val_array(y)
+                            peaks, _ = find_peaks(y, height = b0, distance = (p1-p0) / 2.0)
+                            if len(peaks) > 0:
+                                pkval: float = -1e6
+                                pktim: float = 0.0
+                                for i in peaks:
+                                    if y[i] > pkval:
+                                        pkval = y[i]
+                                        pktim = x[i]
+                                    elif (pkval - y[i]) > 1000e-6:
+                                        break
+                                # print(f'{pktim=},{pkval=}')
+                                if pkval > b0:
+                                    response = f'{to_sel(pktim)},{pkval}'
+                except Exception as e:
+                    response = f'ERR: {e}'
+                finally:
+                    await send(response)
+            elif any(x == fields[0] for x in(":CMD:STAT?",)):
+                # ":CMD:STAT?"
+                # Request the DAQ process acquisition metrics: inter-sample interval statistics and histogram, 
+                # sampling pauses, re-sync events and queue depths, as "<name>=<value>,..." fields.
+                resp = await send_cmd(":CMD:STAT?", prio=DAQLink.PRIO_HIGH)
+                await send(resp)
+            elif any(x == fields[0] for x in(":CMD:WAIT?",)):
+                # ":CMD:WAIT? <timeout>; <condition> {; <condition>}"
+                # Wait until all the conditions are true on the same record, or the timeout in seconds expires.
+                # The conditions are evaluated on each record as it arrives, see the Condition class.
+                # returns "OK,<time>,<value>,..." or "TIMEOUT,<time>,<value>,..." with the last evaluated condition values.
+                # The watch is dropped as soon as the client disconnects, and no response is sent.
+                response = "ERR"
+                watch = None
+                try:
+                    spec = items(cmdstr)
+                    timeout = conv_float(spec[0][0])
+                    if not (math.isfinite(timeout) and timeout >= 0.0): raise ValueError(f'invalid timeout: {spec[0][0]}')
+                    conditions = [Condition(x) for x in spec[1:]]
+                    if conditions:
+                        loop = asyncio.get_running_loop()
+                        fired = loop.create_future()
+                        def resolve(t, values):
+                            if not fired.done(): fired.set_result((t, values))
+                        def fail(error):
+                            if not fired.done(): fired.set_exception(RuntimeError(error))
+                        watch = monitor.add(conditions, lambda t, state, values: loop.call_soon_threadsafe(resolve, t, values),
+                                            errback=lambda error: loop.call_soon_threadsafe(fail, error))
+                        # wait in slices, to check the client connection while the conditions are not met
+                        deadline = loop.time() + timeout
+                        while not fired.done() and not (reader.at_eof() or writer.is_closing()) and ((remaining := deadline - loop.time()) > 0.0):
+                            await asyncio.wait((fired,), timeout=remaining if remaining < 0.5 else 0.5)
+                        if fired.done():
+                            t, values = fired.result()
+                            response = f'OK,{buf.rebase(t, 0, tbase)}' + ''.join(f',{x}' for x in values)
+                        elif reader.at_eof() or writer.is_closing():
+                            response = None
+                        else:
+                            last = await locked(lambda: (buf.rebase(buf.tmax, None, tbase), [c.value for c in conditions]) if len(buf) else None)
+                            if last is None:
+                                response = "ERR: no records"
+                            else:
+                                t, values = last
+                                response = f'TIMEOUT,{t}' + ''.join(f',{x}' for x in values)
+                except Exception as e:
+                    response = f'ERR: {e}'
+                finally:
+                    if watch is not None: monitor.remove(watch)
+                if response is not None: await send(response)
+            elif any(x == fields[0] for x in(":TRIG:CONT:READ?",)):
+                # remove the CONT read from SCPI trigger command, and issue a single read instead.
+                resp = await send_cmd(cmdstr.upper().replace(":CONT", ""))
+                await send(resp)
+            elif any(x in fields[0] for x in("*RST",":SAV",":RCL")):
+                # intercept the *RST command any EEPROM read/write command: the DAQ process waits the firmware completion.
+                resp = await send_cmd(cmdstr, prio=DAQLink.PRIO_LOW)
+                await send(resp)
+            else:
+                # send the SCPI command to the ACQ process and wait on the response
+                resp = await send_cmd(cmdstr)
+                await send(resp)
+        except asyncio.CancelledError:
+            # the cmd server is shutting down
+            break
         except OSError as e:
-            if not arg.silent: err_Q.put(f"Cmd Server Listener OSError: {e}")
+            if not arg.silent: err_Q.put(f'cmd_handelr: Client {addr} Socket error: {e}')
             break
         except Exception as e:
-            if not arg.silent: err_Q.put(f"Cmd Server Listener Exception: {e}")
+            if not arg.silent: err_Q.put(f'cmd_handelr: Error handling client {addr}: {e}')
             break
+    if writer in daq_cmd_clients: daq_cmd_clients.remove(writer)
+    writer.close()
+    if arg.verbose: msg_Q.put(f'Connection with {addr} closed.')
+    if arg.verbose: msg_Q.put(f'CMD Handler {addr}: stopped.')
+
+async def cmd_server_loop(server_socket, daq_cmd_clients:list, daq:DAQLink, msg_Q:mp.Queue, err_Q:mp.Queue):
+    """
+        This coroutine runs the asyncio cmd server on the listening socket, and serves each accepted
+        connection with a cmd_handler() task in the same event loop.
+        When the evt_terminate event is set, it stops accepting connections, closes all client 
+        connections and cancels the remaining handler tasks.
+    """
+    cmd_lock = asyncio.Lock()       # serializes the multi-command DAQ sequences of the pseudo commands
+    server = await asyncio.start_server(lambda reader, writer: cmd_handler(reader, writer, daq_cmd_clients, daq, cmd_lock, msg_Q, err_Q), sock=server_socket)
+    while not evt_terminate.is_set():
+        await asyncio.sleep(0.1)
+    server.close()
+    for writer in tuple(daq_cmd_clients):
+        writer.close()
+    tasks = [x for x in asyncio.all_tasks() if x is not asyncio.current_task()]
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def cmd_server_listener(server_socket, daq_cmd_clients:list, daq:DAQLink, msg_Q:mp.Queue, err_Q:mp.Queue):
+    """
+        This thread runs the cmd server event loop, that multiplexes the cmd server socket listener
+        and all the client connections.
+        The main thread sets the evt_terminate event and joins the thread to terminate the server.
+    """
+    try:
+        asyncio.run(cmd_server_loop(server_socket, daq_cmd_clients, daq, msg_Q, err_Q))
+    except OSError as e:
+        if not arg.silent: err_Q.put(f"Cmd Server Listener OSError: {e}")
+    except Exception as e:
+        if not arg.silent: err_Q.put(f"Cmd Server Listener Exception: {e}")
     if server_socket: server_socket.close()
     if arg.verbose: msg_Q.put("Cmd Server thread stopped.")
 
-def start_cmd_server(host, port, cmd_Q:mp.Queue, msg_Q:mp.Queue, err_Q:mp.Queue, pool_Q:list[mp.Queue], free_Qn:list[int], arg:Namespace):
+def start_cmd_server(host, port, daq:DAQLink, msg_Q:mp.Queue, err_Q:mp.Queue, arg:Namespace):
     """
-        This function opens a socket listener and creates a server listener thread. 
-        Returns the server socket and a dynamic list of all clients sockets.
+        This function opens a socket listener and creates the cmd server event loop thread. 
+        Returns the server thread and a dynamic list of all clients StreamWriters.
         The daq_cmd_clients[] list is maintained by the connection handlers with the active
         connections.
     """
@@ -1406,31 +2586,224 @@ def start_cmd_server(host, port, cmd_Q:mp.Queue, msg_Q:mp.Queue, err_Q:mp.Queue,
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind((host, port))
-    server_socket.listen(arg.max_handlers)
+    server_socket.listen(socket.SOMAXCONN)
+    server_socket.setblocking(False)
     if arg.verbose: msg_Q.put(f"Cmd Server listening on {server_socket.getsockname()}")
-    cmd_server_thread = threading.Thread(target=cmd_server_listener, args=(server_socket, daq_cmd_clients, cmd_Q, msg_Q, err_Q, pool_Q, free_Qn))
+    cmd_server_thread = threading.Thread(target=cmd_server_listener, args=(server_socket, daq_cmd_clients, daq, msg_Q, err_Q))
     cmd_server_thread.daemon = True
     cmd_server_thread.start()
-    return server_socket, daq_cmd_clients
+    return cmd_server_thread, daq_cmd_clients
 
 #===============================================================================================#
 #               DATA SOCKET SERVER                                                              #
 #===============================================================================================#
 
-def data_handler(client_socket, addr, data_clients:list, data_queues:list, msg_Q:mp.Queue, err_Q:mp.Queue):
+class DataRecord():
+    """
+        Converted DAQ record distributed to the DATA stream listeners.</br>
+        The record frames are encoded on first use and cached in the record object. Listeners that 
+        share the same record object share its encoded frames.
+
+        Frame formats:
+        ```
+            ASC:        "<time>s,<value><unit>,..." text record, formatted with the sensors format strings.
+            BIN,32:     little-endian fixed width record "<Qd{N}f": recno, time, N x float32 sensor values.
+            BIN,64:     little-endian fixed width record "<Qd{N}d": recno, time, N x float64 sensor values.
+        ```
+        The binary stream starts with an ASCII header line describing the record layout and the channels:
+        ```
+            "#BIN,<struct format>,<record size>,RECNO,TIME[s],<label>[<unit>],...\n"
+        ```
+        DataRecord.configure() must be called after the sensors are created.
+    """
+    __slots__ = ('recno', 'wavetime', 'values', '_frames')
+    _rowfmt = ''
+    _structs = {}
+
+    def __init__(self, recno: int, wavetime: float, values: list[float]):
+        self.recno = recno
+        self.wavetime = wavetime
+        self.values = values
+        self._frames = {}
+
+    @classmethod
+    def configure(cls) -> None:
+        """Prepare the record formats for the current Sensor instances."""
+        n = Sensor.count()
+        cls._rowfmt = Sensor.record_fmt()
+        cls._structs = {32: struct.Struct(f'<Qd{n}f'), 64: struct.Struct(f'<Qd{n}d')}
+
+    @classmethod
+    def header(cls, bits: int = 32) -> bytes:
+        """Return the binary stream header line for the float width (bits)."""
+        st = cls._structs[bits]
+        hdr = f'#BIN,{st.format},{st.size},RECNO,TIME[s],' + ','.join(f'{x.label}[{x.unit}]' for x in Sensor.sensors()) + '\n'
+        return hdr.encode(encoding="ascii",errors="replace")
+
+    def frame(self, form: str = "ASC", bits: int = 32) -> bytes:
+        """Return the record encoded in the frame format (form), "ASC" or "BIN" with (bits) floats."""
+        key = bits if form == "BIN" else form
+        f = self._frames.get(key)
+        if f is None:
+            if form == "BIN":
+                f = self._structs[bits].pack(self.recno, self.wavetime, *self.values)
+            else:
+                f = self._rowfmt.format(self.wavetime, *self.values).encode(encoding="ascii",errors="replace")
+            self._frames[key] = f
+        return f
+
+class Broadcast():
+    """
+        In-process one-to-many channel for the DATA stream records.</br>
+        The producer writes each record once in a shared ring, and each subscriber reads the ring with 
+        its own cursor, so the fan-out cost does not depend on the number of subscribers. Subscribers 
+        block on a condition variable until new records are published, and idle subscribers cost nothing.
+
+        A subscriber that falls behind by more than the ring depth has lost records. With the "DROP" 
+        policy the subscriber skips to the oldest record still in the ring and the dropped count is 
+        incremented. With the "CLOSE" policy, Broadcast.Overrun is raised to the subscriber.
+
+        ## Methods
+        ```
+            .publish(records):          write a sequence of records to the ring and wake up the subscribers.
+            .subscribe():               return a new Subscriber, starting at the next published record.
+            .close():                   wake up all subscribers, which then receive no more records.
+            .subscribers:               number of active subscribers.
+        ```
+    """
+    class Overrun(Exception):
+        """Raised to a subscriber that lost records, with the CLOSE lag policy."""
+
+    class Subscriber():
+        """Read cursor of one Broadcast subscriber."""
+        def __init__(self, channel):
+            self._channel = channel
+            self._cursor = channel._seq     # sequence of the next record to read
+            self.dropped = 0                # total records lost by lagging behind the producer
+
+        def get(self, timeout: float | None = None, count: int = 256) -> list:
+            """Block until records are available or the timeout expires, and return up to (count) records."""
+            return self._channel._read(self, timeout, count)
+
+        def close(self) -> None:
+            """Remove the subscriber from the channel."""
+            self._channel._unsubscribe(self)
+
+    @property
+    def subscribers(self): return self._subscribers
+
+    def __init__(self, depth: int, policy: str = "DROP"):
+        self._ring = [None] * depth
+        self._depth = depth
+        self._policy = policy
+        self._seq = 0                       # sequence of the next published record
+        self._subscribers = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def publish(self, records) -> None:
+        """Write the records to the ring, and wake up the subscribers."""
+        with self._cond:
+            for r in records:
+                self._ring[self._seq % self._depth] = r
+                self._seq += 1
+            self._cond.notify_all()
+
+    def subscribe(self):
+        """Return a new Subscriber, that receives the records published from now on."""
+        with self._cond:
+            self._subscribers += 1
+            return Broadcast.Subscriber(self)
+
+    def close(self) -> None:
+        """Close the channel, waking up all subscribers."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _unsubscribe(self, sub) -> None:
+        with self._cond:
+            self._subscribers -= 1
+
+    def _read(self, sub, timeout: float | None, count: int) -> list:
+        with self._cond:
+            self._cond.wait_for(lambda: self._closed or (sub._cursor < self._seq), timeout)
+            if self._closed:
+                return []
+            lag = self._seq - sub._cursor
+            if lag > self._depth:
+                if self._policy == "CLOSE":
+                    raise Broadcast.Overrun(f'{lag - self._depth} records lost')
+                sub.dropped += lag - self._depth
+                sub._cursor = self._seq - self._depth
+            n = min(self._seq - sub._cursor, count)
+            records = [self._ring[(sub._cursor + i) % self._depth] for i in range(n)]
+            sub._cursor += n
+            return records
+
+def data_handler(client_socket, addr, data_clients:list, data_bcast:Broadcast, msg_Q:mp.Queue, err_Q:mp.Queue):
     """
         This is the DAQ data socket stream handler thread.
         It runs until the connection is closed by the client.
         The data_clients[] list is maintained with all active connections.
-        The data_queues[] list holds the stream output queues for all data threads.
+        The data_bcast Broadcast channel carries the stream records for all data threads.
         IPC is done via Queues:
             msg_Q:  async stream for print messages.
             err_Q:  async stream for error messages.
-        The data handler will instantiate a new mp.Queue() object and add it to the pool of active data stream queues. 
-        The main thread distributes the DAQ data records to all active data stream queues. 
+        The data handler subscribes to the data_bcast channel to serve a :DATA:LISTEN stream.
+        The main thread publishes the DAQ data records once in the channel, as DataRecord objects
+        that are encoded in the frame format selected by each connection.
+        Listeners that lag behind the channel depth lose records or are closed, as set by arg.lag_policy.
+
+        A connection can subscribe to channel events, given as Condition specifications, and receive them 
+        with :DATA:EVENTS. The subscriptions are ConditionMonitor persistent watches, evaluated by the main 
+        thread on each record, which post an event line on each change of the condition state:
+            "EVT,<id>,<time>,<event>,<fieldname>,<value>\n"
+        where <event> is the state name, e.g. ABOVE/BELOW, IN/OUT, STABLE/UNSTABLE or PEAK, and <value> the 
+        condition value: the channel value, the baseline drift or the peak level. The events are queued up to 
+        arg.stream_depth events while not streaming, and dropped events are reported as errors.
+        A subscription that fails is cancelled, and posts a last line "ERR,<id>,<message>\n".
+
+        CMDs:
+            ":DATA:LISTEN"                                              Continuous data stream until the socket is closed by the client.
+            ":DATA:FORM ASC | BIN[, 32 | 64]"                           Select the :DATA:LISTEN frame format.
+            ":DATA:FORM?"                                               Request the frame format.
+            ":DATA:NAMES?"                                              Request DATA field names.
+            ":DATA:READ? <start_time>[, <end_time>]"                    Request the data records in the time window.
+            ":DATA:SUB <condition>"                                     Subscribe to the events of a condition, e.g. "ABOVE H2, 0.5, 0.01". Returns the subscription id.
+            ":DATA:SUB?"                                                Request the active subscription ids, or "NONE".
+            ":DATA:UNSUB <id> | ALL"                                    Cancel a subscription, or all subscriptions.
+            ":DATA:EVENTS"                                              Continuous events stream until the socket is closed by the client.
     """
+
+    # ----------------- inner functions ---------------------
+
+    def post(sub_id, cond, t, state):
+        """Helper function called by the main thread with buf_lock held, to queue the event of a state change."""
+        name = cond.event(state)
+        if name is None: return
+        try:
+            events.put_nowait(f'EVT,{sub_id},{t - buf.toffs:.6f},{name},{cond.label},{cond.value:.6g}\n')
+        except queue.Full:
+            events.dropped += 1
+
+    def post_error(sub_id, error):
+        """Helper function called by the main thread with buf_lock held, to queue the error of a failed subscription."""
+        try:
+            events.put_nowait(f'ERR,{sub_id},{error}\n')
+        except queue.Full:
+            events.dropped += 1
+
+    # --------------------------------------------------------
+
     # Allocate a free data stream queue, and add it to the list of data stream queues.
     data_clients.append(client_socket)
+    form = "ASC"        # stream frame format for this connection
+    bits = 32           # float width of the binary frames
+    subs = {}           # event subscriptions of this connection, id: watch
+    sub_ids = itertools.count(1)
+    events = queue.Queue(arg.stream_depth)      # event lines posted by the subscriptions
+    events.dropped = 0
     if arg.verbose: msg_Q.put(f'Accepted data stream connection from {addr}.')
     # continue serving the connection until it is closed by the peer or the termination event is set.
     while not evt_terminate.is_set():
@@ -1447,20 +2820,57 @@ def data_handler(client_socket, addr, data_clients:list, data_queues:list, msg_Q
             if any(x == fields[0] for x in(":DATA:LISTEN",)): 
                 # ":DATA:LISTEN"
                 # continuous raw data stream until socket is closed by client
-                data_Q = mp.Queue()
-                data_queues.append(data_Q)
-                while True:
+                sub = data_bcast.subscribe()
+                dropped = 0
+                if form == "BIN":
+                    client_socket.sendall(DataRecord.header(bits))
+                while not evt_terminate.is_set():
                     try:
-                        while not data_Q.empty():
-                            # send the most recent datapoints to the DATA stream socket
-                            record = data_Q.get()
-                            client_socket.sendall(record.encode(encoding="ascii",errors="replace"))
+                        # block until records arrive, waking up periodically to check the connection
+                        frames = [r.frame(form, bits) for r in sub.get(timeout=0.5)]
+                        if sub.dropped != dropped:
+                            if not arg.silent: err_Q.put(f'data_handler: Client {addr} is lagging, {sub.dropped - dropped} records dropped.')
+                            dropped = sub.dropped
+                        # detect a closed connection: the socket is readable and recv() returns no data.
+                        # data sent by the client while listening is discarded.
+                        if select.select([client_socket], [], [], 0)[0]:
+                            if not client_socket.recv(2048):
+                                if arg.verbose: msg_Q.put(f'Client {addr} disconnected.')
+                                break
+                        # send the most recent datapoints to the DATA stream socket. The fixed width binary
+                        # records are sent in a single write, the undelimited text records one per write.
+                        if (form == "BIN") and frames:
+                            client_socket.sendall(b''.join(frames))
+                        else:
+                            for f in frames:
+                                client_socket.sendall(f)
+                    except Broadcast.Overrun as e:
+                        if not arg.silent: err_Q.put(f'data_handler: Client {addr} is lagging, {e}. Closing connection.')
+                        break
                     except Exception as e:
                         if not arg.silent: err_Q.put(f'data_handler: Error: {e}')
                         break
-                data_queues.remove(data_Q)
-                data_Q.close()
+                sub.close()
                 break
+            elif any(x == fields[0] for x in(":DATA:FORM",)):
+                # ":DATA:FORM ASC | BIN[, 32 | 64]"
+                # Select the frame format of the :DATA:LISTEN stream: ASCII text records, or fixed width 
+                # little-endian binary records with float32 or float64 values, preceded by a header line.
+                response = "ERR"
+                if (len(fields) > 1) and (fields[1] == "ASC"):
+                    form = "ASC"
+                    response = "OK"
+                elif (len(fields) > 1) and (fields[1] == "BIN"):
+                    if (len(fields) < 3) or (fields[2] in ("32", "64")):
+                        form = "BIN"
+                        bits = int(fields[2]) if len(fields) > 2 else 32
+                        response = "OK"
+                client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
+            elif any(x == fields[0] for x in(":DATA:FORM?",)):
+                # ":DATA:FORM?"
+                # Request the stream frame format, "ASC" or "BIN,<bits>".
+                response = f'BIN,{bits}' if form == "BIN" else "ASC"
+                client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
             elif any(x == fields[0] for x in(":DATA:NAMES?",)):
                 # ":DATA:NAMES?"
                 # Request DATA field names
@@ -1473,35 +2883,96 @@ def data_handler(client_socket, addr, data_clients:list, data_queues:list, msg_Q
                 # If only one time is given, respond with a single data record.
                 # If no time is given, respond with "ERR".
                 # If the requested time window is invalid, respond with "ERR".
+                # The window is snapshot as a range of buffer write sequences, and is copied, converted and
+                # sent in chunks of records, holding buf_lock only while each chunk is copied. If the window
+                # is overwritten before it is sent, the last record is "ERR: ..." instead of "OK".
                 response = "ERR"
                 try:
-                    p1 = len(bufidx)
-                    p0 = p1 - 1
-                    if len(fields) > 1:
-                        t0 = conv_float(fields[1])
-                        p0 = find_time_index(t0)
-                        t1 = None
-                        p1 = p0+1
-                    if len(fields) > 2:
-                        t1 = conv_float(fields[2])
-                        p1 = find_time_index(t1) + 1
-                    # collect all data lines in a local buffer
-                    databuf = []
+                    rowfmt = Sensor.record_fmt() + "\n"
                     with buf_lock:
-                        for idx, record in zip(bufidx[p0:p1], bufadc[p0:p1]):
-                            wavetime = idx[1]
-                            strings = tuple((s.format(record[i]) for i, s in enumerate(Sensor.sensors())))
-                            datarec = f'{wavetime:.6f}s,' + ','.join(strings) + "\n"
-                            databuf.append(datarec)
-                    # send the data records to the requester
-                    while len(databuf):
-                        response = databuf.pop(0)
+                        p1 = len(buf)
+                        p0 = p1 - 1
+                        if len(fields) > 1:
+                            t0 = conv_float(fields[1])
+                            p0 = find_time_index(t0)
+                            t1 = None
+                            p1 = p0+1
+                        if len(fields) > 2:
+                            t1 = conv_float(fields[2])
+                            p1 = find_time_index(t1) + 1
+                        q0, q1 = buf.seq(max(0, p0)), buf.seq(max(p0, min(p1, len(buf))))
+                        toffs = buf.toffs
+                    # copy, convert and send the window in chunks of records
+                    for q in range(q0, q1, arg.read_chunk):
+                        with buf_lock:
+                            rows = buf.rows_seq(q, min(q + arg.read_chunk, q1)).copy()
+                        times = rows[:, 0] - toffs
+                        values = Sensor.val_records(rows[:, 1:])
+                        response = ''.join([rowfmt.format(wavetime, *record) for wavetime, record in zip(times.tolist(), values.tolist())])
                         client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
                     response = "OK"
                 except Exception as e:
                     response = f'ERR: {e}'
                 finally:
                     client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
+            elif any(x == fields[0] for x in(":DATA:SUB",)):
+                # ":DATA:SUB <condition>"
+                # Subscribe to the events of the condition, and return the subscription id.
+                response = "ERR"
+                try:
+                    cond = Condition(fields[1:])
+                    sub_id = next(sub_ids)
+                    subs[sub_id] = monitor.add([cond], lambda t, state, values, sub_id=sub_id, cond=cond: post(sub_id, cond, t, state), once=False,
+                                               errback=lambda error, sub_id=sub_id: post_error(sub_id, error))
+                    response = f'{sub_id}'
+                except Exception as e:
+                    response = f'ERR: {e}'
+                finally:
+                    client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
+            elif any(x == fields[0] for x in(":DATA:SUB?",)):
+                # ":DATA:SUB?"
+                # Request the ids of the active subscriptions.
+                active = [x for x, watch in subs.items() if watch.error is None]
+                response = ','.join(f'{x}' for x in active) if active else "NONE"
+                client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
+            elif any(x == fields[0] for x in(":DATA:UNSUB",)):
+                # ":DATA:UNSUB <id> | ALL"
+                # Cancel a subscription, or all subscriptions of this connection.
+                response = "ERR"
+                if (len(fields) > 1) and (fields[1] == "ALL"):
+                    for watch in subs.values(): monitor.remove(watch)
+                    subs.clear()
+                    response = "OK"
+                elif (len(fields) > 1) and fields[1].isdigit() and (int(fields[1]) in subs):
+                    monitor.remove(subs.pop(int(fields[1])))
+                    response = "OK"
+                client_socket.sendall(response.encode(encoding="ascii",errors="replace"))
+            elif any(x == fields[0] for x in(":DATA:EVENTS",)):
+                # ":DATA:EVENTS"
+                # continuous events stream until socket is closed by client
+                dropped = 0
+                while not evt_terminate.is_set():
+                    try:
+                        # block until an event arrives, waking up periodically to check the connection
+                        try:
+                            lines = [events.get(timeout=0.5)]
+                            while not events.empty(): lines.append(events.get_nowait())
+                        except queue.Empty:
+                            lines = []
+                        if events.dropped != dropped:
+                            if not arg.silent: err_Q.put(f'data_handler: Client {addr} is lagging, {events.dropped - dropped} events dropped.')
+                            dropped = events.dropped
+                        # detect a closed connection: the socket is readable and recv() returns no data.
+                        if select.select([client_socket], [], [], 0)[0]:
+                            if not client_socket.recv(2048):
+                                if arg.verbose: msg_Q.put(f'Client {addr} disconnected.')
+                                break
+                        if lines:
+                            client_socket.sendall(''.join(lines).encode(encoding="ascii",errors="replace"))
+                    except Exception as e:
+                        if not arg.silent: err_Q.put(f'data_handler: Error: {e}')
+                        break
+                break
             else:
                 # command not recognized, send "ERR"
                 client_socket.sendall("ERR".encode(encoding="ascii",errors="replace"))
@@ -1512,13 +2983,14 @@ def data_handler(client_socket, addr, data_clients:list, data_queues:list, msg_Q
             if not arg.silent: err_Q.put(f'data_handler: Error handling client {addr}: {e}')
             raise e
             break
+    for watch in subs.values(): monitor.remove(watch)
     if client_socket: 
         client_socket.close()
         if client_socket in data_clients: data_clients.remove(client_socket)
         if arg.verbose: msg_Q.put(f'Connection with {addr} closed.')
     if arg.verbose: msg_Q.put(f'Data Handler {addr}: thread stopped.')
 
-def data_server_listener(server_socket, data_clients:list, data_queues:list, msg_Q:mp.Queue, err_Q:mp.Queue):
+def data_server_listener(server_socket, data_clients:list, data_bcast:Broadcast, msg_Q:mp.Queue, err_Q:mp.Queue):
     """
         This thread runs forever the data server socket listener, and starts 
         a new handler thread for each accepted connection.
@@ -1531,7 +3003,7 @@ def data_server_listener(server_socket, data_clients:list, data_queues:list, msg
             # blocks until an incoming connection is received
             client_socket, addr = server_socket.accept()
             # runs each client handler in a separate thread
-            data_handler_thread = threading.Thread(target=data_handler, args=(client_socket, addr, data_clients, data_queues, msg_Q, err_Q))
+            data_handler_thread = threading.Thread(target=data_handler, args=(client_socket, addr, data_clients, data_bcast, msg_Q, err_Q))
             data_handler_thread.daemon = True
             data_handler_thread.start()
         except OSError as e:
@@ -1551,16 +3023,126 @@ def start_data_server(host, port, msg_Q:mp.Queue, err_Q:mp.Queue, arg:Namespace)
         connections.
     """
     data_clients = []
-    data_queues = []
+    data_bcast = Broadcast(arg.stream_depth, arg.lag_policy)
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind((host, port))
     server_socket.listen(arg.max_handlers)
     if arg.verbose: msg_Q.put(f"Data Server listening on {server_socket.getsockname()}")
-    data_server_thread = threading.Thread(target=data_server_listener, args=(server_socket, data_clients, data_queues, msg_Q, err_Q))
+    data_server_thread = threading.Thread(target=data_server_listener, args=(server_socket, data_clients, data_bcast, msg_Q, err_Q))
     data_server_thread.daemon = True
     data_server_thread.start()
-    return server_socket, data_clients, data_queues
+    return server_socket, data_clients, data_bcast
+
+#===============================================================================================#
+#               SVC SOCKET SERVER                                                               #
+#===============================================================================================#
+
+def svc_metrics(svc:Namespace) -> str:
+    """
+        Return the server metrics in the Prometheus text exposition format.
+        All values are read from the server process state, without any request to the DAQ process.
+        The svc Namespace holds the objects of the main program: daq, ring, proc, cmd_clients, 
+        data_clients and data_bcast.
+    """
+    lines = []
+    def metric(name, kind, help, samples):
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            lines.append(f'{name}{labels} {value}')
+    # --- acquisition ---
+    with buf_lock:
+        count = len(buf)
+        fill = (buf.tmax - buf.tmin) if count else 0.0
+        if count > 1:
+            # record rate over the last 10s of the buffer
+            p0 = buf.index(buf.tmax - 10.0)
+            span = buf.tmax - buf.time(p0)
+            rate = (count - 1 - p0) / span if span > 0.0 else 0.0
+        else:
+            rate = 0.0
+    metric('daq_records_total', 'counter', 'Records written by the DAQ process.', [('', svc.ring.seq)])
+    metric('daq_records_lost_total', 'counter', 'Records overwritten in the shared memory ring before read.', [('', svc.ring.lost)])
+    metric('daq_records_per_second', 'gauge', 'Record rate over the last 10 seconds.', [('', f'{rate:.3f}')])
+    metric('daq_conversion_nan_total', 'counter', 'Sensor readings that failed conversion to float.', [('', svc.ring.nans)])
+    metric('daq_buffer_fill_seconds', 'gauge', 'Time span of the records in the data buffer.', [('', f'{fill:.3f}')])
+    metric('daq_buffer_records', 'gauge', 'Records in the data buffer.', [('', count)])
+    metric('daq_buffer_capacity_records', 'gauge', 'Data buffer capacity.', [('', buf.capacity)])
+    metric('daq_ring_backlog_records', 'gauge', 'Records in the shared memory ring not yet read.', [('', svc.ring.backlog)])
+    # --- DAQ process liveness ---
+    metric('daq_process_up', 'gauge', 'DAQ process is alive.', [('', int(svc.proc.is_alive()))])
+    age = (time.time() - svc.ring.heartbeat) if svc.ring.seq else -1.0
+    metric('daq_last_record_age_seconds', 'gauge', 'Time since the last record written by the DAQ process, -1 if none.', [('', f'{age:.3f}')])
+    # --- clients ---
+    metric('daq_cmd_clients', 'gauge', 'Active CMD connections.', [('', len(svc.cmd_clients))])
+    metric('daq_data_clients', 'gauge', 'Active DATA connections.', [('', len(svc.data_clients))])
+    metric('daq_data_subscribers', 'gauge', 'Active DATA stream listeners.', [('', svc.data_bcast.subscribers)])
+    metric('daq_cmd_pending', 'gauge', 'DAQ command requests waiting for the response.', [('', svc.daq.pending)])
+    # --- command latencies ---
+    samples = []
+    for mnemonic, values in sorted(svc.daq.latencies().items()):
+        name = mnemonic.replace('\\', '\\\\').replace('"', '\\"')
+        for q, v in zip((0.5, 0.9, 0.99), np.percentile(values, (50, 90, 99))):
+            samples.append((f'{{cmd="{name}",quantile="{q}"}}', f'{v:.6f}'))
+        samples.append((f'_sum{{cmd="{name}"}}', f'{sum(values):.6f}'))
+        samples.append((f'_count{{cmd="{name}"}}', len(values)))
+    metric('daq_cmd_latency_seconds', 'summary', 'DAQ command request latency, over the recent requests of each command.', samples)
+    return '\n'.join(lines) + '\n'
+
+def svc_server_listener(server_socket, svc:Namespace, msg_Q:mp.Queue, err_Q:mp.Queue):
+    """
+        This thread runs forever the svc server socket listener, and serves the metrics 
+        endpoint as a minimal HTTP/1.0 server: each connection receives one GET request, 
+        is answered with the svc_metrics() text, and is closed.
+        The requests are served in the listener thread, one at a time.
+        The main thread sets the evt_terminate event and closes the 
+        svc socket server to terminate the listener thread.
+    """
+    while not evt_terminate.is_set():
+        try:
+            # blocks until an incoming connection is received
+            client_socket, addr = server_socket.accept()
+        except OSError as e:
+            if not evt_terminate.is_set() and not arg.silent: err_Q.put(f"Svc Server Listener OSError: {e}")
+            break
+        try:
+            client_socket.settimeout(2.0)
+            request = b''
+            while b'\r\n\r\n' not in request and len(request) < 8192:
+                data = client_socket.recv(4096)
+                if not data: break
+                request += data
+            fields = request.decode(encoding="ascii", errors="replace").split()
+            if (len(fields) > 1) and (fields[0] == "GET") and (fields[1] in ("/", "/metrics")):
+                body = svc_metrics(svc).encode(encoding="utf-8", errors="replace")
+                header = "HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            else:
+                body = b'Not Found\n'
+                header = "HTTP/1.0 404 Not Found\r\nContent-Type: text/plain\r\n"
+            header += f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+            client_socket.sendall(header.encode(encoding="ascii") + body)
+        except Exception as e:
+            if not arg.silent: err_Q.put(f"Svc Server: Error handling client {addr}: {e}")
+        finally:
+            client_socket.close()
+    if server_socket: server_socket.close()
+    if arg.verbose: msg_Q.put("Svc Server thread stopped.")
+
+def start_svc_server(host, port, svc:Namespace, msg_Q:mp.Queue, err_Q:mp.Queue, arg:Namespace):
+    """
+        This function opens a socket listener and creates the svc server listener thread. 
+        Returns the server socket.
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind((host, port))
+    server_socket.listen(arg.max_handlers)
+    if arg.verbose: msg_Q.put(f"Svc Server listening on {server_socket.getsockname()}")
+    svc_server_thread = threading.Thread(target=svc_server_listener, args=(server_socket, svc, msg_Q, err_Q))
+    svc_server_thread.daemon = True
+    svc_server_thread.start()
+    return server_socket
 
 #===============================================================================================#
 #               MAIN                                                                            #
@@ -1584,22 +3166,23 @@ def main():
     sensors = create_sensors()
 
     # --- declare global and prealocate the data buffer objects -----------------------------------
-    global recno, bufidx, bufadc
+    global recno, buf, stats, monitor
     recno = 0
-    bufidx = []
-    bufadc = []
+    bufrate = min(arg.bufrate, 60.0 / arg.nplc)             # records/s upper bound: at least one conversion per record
+    buf = RingBuffer(int(arg.bufsize * bufrate) + 1, len(sensors), arg.bufsize)
+    stats = RollingStats(len(sensors), arg.windows)
+    monitor = ConditionMonitor()
     
     # --- create the queues for the DAQ process  --------------------------------------------------
     mp.set_start_method('spawn')
     ctr_Q = mp.Queue()      # DAQ process control messages
     cmd_Q = mp.Queue()      # DAQ commands from remote sockets
-    data_Q = mp.Queue()     # continuous sampling DAQ responses
+    ring = SampleRing.create(arg.shm_depth, len(sensors))  # continuous sampling DAQ records
     msg_Q = mp.Queue()      # async stream for print messages
     err_Q = mp.Queue()      # async stream for error messages
-    pool_Q = [mp.Queue() for x in range(arg.max_handlers)]  # preallocated response Queue pool
-    free_Qn = [x for x in range(arg.max_handlers)]          # pool free index list
+    resp_Q = mp.Queue()     # DAQ (req_id, response) stream for the remote commands
     # --- spawn DAQ process -----------------------------------------------------------------------
-    p1 = mp.Process(target = DAQ_process, args = [ctr_Q, cmd_Q, data_Q, msg_Q, err_Q, pool_Q, arg, sensors])
+    p1 = mp.Process(target = DAQ_process, args = [ctr_Q, cmd_Q, ring.name, msg_Q, err_Q, resp_Q, arg, sensors])
     p1.daemon = True        # force process termination if parent dies
     p1.start()              # spawn data acquisition CPU process
     time.sleep(1.0)
@@ -1611,6 +3194,7 @@ def main():
         if any(x in err_msg for x in("ABORT","EXIT")):
             p1.join(0.1)
             p1.terminate()
+            ring.close()
             if not arg.silent: print(f'Exiting ...', flush=True)
             sys.exit(1)
     if arg.verbose: 
@@ -1618,28 +3202,37 @@ def main():
         print(f'Buffer size: {arg.bufsize}s.', flush=True)
         
     # --- start socket servers ----------------------------------------------------------------
-    daq_cmd_server, daq_cmd_clients = start_cmd_server(arg.host_addr, arg.cmd_port, cmd_Q, msg_Q, err_Q, pool_Q, free_Qn, arg)
-    daq_data_server, data_clients, data_queues = start_data_server(arg.host_addr, arg.data_port, msg_Q, err_Q, arg)
+    daq = DAQLink(cmd_Q, resp_Q)
+    daq_cmd_server, daq_cmd_clients = start_cmd_server(arg.host_addr, arg.cmd_port, daq, msg_Q, err_Q, arg)
+    daq_data_server, data_clients, data_bcast = start_data_server(arg.host_addr, arg.data_port, msg_Q, err_Q, arg)
+    svc = Namespace(daq=daq, ring=ring, proc=p1, cmd_clients=daq_cmd_clients, data_clients=data_clients, data_bcast=data_bcast)
+    daq_svc_server = start_svc_server(arg.host_addr, arg.svc_port, svc, msg_Q, err_Q, arg)
     
     # --- toplevel thread loop ----------------------------------------------------------------
     # monitors the connections and print threads messages
-    wavetime = 0.0
+    lost = 0
+    DataRecord.configure()
     while not evt_terminate.is_set():
         try:
-            # --- handle data_Q: capture the data in buffers ---
-            while not data_Q.empty():
+            # --- handle the records ring: capture the data in buffers ---
+            records = []
+            rows = ring.read()
+            if ring.lost != lost:
+                if not arg.silent: print(f'DAQ records ring overrun: {ring.lost - lost} records lost.', flush=True)
+                lost = ring.lost
+            if len(rows):
                 try:
                     with buf_lock:
-                        (recno, wavetime, *record) = data_Q.get()
-                        bufidx.append([recno,wavetime])
-                        bufadc.append(record)
-                        if (bufidx[-1][1] - bufidx[0][1]) > arg.bufsize:
-                            bufidx.pop(0)
-                            bufadc.pop(0)
-                    strings = tuple((s.format(record[i]) for i, s in enumerate(sensors)))
-                    outrec = f'{wavetime:.6f}s,' + ','.join(strings)
-                    for q in data_queues:
-                        q.put(outrec)
+                        records = capture_rows(rows)
+                except Exception as e:
+                    print(f'Exception: {e}')
+            elif msg_Q.empty() and err_Q.empty():
+                time.sleep(0.002)       # idle: no new records in the ring
+            # --- convert the captured block of records and distribute to the DATA streams ---
+            if records and data_bcast.subscribers:
+                try:
+                    values = Sensor.val_records([r for _, _, r in records])
+                    data_bcast.publish([DataRecord(recno, wavetime, record) for (recno, wavetime, _), record in zip(records, values.tolist())])
                 except Exception as e:
                     print(f'Exception: {e}')
             # --- handle msg_Q: print messages ---
@@ -1669,8 +3262,7 @@ def main():
     # signal the process to exit acquisition loop
     if not arg.quiet: print("waiting DAQ process exit...", flush=True)
     ctr_Q.put("DAQ_ABORT")
-    time.sleep(1.0)
-    p1.join(0.1)
+    p1.join(5.0)            # the DAQ process resets the instrument and saves the latency profile
     p1.terminate()
     # terminate all threads event loops
     if arg.verbose: 
@@ -1685,16 +3277,11 @@ def main():
     # close all outstanding socket connections
     if len(daq_cmd_clients):
         if arg.verbose: print(f'Closing remaining {len(daq_cmd_clients)} opened CMD conections:')
-        for s in daq_cmd_clients:
-            try:
-                if arg.verbose: print(f'    {s.getpeername()}')
-            except Exception as e:
-                if not arg.silent: print(f'Exception {e} while accessing CMD client socket data.')
-        for s in daq_cmd_clients:
-            try:
-                s.close()
-            except Exception as e:
-                if not arg.silent: print(f'Exception {e} while closing CMD socket.')
+        for w in tuple(daq_cmd_clients):
+            if arg.verbose: print(f'    {w.get_extra_info("peername")}')
+    # the cmd server event loop closes its connections on evt_terminate
+    daq_cmd_server.join(1.0)
+    daq.close()
     if len(data_clients):
         if arg.verbose: print(f'Closing remaining {len(data_clients)} opened DATA conections:')
         for s in data_clients:
@@ -1707,16 +3294,13 @@ def main():
                 s.close()
             except Exception as e:
                 if not arg.silent: print(f'Exception {e} while closing DATA socket.')
-    if len(data_queues):
-        if arg.verbose: print(f'Closing remaining {len(data_queues)} opened DATA queues...')
-        for q in data_queues:
-            try:
-                q.close()
-            except Exception as e:
-                if not arg.silent: print(f'Exception {e} while closing DATA queue.')
+    if data_bcast.subscribers:
+        if arg.verbose: print(f'Closing remaining {data_bcast.subscribers} DATA stream subscribers...')
+    data_bcast.close()
     # close server sockets
-    daq_cmd_server.close()
     daq_data_server.close()
+    daq_svc_server.close()
+    ring.close()
 
     # --- epilog ------------------------------------------------------------------------------
     time.sleep(0.1)
@@ -49,6 +49,7 @@ from argparse import Namespace
 import multiprocessing as mp
 from collections import namedtuple
 import math
+import bisect
 import numpy as np
 import time
 import re
@@ -58,6 +59,7 @@ import sys
 import getopt
 from instrument import Instrument
 import socket
+import select
 import threading
 from serial_ctrl import SerialCtrl
 # import hid
@@ -971,6 +973,7 @@ def create_sensors() -> tuple[Sensor]:
 evt_terminate = threading.Event()           # All event loops terminate when set to True
 cmd_lock = threading.Lock()                 # locks other command handlers
 buf_lock = threading.Lock()                 # locks buffer access
+cmd_conn = None                             # shared CMD port connection
 
 def sock_connect(host, port) -> socket.socket:
     """Create a TCP stream connection, and returns the handler."""
@@ -978,24 +981,153 @@ def sock_connect(host, port) -> socket.socket:
     server.connect((host, port))
     return server
 
-def send(server, msg, wait=1.0):
+class CmdConnection:
+    """
+        Persistent connection to the DAQ CMD port, shared by all the command helpers.
+
+        ### Parameters
+        ```
+            - host, port: DAQ server CMD port address.
+            - timeout: socket timeout in seconds for a command response.
+        ```
+        The connection is opened on the first request, and kept open. Before each request a health check 
+        detects a connection closed by the server, and discards any stale response left by a timed out 
+        request. If the connection is broken when the request is sent, it is reopened and the request is sent 
+        again once. A request that was sent is never sent again: a response timeout or a connection lost 
+        while waiting for the response raises the OSError to the caller.
+
+        The connection uses the framed CMD protocol: each request is sent as a line "<id> <command>\n", 
+        and the response is the line "<id> <response>\n" with the same request id, so a response is 
+        complete when its line is received, and responses to other requests are discarded.
+
+        ## Methods
+        ```
+            - ask(msg): send a command and return the response.
+            - close(): close the connection.
+        ```
+    """
+    def __init__(self, host: str, port: int, timeout: float = 30.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+        self.reconnects = 0
+        self.req_id = 0             # id of the last framed request
+        self.rxbuf = b''            # received bytes not yet parsed into response lines
+
+    def connect(self) -> None:
+        """Open the connection to the CMD port."""
+        self.close()
+        self.sock = sock_connect(self.host, self.port)
+        self.sock.settimeout(self.timeout)
+        self.reconnects += 1
+        self.rxbuf = b''
+        # select the framed protocol: this request and its response are not framed
+        self.sock.sendall(b':CMD:FRAME ON')
+        response = self.sock.recv(1024)
+        if response != b'OK': raise ConnectionError(f'framed protocol not supported: {response}')
+
+    def close(self) -> None:
+        """Close the connection."""
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def healthy(self) -> bool:
+        """Return False if the connection is not open or was closed by the server. Discard stale responses."""
+        if self.sock is None: return False
+        try:
+            while select.select([self.sock], [], [], 0)[0]:
+                if not self.sock.recv(4096):
+                    return False        # connection closed by the server
+            self.rxbuf = b''
+            return True
+        except OSError:
+            return False
+
+    def readline(self) -> bytes:
+        """Return the next response line received, without the line terminator."""
+        while (i := self.rxbuf.find(b'\n')) < 0:
+            data = self.sock.recv(4096)
+            if not data: raise ConnectionResetError("connection closed by the server")
+            self.rxbuf += data
+        line, self.rxbuf = self.rxbuf[:i], self.rxbuf[i+1:]
+        return line
+
+    def ask(self, msg: str) -> str:
+        """Send a command and return the response, reconnecting and sending again once if the connection is broken before the request is sent."""
+        with self.lock:
+            for retry in (False, True):
+                try:
+                    if not self.healthy(): self.connect()
+                    self.req_id += 1
+                    req = f'{self.req_id}'.encode()
+                    self.sock.sendall(req + b' ' + msg.encode() + b'\n')
+                    break
+                except OSError:
+                    self.close()
+                    if retry: raise
+            # the request was sent: wait for its response, and never send it again
+            try:
+                while True:
+                    line = self.readline()
+                    id, _, response = line.partition(b' ')
+                    if id == req:
+                        return response.decode()
+            except TimeoutError:
+                raise           # keep the connection: the late response is discarded by its request id
+            except OSError:
+                self.close()
+                raise
+
+def cmd_connection() -> CmdConnection:
+    """Return the shared CMD port connection, created on the first call."""
+    global cmd_conn
+    if cmd_conn is None:
+        cmd_conn = CmdConnection(arg.host_addr, arg.cmd_port)
+    return cmd_conn
+
+def send(server, msg):
     """Sends a message to the connection server, and returns the response."""
     try: 
-        time.sleep(wait)
-        server.send(msg.encode())
-        response = server.recv(1024).decode()
-        return response
-    except BrokenPipeError as e:
+        return server.ask(msg)
+    except OSError as e:
         return str(e)
 
+def send_values(server, msg, count):
+    """Sends a multi-item query, and returns the list of (count) values of the comma separated response, all NaN if failed."""
+    values = [conv_float(x) for x in send(server, msg).split(',')]
+    return values if len(values) == count else [float('nan')] * count
+
+def wait_until(server, timeout, *conditions):
+    """
+        Waits in the server until all the (conditions) are true, up to (timeout) seconds, and returns (ok, time, values) 
+        with the condition values. The conditions are the :CMD:WAIT? conditions, e.g. "LEVEL CH4_TEMP, 45.0, 1.0".
+        If the server does not answer OK or TIMEOUT (error, lost connection), the rest of the (timeout) is slept 
+        here, so a polling loop does not spin on a failing server.
+    """
+    t0 = time.monotonic()
+    response = send(server, f':CMD:WAIT? {timeout}; ' + '; '.join(conditions)).split(',')
+    if response[0] not in ("OK", "TIMEOUT"):
+        time.sleep(max(0.0, timeout - (time.monotonic() - t0)))
+    try:
+        return response[0] == "OK", float(response[1]), [conv_float(x) for x in response[2:]]
+    except (IndexError, ValueError):
+        return False, float('nan'), [float('nan')] * len(conditions)
+
 def boot_pids():
     """Enables the heatpump and hotplate PID and related cooling fan, and turns ON the purging air pump."""
-    with sock_connect(arg.host_addr, arg.cmd_port) as cmd:
-        send(cmd, ":dout0.0:write 1")       # purge air pump
-        send(cmd, ":dout0.1:write 1")       # cooling fan 1
-        send(cmd, ":DOUT0.2:WRITE 1")       # cooling fan 2
-        send(cmd, ":pwm3:outp:ena")         # heat pump PID
-        send(cmd, ":pwm4:outp:ena")         # hotplate PID
+    # the commands are sent in one SCPI line, executed by the DAQ in a single sampling pause
+    scpi = (":dout0.0:write 1",             # purge air pump
+            ":dout0.1:write 1",             # cooling fan 1
+            ":DOUT0.2:WRITE 1",             # cooling fan 2
+            ":pwm3:outp:ena",               # heat pump PID
+            ":pwm4:outp:ena")               # hotplate PID
+    send(cmd_connection(), ';'.join(scpi))
 
 def set_valve(name, state):
     """Control the valves solenoids."""
@@ -1003,24 +1135,24 @@ def set_valve(name, state):
         if any(x == state.upper() for x in("ON", "OFF")):
             val = 1 if state.upper() == "ON" else 0
             print(f'set_valve, {name}, {state}, {val=}')
-            with sock_connect(arg.host_addr, arg.cmd_port) as cmd:
-                match name.upper():
-                    case 'SYRINGE':
-                        send(cmd, f':dout0.7:write {val}')       # SYRINGE valve    0x80
-                    case 'SENSORS':
-                        send(cmd, f':dout0.6:write {val}')       # SENSORS valve    0x40
-                    case 'INTAKE':
-                        send(cmd, f':dout0.5:write {val}')       # INTAKE valve     0x20
-                    case 'PURGE':
-                        send(cmd, f':dout0.4:write {val}')       # PURGE valve      0x10
-                    case 'STILL':
-                        send(cmd, f':dout0.3:write {val}')       # STILL valve      0x08
-                    case 'COOLING2':
-                        send(cmd, f':dout0.2:write {val}')       # COOLING fan 2    0x04
-                    case 'COOLING1':
-                        send(cmd, f':dout0.1:write {val}')       # COOLING fan 1    0x02
-                    case 'PUMP':
-                        send(cmd, f':dout0.0:write {val}')       # PUMP fan         0x01
+            cmd = cmd_connection()
+            match name.upper():
+                case 'SYRINGE':
+                    send(cmd, f':dout0.7:write {val}')       # SYRINGE valve    0x80
+                case 'SENSORS':
+                    send(cmd, f':dout0.6:write {val}')       # SENSORS valve    0x40
+                case 'INTAKE':
+                    send(cmd, f':dout0.5:write {val}')       # INTAKE valve     0x20
+                case 'PURGE':
+                    send(cmd, f':dout0.4:write {val}')       # PURGE valve      0x10
+                case 'STILL':
+                    send(cmd, f':dout0.3:write {val}')       # STILL valve      0x08
+                case 'COOLING2':
+                    send(cmd, f':dout0.2:write {val}')       # COOLING fan 2    0x04
+                case 'COOLING1':
+                    send(cmd, f':dout0.1:write {val}')       # COOLING fan 1    0x02
+                case 'PUMP':
+                    send(cmd, f':dout0.0:write {val}')       # PUMP fan         0x01
     except:
         pass
 
@@ -1028,8 +1160,7 @@ def set_valves(value: int) -> None:
     """Control the valves solenoids, with a single write for all valves simultaneously."""
     try:
         print(f'set_valves, 0x{value:02X}')
-        with sock_connect(arg.host_addr, arg.cmd_port) as cmd:
-            send(cmd, f':dout0:write {value}')  # write all bits in a single operation
+        send(cmd_connection(), f':dout0:write {value}')    # write all bits in a single operation
     except:
         pass
 
@@ -1041,41 +1172,13 @@ def conv_float(x):
         return float('nan')
     
 def find_time_index(t:float):
-    """scans the time index and returns the next valid subscript greater than or equal to (t) if the time is found, or the extreme indexes if not. """
-    try:
-        while len(bufidx[0]) < 2:
-            bufidx.pop(0)
-        while len(bufidx[-1]) < 2:
-            bufidx.pop(-1)
-        if (t >= bufidx[0][1]) and (t <= bufidx[-1][1]):
-            for p in range(len(bufidx)):
-                if len(bufidx[p]) > 1:
-                    if t <= bufidx[p][1]:
-                        return p
-                else:
-                    bufidx.pop(p)
-            else:
-                return len(bufidx)-1
-        elif t < bufidx[0][1]:
-            return 0
-        else:
-            return len(bufidx)-1
-    except IndexError:
+    """searches the time index and returns the next valid subscript greater than or equal to (t) if the time is found, or the extreme indexes if not. """
+    if len(bufidx) == 0:
         return 0
-
-def h2_baseline_drift(cmd, drift: float):
-    stable = False
-    h2_drift_val = conv_float(send(cmd, ":CMD:BASE:DRIFT? h2, 60.0")) * 1e3
-    if(abs(h2_drift_val) <= drift):
-        stable = True
-    return h2_drift_val, stable
-
-def tgs_baseline_drift(cmd, drift: float):
-    stable = False
-    tgs_drift_val = conv_float(send(cmd, ":CMD:BASE:DRIFT? ch4, 60.0")) * 1e3
-    if(abs(tgs_drift_val) <= drift):
-        stable = True
-    return tgs_drift_val, stable
+    if not (t <= bufidx[-1][1]):
+        return len(bufidx)-1
+    # the wavetime is monotonic: binary search for the first record with time >= t
+    return bisect.bisect_left(bufidx, t, key=lambda x: x[1])
 
 def compute_calib_curves(cal:dict):
     global z_cell_adc2h2, z_tgs_h2_2adc, z_tgs_adc2ch4
@@ -1159,7 +1262,7 @@ def main():
     bufadc = []
     
     # --- instantiate the command and syringe control objects -------------------------------------
-    cmd = sock_connect(arg.host_addr, arg.cmd_port)
+    cmd = cmd_connection()
     hid = Hid(arg.vendor_id, arg.product_id)
 
     # --- calibration data ------------------------------------------------------------------------
@@ -1202,32 +1305,34 @@ def main():
                         moving = False
                         send(cmd, ":PWM1:MOVE MIN,MAX")
                         send(cmd, ":SYST:BEEP")
-                    ch4_temp = conv_float(send(cmd, ":CMD:READ? CH4_TEMP"))
-                    coldside_temp = conv_float(send(cmd, ":CMD:READ? COLDSIDE_TEMP"))
-                    hotplate_temp = conv_float(send(cmd, ":CMD:READ? HOTPLATE_TEMP"))
+                    # the server evaluates the setpoint conditions on each record, and answers when all are met or after 5s
+                    stable, _, (ch4_temp, coldside_temp, hotplate_temp) = wait_until(cmd, 5.0,
+                                                                f'LEVEL CH4_TEMP, {ch4_temp_setp}, 1.0',
+                                                                f'LEVEL COLDSIDE_TEMP, {coldside_temp_setp}, 0.50',
+                                                                f'LEVEL HOTPLATE_TEMP, {hotplate_temp_setp}, 3.00')
                     print(f'Current temperatures:  CH4={ch4_temp:.2f}C, coldside={coldside_temp:.2f}, hotplate={hotplate_temp}            \r', end='', flush=True)
-                    if  (abs(ch4_temp_setp - ch4_temp) < 1.0) and               \
-                        (abs(coldside_temp_setp - coldside_temp) < 0.50) and    \
-                        (abs(hotplate_temp_setp - hotplate_temp) < 3.00):
+                    if stable:
                         print()
                         print("Temperatures stabilized!")
                         send(cmd, ":SYST:BEEP 1.0")
                         state = 'WAIT_BASELINES'
                         print(f'{state.upper()}')
                 case 'CALIB_B0_WAIT_LEVEL':
-                    time.sleep(1.0)
-                    tgs_level = conv_float(send(cmd, ":CMD:READ? ch4"))
-                    now = conv_float(send(cmd, ":CMD:TIME:MAX?"))
+                    # wait in the server for the CH4 level to return above the previous baseline, less the drift criteria
+                    recovered, now, _ = wait_until(cmd, 5.0, f'ABOVE ch4, {tgs_base - arg.ch4_base_drift}')
                     if now > t105_time_recover:
-                        if (abs(tgs_level - tgs_base) < arg.ch4_base_drift) or (tgs_level > tgs_base):
+                        if recovered:
                             # CH4 Baseline returned to previous level, now wait for near zero derivative
                             t105_time_recover = now if t105_time_recover == 0.0 else t105_time_recover
                             state = 'CALIB_B0_WAIT_DRIFT'
                             print(f'{state.upper()}')
+                    elif recovered:
+                        # the level is met on the next record until the recovery time: do not poll on each record
+                        time.sleep(min(t105_time_recover - now, 5.0))
                 case 'CALIB_B0_WAIT_DRIFT':
                     """Calibration of the still air baseline (1st)"""
-                    time.sleep(1.0)
-                    tgs_drift_val, tgs_stable = tgs_baseline_drift(cmd, arg.ch4_base_drift)
+                    tgs_stable, _, (tgs_drift_val,) = wait_until(cmd, 5.0, f'DRIFT ch4, {arg.ch4_base_drift / 1e3}, 60.0')
+                    tgs_drift_val *= 1e3
                     print(f'Ch4 baseline drift: {tgs_drift_val:.2f} mV/min            \r', end='', flush=True)
                     if tgs_stable:
                         # CH4 Baseline is stable: capture data and start still air.
@@ -1253,12 +1358,17 @@ def main():
                         state = 'WAIT_BASELINES'
                         print(f'{state.upper()}')
                 case 'WAIT_BASELINES':
-                    tgs_baseline = conv_float(send(cmd, ":CMD:READ? ch4, max, 2.0"))
-                    tgs_drift_val, tgs_stable = tgs_baseline_drift(cmd, arg.ch4_base_drift)
-                    h2_baseline = conv_float(send(cmd, ":CMD:READ? h2, max, 2.0"))
-                    h2_drift_val, h2_stable = h2_baseline_drift(cmd, arg.h2_base_drift)
+                    # the server evaluates the drifts on each second of samples, and answers when both are stable or after 5s
+                    _, _, drifts = wait_until(cmd, 5.0, f'DRIFT ch4, {arg.ch4_base_drift / 1e3}, 60.0', f'DRIFT h2, {arg.h2_base_drift / 1e3}, 60.0')
+                    tgs_drift_val, h2_drift_val = (x * 1e3 for x in drifts)
+                    tgs_stable = abs(tgs_drift_val) <= arg.ch4_base_drift
+                    h2_stable = abs(h2_drift_val) <= arg.h2_base_drift
+                    tgs_baseline, h2_baseline = send_values(cmd, ":CMD:READ? ch4, max, 2.0; h2, max, 2.0", 2)
                     print(f'Ch4 baseline: {tgs_baseline:.6f} mV  drift: {tgs_drift_val:.2f} mV/min ({'STABLE' if tgs_stable else 'DRIFTING'})   H2 baseline: {h2_baseline:.6f} mV/min  drift: {h2_drift_val:.2f} mV/min ({'STABLE' if h2_stable else 'DRIFTING'})                  \r', end='', flush=True)
-                    if ((time.time() - tstart) >= 240.0) and (tgs_stable) and (h2_stable):
+                    if tgs_stable and h2_stable and ((remaining := 240.0 - (time.time() - tstart)) > 0.0):
+                        # the drifts are met on the next record until the warm-up ends: do not poll on each record
+                        time.sleep(min(remaining, 5.0))
+                    elif tgs_stable and h2_stable:
                         print()
                         if arg.boot:
                             arg.boot = False
@@ -1278,11 +1388,8 @@ def main():
                     # -----------------------------------------------------------------------------
                     # init the sample pushing
                     # get baselines and drifts
-                    tgs_baseline = conv_float(send(cmd, ":CMD:READ? ch4, max, 1.0"))
-                    h2_baseline = conv_float(send(cmd, ":CMD:READ? h2, max, 1.0"))
-                    o2_baseline = conv_float(send(cmd, ":CMD:READ? o2, max, 1.0"))
-                    tgs_drift_val = conv_float(send(cmd, ":CMD:BASE:DRIFT? ch4, 60.0")) * 1e3
-                    h2_drift_val = conv_float(send(cmd, ":CMD:BASE:DRIFT? h2, 60.0")) * 1e3
+                    tgs_baseline, h2_baseline, o2_baseline = send_values(cmd, ":CMD:READ? ch4, max, 1.0; h2, max, 1.0; o2, max, 1.0", 3)
+                    tgs_drift_val, h2_drift_val = (x * 1e3 for x in send_values(cmd, ":CMD:BASE:DRIFT? ch4, 60.0; h2, 60.0", 2))
                     print(f'Ch4 baseline: {tgs_baseline:.6f} mV  drift: {tgs_drift_val:.2f} mV/min \nH2 baseline: {h2_baseline:.6f} mV/min  drift: {h2_drift_val:.2f} mV/min', flush=True)
                     print(f'Sensors: {send(cmd, ":CMD:READ? ALL")}')
                     hid.connect()
@@ -1306,10 +1413,8 @@ def main():
                     """Wait sensors until T107"""
                     try:
                         if (time.time() - tstart) >= 107.0:
-                            rel_hum = conv_float(send(cmd, ":CMD:READ? AHT10_RHUM"))
-                            o2_t105_meas = conv_float(send(cmd, ":CMD:READ? o2, 105.0, 1.0"))
+                            rel_hum, o2_t105_meas, tgs_t105_meas = send_values(cmd, ":CMD:READ? AHT10_RHUM; o2, 105.0, 1.0; ch4, 105.0, 1.0", 3)
                             o2_t105_val = (o2_t105_meas - o2_baseline)
-                            tgs_t105_meas = conv_float(send(cmd, ":CMD:READ? ch4, 105.0, 1.0"))
                             tgs_t105_val = (tgs_t105_meas - tgs_baseline) + calib["tgs_comp"]
                             _, h2_peak_str = send(cmd, ":CMD:PEAK? h2, -60, 1200.0").split(',')
                             h2_peak_val = (conv_float(h2_peak_str) - h2_baseline)
@@ -1430,6 +1535,7 @@ def main():
             print(f'Exception: {e}')
 
     # --- epilog ------------------------------------------------------------------------------
+    cmd.close()
     time.sleep(0.1)
     if threading.active_count() > 1:
         if arg.verbose: print(f'Terminating remaining {threading.active_count() - 1} active threads:')
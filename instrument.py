@@ -1,4 +1,6 @@
 import sys
+import os
+import json
 import time
 from typing import NoReturn, Self, Any
 import usbtmc
@@ -19,7 +21,9 @@ class Instrument(object):
             - wait : time interval to sleep after write/read ops.
             - timeout : timeout time for device response.
             - eol: line ending for serial frames, default to CRLF.
-            - start_delay: a delay in seconds to wait before initial '*IDN' handshake command.
+            - start_delay: maximum time in seconds for the instrument to answer the initial '*IDN' handshake command.
+            - adaptive: response driven completion, instead of the fixed (wait) sleeps.
+            - portname: serial port device name, to skip the ports search.
             
         ### Returns:
             Returns an instance of the device interface, or None if device not found. 
@@ -41,11 +45,28 @@ class Instrument(object):
         Implements a uniform transparent interface for serial SCPI instruments, via USBTMC or via USBCDC,
         encapsulating the USBTMC and PySerial classes, and offering a uniform calling interface for instruments, 
         regardless of their serial interface connection. \n
+        In adaptive mode, write() and ask() do not sleep (wait) seconds: queries complete when the response 
+        frame is received, with the port timeout as deadline, and writes can be confirmed with '*OPC?'. 
+        The latency of each command mnemonic is learned from the confirmed writes and queries, and a write 
+        that is not confirmed delays the next operation by the learned latency of its command. An explicit 
+        (wait) argument is still honored. \n
+        The learned latencies are kept as a profile for each instrument serial number, that can be saved and 
+        loaded with save_profile() and load_profile(). wait_ready() polls '*OPC?' after slow commands such as 
+        '*RST', instead of a fixed sleep, learning the completion time, and later runs wait most of the 
+        learned time before polling. \n
+        With a (start_delay), the serial port '*IDN?' handshake is polled until the instrument answers, up to 
+        (start_delay) seconds, instead of sleeping the whole delay before the handshake. \n
+        Instrument.discover() locates the first instrument of a list of candidate VISA strings, enumerating the 
+        serial ports once for all candidates, and verifying first the port of the last discovery, kept in an
+        on-disk cache. \n
+        Serial port responses are read in bulk into a receive buffer, with all the bytes waiting in the port 
+        per read call, and the frames are split on the line feed from the buffer. Continuous response streams
+        are served from the buffer without a port read per frame. \n
         The selection is done via the VISA instrument identification string, that specifies "USBSER" for PySerial 
         ports, and "USBx" for USBTMC ports. \n
         If the instrument is not found in the USB bus, the class is not instantiated and returns NoneType.
     """
-    def __new__(cls, visa_str:str, baudrate:int|None=None, wait:float=0.2, timeout:float=1.0, eol:str='\r\n', start_delay:float|None=None) -> Self | None:
+    def __new__(cls, visa_str:str, baudrate:int|None=None, wait:float=0.2, timeout:float=1.0, eol:str='\r\n', start_delay:float|None=None, adaptive:bool=False, portname:str|None=None) -> Self | None:
         """Create the object instance and attempt connection with the instrument, returning None if failed."""
         if not isinstance(visa_str, str): raise TypeError("'visa_str': expected <str>")
         s = visa_str.split("::")
@@ -55,6 +76,11 @@ class Instrument(object):
         self = super().__new__(cls)
         self.wait = wait
         self.eol = eol
+        self._rxbuf = bytearray()       # serial receive buffer
+        self._rxpos = 0                 # start of the unread bytes in the receive buffer
+        self.adaptive = adaptive
+        self.latency = {}               # learned latency in seconds for each command mnemonic
+        self._ready = 0.0               # adaptive mode: time when the instrument is ready for the next command
         if("USBSER" in s[0]):
             if not isinstance(baudrate, int): raise TypeError("'baudrate': expected <int>")
             if not isinstance(timeout, float): raise TypeError("'timeout': expected <float>")
@@ -65,7 +91,7 @@ class Instrument(object):
                 self.pid = int(s[2],0)
                 self.sernum = s[3]
                 self.ifcnum = s[4] if len(s) > 5 else None
-                self.portname = self.search_portname(self.vid, self.pid, self.ifcnum if self.ifcnum != '*' else None)
+                self.portname = portname or self.search_portname(self.vid, self.pid, self.ifcnum if self.ifcnum != '*' else None)
                 self.baudrate = baudrate
                 self.timeout = timeout
                 if self.portname:
@@ -73,6 +99,7 @@ class Instrument(object):
                     self.write = self.serial_write
                     self.read = self.serial_read
                     self.ask = self.serial_ask
+                    self.drain = self.serial_drain
                     self.close = self.serial_close
                     self.open = self.serial_open
                     self.instr.port = self.portname
@@ -81,10 +108,12 @@ class Instrument(object):
                     self.instr.open()
                     self.is_open = self.instr.is_open
                     if self.is_open:
-                        self.instr.reset_input_buffer()
+                        self.serial_reset_input()
                         self.instr.reset_output_buffer()
-                        if (start_delay): time.sleep(start_delay)
-                        self.idn = self.ask("*idn?")
+                        if (start_delay):
+                            self.idn = self.serial_poll_idn(start_delay)
+                        else:
+                            self.idn = self.ask("*idn?")
                         if len(self.idn) == 0:
                             self.close()
                             print("Invalid IDN string for", visa_str)
@@ -115,6 +144,7 @@ class Instrument(object):
                 self.write = self.usb_write
                 self.read = self.usb_read
                 self.ask = self.usb_ask
+                self.drain = self.usb_drain
                 self.close = self.usb_close
                 self.open = self.usb_open
                 self.idn = self.ask("*idn?")
@@ -174,9 +204,10 @@ class Instrument(object):
     def apply_settings(self, d:dict[str, Any]) -> None:
         """Apply the settings in the settings dictionary."""
         self.instr.apply_settings(d)
-    def search_portname(self, vid:int, pid:int, ifcnum:str|None = None) -> str|None:
-        """Locate a matching serial device port."""
-        for com in lp.comports():       
+    @staticmethod
+    def search_portname(vid:int, pid:int, ifcnum:str|None = None, ports:list|None = None) -> str|None:
+        """Locate a matching serial device port, in the (ports) list or in the system serial ports."""
+        for com in (ports if ports is not None else lp.comports()):
             if (com.vid == vid) and (com.pid == pid):
                 if ifcnum and (ifcnum not in com.device):
                     continue
@@ -185,10 +216,30 @@ class Instrument(object):
                 # return ttyname
         else:
             return None
-    def serial_write(self, str:str, wait:float|None=None) -> None:
-        """Encapsulate the write sequence for serial devices."""
+    def serial_write(self, str:str, wait:float|None=None, opc:bool=False) -> None:
+        """Encapsulate the write sequence for serial devices. In adaptive mode, (opc) confirms the completion with '*OPC?', raising RuntimeError if not confirmed."""
         if self.type != "SERIAL": raise TypeError("'serial_write' unsupported for type '%s'" % self.type) # type: ignore
         if not self.is_open: raise RuntimeError("Illegal operation on a closed port.")
+        if self.adaptive:
+            self._pace()
+            t0 = time.perf_counter()
+            line = str + ";*OPC?" if opc else str
+            self.instr.write((line + self.eol).encode(encoding="latin-1", errors="ignore"))
+            if opc:
+                deadline = t0 + self.timeout
+                reply = self.serial_frame(self.timeout).strip()
+                while reply != b'1':
+                    # skip the stale lines left in the input, until the '*OPC?' reply or the timeout
+                    if (not reply) or (time.perf_counter() > deadline):
+                        self.serial_reset_input()
+                        raise RuntimeError(f"'{str}': completion not confirmed by '*OPC?', received {reply!r}")
+                    reply = self.serial_frame(self.timeout).strip()
+                self.learn(str, time.perf_counter() - t0)
+            elif wait:
+                time.sleep(wait)
+            else:
+                self._ready = t0 + self.latency.get(self.mnemonic(str), 0.0)
+            return
         if not wait: wait = self.wait # type: ignore
         str = str + self.eol # type: ignore
         self.instr.write(str.encode(encoding="latin-1", errors="ignore"))
@@ -197,15 +248,85 @@ class Instrument(object):
         """Encapsulate the query/response for serial devices."""
         if self.type != "SERIAL": raise TypeError("'serial_ask' unsupported for type '%s'" % self.type)
         if not self.is_open: raise RuntimeError("Illegal operation on a closed port.")
+        if self.adaptive:
+            self._pace()
+            if wait: time.sleep(wait)
+            t0 = time.perf_counter()
+            self.instr.write((str + self.eol).encode(encoding="latin-1", errors="ignore"))
+            response = self.serial_frame(self.timeout).decode(encoding="latin-1", errors="ignore")
+            self.learn(str, time.perf_counter() - t0)
+            return response
         if not wait: wait = self.wait
         self.serial_write(str, wait=wait)
         if wait: time.sleep(wait)
-        return self.instr.readline().decode(encoding="latin-1", errors="ignore")[:-1]
+        return self.serial_frame().decode(encoding="latin-1", errors="ignore")
     def serial_read(self) -> str:
         """Encapsulate read continuous response for serial devices."""
         if self.type != "SERIAL": raise TypeError("'serial_ask' unsupported for type '%s'" % self.type)
         if not self.is_open: raise RuntimeError("Illegal operation on a closed port.")
-        return self.instr.readline().decode(encoding="latin-1", errors="ignore")[:-1]
+        return self.serial_frame().decode(encoding="latin-1", errors="ignore")
+    def serial_frame(self, timeout:float|None=None) -> bytes:
+        """Return the next frame from the receive buffer, without the line feed, reading the port in bulk. Return the partial frame on port timeout, or after (timeout) seconds."""
+        buf = self._rxbuf
+        deadline = time.perf_counter() + timeout if timeout else None
+        while True:
+            i = buf.find(b'\n', self._rxpos)
+            if i >= 0:
+                with memoryview(buf) as mv:
+                    frame = bytes(mv[self._rxpos:i])
+                self._rxpos = i + 1
+                if self._rxpos == len(buf):
+                    buf.clear()
+                    self._rxpos = 0
+                return frame
+            # drop the consumed frames, and read all the waiting bytes, blocking for at least one byte
+            if self._rxpos:
+                del buf[:self._rxpos]
+                self._rxpos = 0
+            chunk = self.instr.read(max(1, self.instr.in_waiting))
+            if (not chunk) or (deadline and (time.perf_counter() > deadline) and (b'\n' not in chunk)):
+                buf += chunk
+                frame = bytes(buf)
+                buf.clear()
+                return frame
+            buf += chunk
+    def serial_drain(self, quiet:float=0.05, timeout:float=2.0) -> int:
+        """Discard the incoming bytes until the port is quiet for (quiet) seconds, or for (timeout) seconds. Return the number of bytes discarded."""
+        if self.type != "SERIAL": raise TypeError("'serial_drain' unsupported for type '%s'" % self.type)
+        n = len(self._rxbuf) - self._rxpos
+        self._rxbuf.clear()
+        self._rxpos = 0
+        t_end = time.perf_counter() + timeout
+        t_last = time.perf_counter()
+        while (time.perf_counter() < t_end) and (time.perf_counter() - t_last < quiet):
+            waiting = self.instr.in_waiting
+            if waiting:
+                n += len(self.instr.read(waiting))
+                t_last = time.perf_counter()
+            else:
+                time.sleep(quiet / 5)
+        return n
+    def serial_poll_idn(self, timeout:float, poll:float=0.2) -> str:
+        """Ask '*idn?' every (poll) seconds until the instrument answers a valid IDN string, up to (timeout) seconds. Return the IDN string, or '' if no answer."""
+        saved_timeout = self.instr.timeout
+        self.instr.timeout = poll
+        t_end = time.perf_counter() + timeout
+        try:
+            while True:
+                self.instr.write(("*idn?" + self.eol).encode(encoding="latin-1", errors="ignore"))
+                idn = self.serial_frame(poll).decode(encoding="latin-1", errors="ignore")
+                if idn.count(',') >= 3:
+                    self.serial_drain(quiet=0.02, timeout=poll)       # discard the answers to the previous polls
+                    return idn
+                if time.perf_counter() > t_end:
+                    return ''
+        finally:
+            self.instr.timeout = saved_timeout
+    def serial_reset_input(self) -> None:
+        """Discard the bytes in the port input buffer and in the receive buffer."""
+        self.instr.reset_input_buffer()
+        self._rxbuf.clear()
+        self._rxpos = 0
     def serial_close(self) -> None:
         """Encapsulate the close sequence for serial devices."""
         if self.type != "SERIAL": raise TypeError("'serial_close' unsupported for type '%s'" % self.type)
@@ -229,9 +350,10 @@ class Instrument(object):
                     self.write = self.serial_write
                     self.ask = self.serial_ask
                     self.read = self.serial_read
+                    self.drain = self.serial_drain
                     self.close = self.serial_close
                     self.open = self.serial_open
-                    self.instr.reset_input_buffer()
+                    self.serial_reset_input()
                     self.instr.reset_output_buffer()
                     self.write("*cls")
                     self.idn = self.ask("*idn?")
@@ -250,15 +372,34 @@ class Instrument(object):
         except:
             print("ERROR -", sys.exc_info()[1], "for", self.visa_str)
         return self.is_open
-    def usb_write(self, str:str, wait:float=None) -> None:
-        """Encapsulate the write sequence for usbtmc devices."""
+    def usb_write(self, str:str, wait:float=None, opc:bool=False) -> None:
+        """Encapsulate the write sequence for usbtmc devices. In adaptive mode, (opc) confirms the completion with '*OPC?', raising RuntimeError if not confirmed."""
         if self.type != "USB": raise TypeError("'usb_write' unsupported for type '%s'" % self.type)
+        if self.adaptive:
+            self._pace()
+            if wait: time.sleep(wait)
+            t0 = time.perf_counter()
+            if opc:
+                reply = self.instr.ask(str + ";*OPC?")
+                if reply.strip() != "1": raise RuntimeError(f"'{str}': completion not confirmed by '*OPC?', received {reply!r}")
+                self.learn(str, time.perf_counter() - t0)
+            else:
+                self.instr.write(str)
+                self._ready = t0 + self.latency.get(self.mnemonic(str), 0.0)
+            return
         if not wait: wait = self.wait
         if wait: time.sleep(wait)
         self.instr.write(str)
     def usb_ask(self, str:str, wait:float=None) -> str:
         """Encapsulate the query/response for usbtmc devices."""
         if self.type != "USB": raise TypeError("'usb_ask' unsupported for type '%s'" % self.type)
+        if self.adaptive:
+            self._pace()
+            if wait: time.sleep(wait)
+            t0 = time.perf_counter()
+            response = self.instr.ask(str)
+            self.learn(str, time.perf_counter() - t0)
+            return response
         if not wait: wait = self.wait
         if wait: time.sleep(wait)
         return self.instr.ask(str)
@@ -266,6 +407,9 @@ class Instrument(object):
         """Encapsulate continuous read for usbtmc devices."""
         if self.type != "USB": raise TypeError("'usb_ask' unsupported for type '%s'" % self.type)
         return self.instr.readline().decode(encoding="latin-1", errors="ignore")[:-1]
+    def usb_drain(self, quiet:float=0.05, timeout:float=2.0) -> int:
+        """The usbtmc devices are message based, with no stream to drain."""
+        return 0
     def usb_close(self) -> None:
         """Encapsulate the close sequence for usbtmc devices."""
         if self.type != "USB": raise TypeError("'usb_close' unsupported for type '%s'" % self.type)
@@ -282,6 +426,7 @@ class Instrument(object):
             self.write = self.usb_write
             self.read = self.usb_read
             self.ask = self.usb_ask
+            self.drain = self.usb_drain
             self.close = self.usb_close
             self.open = self.usb_open
             self.write("*cls")
@@ -294,6 +439,128 @@ class Instrument(object):
         except:
             print("ERROR -", sys.exc_info()[1], "for", self.visa_str)
         return self.is_open
+    def serial_number(self) -> str:
+        """Return the instrument serial number, from the IDN string."""
+        idn_fields = self.idn.split(",")
+        return idn_fields[2].strip() if len(idn_fields) > 2 else ''
+    def load_profile(self, path:str) -> bool:
+        """Load the learned latencies of this instrument serial number from the JSON profile file (path). Return True if found."""
+        try:
+            with open(path, "r") as f:
+                profile = json.load(f).get(self.serial_number())
+        except (OSError, ValueError):
+            return False
+        if not isinstance(profile, dict): return False
+        self.latency.update({k: float(v) for k, v in profile.items()})
+        return True
+    def save_profile(self, path:str) -> None:
+        """Save the learned latencies of this instrument serial number in the JSON profile file (path), keeping the other instruments profiles."""
+        try:
+            with open(path, "r") as f:
+                profiles = json.load(f)
+        except (OSError, ValueError):
+            profiles = {}
+        profiles[self.serial_number()] = {k: round(v, 6) for k, v in sorted(self.latency.items())}
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(profiles, f, indent=4)
+        os.replace(tmp, path)
+    def wait_ready(self, str:str, timeout:float=2.0, poll:float=0.1) -> float:
+        """
+            Wait for the completion of the command (str) polling '*OPC?' every (poll) seconds, up to (timeout) seconds. Learn and return the completion time.
+            The input is discarded before polling, so that stale data frames are not taken as the '*OPC?' response, and 
+            after a timeout, so that a late '*OPC?' response is not taken as the response of the next command.
+        """
+        t0 = time.perf_counter()
+        if self.type == "SERIAL": self.serial_reset_input()    # discard the frames received before the command
+        learned = self.latency.get(self.mnemonic(str))
+        if learned: time.sleep(min(0.8 * learned, timeout))     # do not poll before the usual completion time
+        while not self._poll_opc(poll):
+            if time.perf_counter() - t0 > timeout:
+                self.drain(quiet=0.02, timeout=poll)             # discard the late responses of the polls
+                if self.type == "SERIAL": self.serial_reset_input()
+                return timeout
+        latency = time.perf_counter() - t0
+        self.learn(str, latency)
+        self.drain(quiet=0.02, timeout=poll)                     # discard the late responses of previous polls
+        return latency
+    def _poll_opc(self, poll:float) -> bool:
+        """Send '*OPC?', and return True if the instrument responds '1' within (poll) seconds."""
+        try:
+            if self.type == "SERIAL":
+                saved_timeout = self.instr.timeout
+                self.instr.timeout = poll
+                try:
+                    self.instr.write(("*OPC?" + self.eol).encode(encoding="latin-1", errors="ignore"))
+                    return self.serial_frame(poll).strip() == b'1'
+                finally:
+                    self.instr.timeout = saved_timeout
+            return self.instr.ask("*OPC?").strip() == "1"
+        except Exception:
+            time.sleep(poll)
+            return False
+    @classmethod
+    def discover(cls, visa_strs:list[str], cache:str|None=None, **kwargs) -> Self | None:
+        """
+            Return the first instrument found for the list of candidate VISA strings (visa_strs), or None.
+            The serial ports are enumerated once, and matched with all the candidates. The port of the last discovery 
+            of each VISA string is read from the JSON (cache) file, and verified first if it is still assigned to a 
+            device with the VISA string vid/pid. The cache is updated with the port and IDN of the instrument found. 
+            The (kwargs) are passed to the Instrument constructor.
+        """
+        try:
+            with open(cache, "r") as f:
+                entries = json.load(f)
+        except (TypeError, OSError, ValueError):
+            entries = {}
+        def found(visa_str, instr):
+            if cache and (instr.type == "SERIAL"):
+                entries[visa_str] = {"port": instr.portname, "idn": instr.idn.strip()}
+                try:
+                    tmp = cache + ".tmp"
+                    with open(tmp, "w") as f:
+                        json.dump(entries, f, indent=4)
+                    os.replace(tmp, cache)
+                except OSError:
+                    pass
+            return instr
+        def usb_ids(visa_str):
+            s = visa_str.split("::")
+            ifcnum = s[4] if (len(s) > 5) and (s[4] != '*') else None
+            return int(s[1],0), int(s[2],0), ifcnum
+        # enumerate the serial ports once for all candidates
+        ports = list(lp.comports())
+        # verify the cached ports first, if still assigned to a matching device
+        for visa_str in visa_strs:
+            port = entries.get(visa_str, {}).get("port")
+            if port and ("USBSER" in visa_str.split("::")[0]):
+                vid, pid, ifcnum = usb_ids(visa_str)
+                if any((com.device == port) for com in ports if (com.vid == vid) and (com.pid == pid)):
+                    instr = cls(visa_str, portname=port, **kwargs)
+                    if instr: return found(visa_str, instr)
+        # try all candidates
+        for visa_str in visa_strs:
+            if "USBSER" in visa_str.split("::")[0]:
+                port = cls.search_portname(*usb_ids(visa_str), ports)
+                if not port: continue
+                instr = cls(visa_str, portname=port, **kwargs)
+            else:
+                instr = cls(visa_str, **kwargs)
+            if instr: return found(visa_str, instr)
+        return None
+    @staticmethod
+    def mnemonic(str:str) -> str:
+        """Return the command mnemonic: the command headers without the parameters, for each command in the line."""
+        return ';'.join(x.split()[0].upper() for x in str.split(';') if x.strip())
+    def learn(self, str:str, latency:float) -> None:
+        """Update the learned latency of the command (str) with the measured (latency) in seconds."""
+        key = self.mnemonic(str)
+        learned = self.latency.get(key)
+        self.latency[key] = latency if learned is None else learned + 0.2 * (latency - learned)
+    def _pace(self) -> None:
+        """Adaptive mode: wait until the instrument is ready after an unconfirmed write."""
+        delay = self._ready - time.perf_counter()
+        if delay > 0.0: time.sleep(delay)
     def _illegal_stub(self, *arg) -> NoReturn:
         """Raise exception when called for closed port."""
         raise RuntimeError("Illegal operation on closed port.")
@@ -0,0 +1,761 @@
+#!/usr/bin/env python3
+
+#   Unit tests of the daq_server buffer and condition classes.
+#   The tests need no DAQ hardware, and run with the standard unittest runner or pytest.
+#
+#   usage: python -m unittest test_daq_server
+
+import unittest
+import asyncio
+import heapq
+import queue
+import socket
+import struct
+import threading
+import numpy as np
+from argparse import Namespace
+import daq_server as d
+
+#===============================================================================================#
+#   RingBuffer                                                                                  #
+#===============================================================================================#
+
+class TestRingBuffer(unittest.TestCase):
+
+    def fill(self, buf, n, t0 = 0.0, dt = 1.0, first = 0):
+        """Append (n) records with record numbers from (first), times from (t0) every (dt), and sensor values equal to the record number."""
+        for i in range(first, first + n):
+            buf.append(i, t0 + (i - first) * dt, [float(i)] * buf.channels)
+
+    def test_append(self):
+        buf = d.RingBuffer(8, 3, 100.0)
+        self.assertEqual(len(buf), 0)
+        self.fill(buf, 5)
+        self.assertEqual(len(buf), 5)
+        self.assertEqual((buf.tmin, buf.tmax), (0.0, 4.0))
+        self.assertEqual(buf.recno(-1), 4)
+        np.testing.assert_array_equal(buf.record(2), [2.0, 2.0, 2.0])
+        np.testing.assert_array_equal(buf.column(1), [0.0, 1.0, 2.0, 3.0, 4.0])
+        with self.assertRaises(IndexError):
+            buf.record(5)
+
+    def test_wraparound(self):
+        """The oldest records are overwritten, and windows across the ring end are contiguous views."""
+        buf = d.RingBuffer(8, 2, 100.0)
+        self.fill(buf, 13)
+        self.assertEqual(len(buf), 8)
+        self.assertEqual((buf.recno(0), buf.recno(-1)), (5, 12))
+        rows = buf.rows(1, 7)
+        self.assertTrue(np.shares_memory(rows, buf._data))
+        np.testing.assert_array_equal(rows[:, 0], [6.0, 7.0, 8.0, 9.0, 10.0, 11.0])
+        np.testing.assert_array_equal(buf.times(), np.arange(5.0, 13.0))
+
+    def test_span(self):
+        """Records older than the time span are evicted on append."""
+        buf = d.RingBuffer(100, 1, 2.5)
+        self.fill(buf, 10, dt = 0.5)
+        self.assertEqual((buf.tmin, buf.tmax), (2.0, 4.5))
+        self.assertEqual(len(buf), 6)
+
+    def test_rows_seq(self):
+        buf = d.RingBuffer(8, 1, 100.0)
+        self.fill(buf, 6)
+        q0, q1 = buf.seq(2), buf.seq(len(buf))
+        self.assertEqual((q0, q1), (2, 6))
+        self.fill(buf, 4, t0 = 6.0, first = 6)
+        # the records [2:6] are still in the ring after 4 more appends
+        np.testing.assert_array_equal(buf.rows_seq(q0, q1)[:, 1], [2.0, 3.0, 4.0, 5.0])
+        self.fill(buf, 1, t0 = 10.0, first = 10)
+        with self.assertRaises(IndexError):
+            buf.rows_seq(q0, q1)
+
+    def test_clear(self):
+        buf = d.RingBuffer(8, 1, 100.0)
+        self.fill(buf, 5)
+        buf.clear()
+        self.assertEqual(len(buf), 0)
+        self.fill(buf, 2, t0 = 5.0, first = 5)
+        self.assertEqual((buf.recno(0), buf.seq(0), buf.written), (5, 5, 7))
+
+    def test_index(self):
+        """index() returns the first record at or after the time, and the extreme subscripts out of the buffer."""
+        buf = d.RingBuffer(8, 1, 100.0)
+        self.assertEqual(buf.index(1.0), 0)
+        self.fill(buf, 13)
+        # the buffer holds the times 5.0 .. 12.0, across the ring end
+        self.assertEqual(buf.index(5.0), 0)
+        self.assertEqual(buf.index(8.0), 3)
+        self.assertEqual(buf.index(8.5), 4)
+        self.assertEqual(buf.index(0.0), 0)
+        self.assertEqual(buf.index(12.0), 7)
+        self.assertEqual(buf.index(20.0), 7)
+        self.assertEqual(buf.index(float('nan')), 7)
+
+    def test_index_search(self):
+        """index() matches a linear search on irregular sample times."""
+        rng = np.random.default_rng(1)
+        buf = d.RingBuffer(500, 1, 1e6)
+        times = np.cumsum(rng.uniform(0.001, 0.1, 700))
+        for i, t in enumerate(times):
+            buf.append(i, t, [0.0])
+        held = times[-500:]
+        for t in rng.uniform(held[0], held[-1], 200):
+            self.assertEqual(buf.index(t), int(np.argmax(held >= t)))
+
+    def test_epochs(self):
+        """A time reset starts a new time base, without rewriting the stored times."""
+        buf = d.RingBuffer(100, 1, 100.0)
+        self.fill(buf, 10, t0 = 100.0)
+        buf.reset_time(104.0)
+        self.assertEqual((buf.bases, buf.toffs), (2, 104.0))
+        self.assertEqual((buf.tmin, buf.tmax), (-4.0, 5.0))
+        self.assertEqual(buf.raw_times()[0], 100.0)
+        np.testing.assert_array_equal(buf.times(3, 6), [-1.0, 0.0, 1.0])
+        self.assertEqual(buf.index(0.0), 4)
+        buf.reset_time(108.0)
+        self.assertEqual(buf.index(0.0), 8)
+        self.assertEqual(buf.epoch(1), 104.0)
+
+    def test_rebase(self):
+        buf = d.RingBuffer(10, 1, 100.0)
+        buf.reset_time(10.0)
+        buf.reset_time(25.0)
+        self.assertEqual(buf.rebase(1.0), 1.0)
+        self.assertEqual(buf.rebase(1.0, 1, None), -14.0)
+        self.assertEqual(buf.rebase(1.0, None, 0), 26.0)
+        self.assertEqual(buf.rebase(26.0, 0, 1), 16.0)
+        for src in range(3):
+            for dst in range(3):
+                self.assertEqual(buf.rebase(buf.rebase(7.0, src, dst), dst, src), 7.0)
+
+#===============================================================================================#
+#   Sensor                                                                                      #
+#===============================================================================================#
+
+class TestSensor(unittest.TestCase):
+
+    def setUp(self):
+        d.Sensor.clear()
+        self.addCleanup(d.create_sensors)
+        self.sensors = (
+            d.Sensor_ADC('pwm1','prct','SERVO','%','{:.2f}'),
+            d.Sensor_H2_MEMS('ch0','main','H2_MEMS','V','{:.6f}'),
+            d.Sensor_CH4_MQ4B('ch1','main','CH4_MQ4B','V','{:.6f}'),
+            d.Sensor_CH4_TGS2611('ch2','main','CH4','V','{:.6f}'),
+            d.Sensor_T10k('ch3','temp','CH4_TEMP','C','{:.2f}'),
+            d.Sensor_PT100('ch4','temp','PT100','C','{:.2f}'),
+            d.Sensor_O2_AO_03('ch5','prct','O2_AO','%','{:.2f}'),
+            d.Sensor_O2_Me2_O2('ch6','prct','O2','%','{:.2f}'),
+            d.Sensor_H2_Fuel_Cell('ch7','main','H2','V','{:.6f}'),
+            d.Sensor_CO2_MG812('ch8','main','CO2','V','{:.6f}'),
+            d.Sensor_AHT('temp','temp','AHT10_TEMP','C','{:.2f}'),
+        )
+
+    def inputs(self, s):
+        """Return the in range, NaN and out of domain raw readings for the sensor (s)."""
+        x = [0.0, 1e-3, 0.318, 0.9, 1.0, 1.1, 1.29, 2.5, 4.5, float('nan'), -1.0, 10.0, -10.0]
+        if isinstance(s, d.Sensor_T10k): x.append(s.vref)
+        return np.array(x)
+
+    def test_val_array(self):
+        """val_array() matches val() for each reading, and is not finite where val() raises."""
+        for s in self.sensors:
+            x = self.inputs(s)
+            v = s.val_array(x)
+            for vadc, y in zip(x, v):
+                with self.subTest(sensor = type(s).__name__, vadc = vadc):
+                    try:
+                        expected = s.val(float(vadc))
+                    except (ValueError, ZeroDivisionError):
+                        self.assertFalse(np.isfinite(y))
+                        continue
+                    if np.isnan(expected):
+                        self.assertTrue(np.isnan(y))
+                    else:
+                        self.assertAlmostEqual(float(y), expected, delta = 1e-9 * max(1.0, abs(expected)))
+
+    def test_val_records(self):
+        """val_records() and the record format match val() and format() of each sensor."""
+        block = np.array([[v] * len(self.sensors) for v in (0.318, 0.9, 1.1, 2.5)])
+        values = d.Sensor.val_records(block)
+        np.testing.assert_array_equal(d.Sensor.val_records(block[0]), values[0])
+        for row, record in zip(block, values):
+            line = d.Sensor.record_fmt().format(1.5, *record.tolist())
+            self.assertEqual(line, '1.500000s,' + ','.join(s.format(float(x)) for s, x in zip(self.sensors, row)))
+
+#===============================================================================================#
+#   RollingWindow                                                                               #
+#===============================================================================================#
+
+class TestRollingWindow(unittest.TestCase):
+
+    def test_statistics(self):
+        """The incremental statistics match numpy on the samples in the window."""
+        rng = np.random.default_rng(2)
+        w = d.RollingWindow(1.0)
+        times = np.arange(3000) * 0.01
+        values = rng.normal(1.0, 0.1, 3000)
+        for i, (t, v) in enumerate(zip(times, values)):
+            w.update(t, v)
+            if i % 97 == 0:
+                held = values[(times >= t - 1.0) & (times <= t)]
+                self.assertEqual(w.count, len(held))
+                self.assertAlmostEqual(w.median, float(np.median(held)), places = 12)
+                self.assertAlmostEqual(w.mean, float(np.mean(held)), places = 9)
+                self.assertAlmostEqual(w.std, float(np.std(held)), places = 6)
+                self.assertEqual((w.min, w.max), (held.min(), held.max()))
+
+    def test_nan(self):
+        """All statistics are NaN while the window holds a NaN sample."""
+        w = d.RollingWindow(1.0)
+        w.update(0.0, 1.0)
+        w.update(0.5, float('nan'))
+        w.update(1.0, 3.0)
+        self.assertTrue(all(np.isnan(x) for x in (w.median, w.mean, w.min, w.max, w.std)))
+        w.update(1.6, 5.0)
+        self.assertEqual((w.count, w.median, w.mean), (2, 4.0, 4.0))
+
+    def test_empty(self):
+        w = d.RollingWindow(2.0)
+        self.assertEqual(w.count, 0)
+        self.assertTrue(np.isnan(w.mean))
+        w.update(0.0, 2.0)
+        w.clear()
+        self.assertEqual(w.count, 0)
+
+    def test_stats(self):
+        stats = d.RollingStats(3, (1.0, 2.0))
+        for i in range(30):
+            stats.update(i * 0.25, [i, 2 * i, 3 * i])
+        self.assertEqual(stats.periods(), (1.0, 2.0))
+        self.assertEqual(stats.window(2, 2.0).max, 87.0)
+        self.assertEqual(stats.window(0, 1.0).count, 5)
+        self.assertIsNone(stats.window(0, 5.0))
+
+#===============================================================================================#
+#   Broadcast                                                                                   #
+#===============================================================================================#
+
+class TestBroadcast(unittest.TestCase):
+
+    def test_cursors(self):
+        """Each subscriber reads all the records published after it subscribed, with its own cursor."""
+        ch = d.Broadcast(8)
+        ch.publish([0, 1])
+        a = ch.subscribe()
+        ch.publish([2, 3, 4])
+        b = ch.subscribe()
+        ch.publish([5])
+        self.assertEqual(ch.subscribers, 2)
+        self.assertEqual(a.get(0.0, count = 2), [2, 3])
+        self.assertEqual(a.get(0.0), [4, 5])
+        self.assertEqual(b.get(0.0), [5])
+        self.assertEqual(a.get(0.01), [])
+        a.close()
+        self.assertEqual(ch.subscribers, 1)
+
+    def test_drop(self):
+        """A subscriber lagging behind the ring depth skips to the oldest record, and counts the dropped records."""
+        ch = d.Broadcast(4, "DROP")
+        sub = ch.subscribe()
+        ch.publish(range(10))
+        self.assertEqual(sub.get(0.0), [6, 7, 8, 9])
+        self.assertEqual(sub.dropped, 6)
+
+    def test_close_policy(self):
+        ch = d.Broadcast(4, "CLOSE")
+        sub = ch.subscribe()
+        ch.publish(range(4))
+        self.assertEqual(sub.get(0.0, count = 1), [0])
+        ch.publish(range(4, 6))
+        with self.assertRaises(d.Broadcast.Overrun):
+            sub.get(0.0)
+
+    def test_wakeup(self):
+        """A blocked subscriber is woken up by publish() and by close()."""
+        ch = d.Broadcast(8)
+        sub = ch.subscribe()
+        received = []
+        def reader():
+            while records := sub.get(5.0):
+                received.extend(records)
+        th = threading.Thread(target = reader)
+        th.start()
+        ch.publish(["a"])
+        ch.publish(["b", "c"])
+        while len(received) < 3 and th.is_alive():
+            th.join(0.01)
+        ch.close()
+        th.join(5.0)
+        self.assertFalse(th.is_alive())
+        self.assertEqual(received, ["a", "b", "c"])
+
+#===============================================================================================#
+#   SampleRing                                                                                  #
+#===============================================================================================#
+
+class TestSampleRing(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = d.SampleRing.create(8, 3)
+        self.reader = d.SampleRing.attach(self.ring.name)
+
+    def tearDown(self):
+        self.reader.close()
+        self.ring.close()
+
+    def test_read(self):
+        """The reader gets the records written by the writer, in the attached mapping."""
+        self.ring.write(0, 0.5, [1.0, 2.0, 3.0])
+        self.ring.write(1, 1.0, [4.0, 5.0])
+        self.assertEqual(self.reader.backlog, 2)
+        rows = self.reader.read()
+        np.testing.assert_array_equal(rows[:, :5], [[0, 0, 0.5, 1, 2], [1, 1, 1.0, 4, 5]])
+        self.assertEqual(rows[0, 5], 3.0)
+        self.assertTrue(np.isnan(rows[1, 5]))
+        self.assertEqual((self.reader.nans, self.reader.backlog, len(self.reader.read())), (1, 0, 0))
+
+    def test_slot(self):
+        """A slot filled in place is published by commit()."""
+        slot = self.ring.slot()
+        slot[:] = [7.0, 8.0, 9.0]
+        self.assertEqual(len(self.reader.read()), 0)
+        self.ring.commit(5, 2.0)
+        np.testing.assert_array_equal(self.reader.read(), [[0, 5, 2.0, 7, 8, 9]])
+
+    def test_lapped(self):
+        """Records overwritten before they are read are counted as lost."""
+        for i in range(20):
+            self.ring.write(i, float(i), [float(i)] * 3)
+        rows = self.reader.read(5)
+        np.testing.assert_array_equal(rows[:, 1], [12, 13, 14, 15, 16])
+        self.assertEqual((self.reader.lost, self.reader.backlog), (12, 3))
+
+    def test_torn_row(self):
+        """A row with an invalid sequence stamp, being rewritten by the writer, is not accepted."""
+        for i in range(3):
+            self.ring.write(i, float(i), [float(i)] * 3)
+        self.ring._rows[1, 0] = -1.0
+        rows = self.reader.read()
+        np.testing.assert_array_equal(rows[:, 1], [0, 2])
+        self.assertEqual(self.reader.lost, 1)
+
+#===============================================================================================#
+#   FrameParser                                                                                 #
+#===============================================================================================#
+
+class TestFrameParser(unittest.TestCase):
+
+    def test_parse(self):
+        """The unit suffixes and whitespace are removed, as with conv_float()."""
+        out = np.zeros(5)
+        frame = " 1.250000V,25.31C, 20.5%,-3.5e-3V,0.000100s\r\n"
+        self.assertEqual(d.FrameParser().parse(frame, out), 0)
+        np.testing.assert_array_equal(out, [1.25, 25.31, 20.5, -3.5e-3, 1e-4])
+        np.testing.assert_array_equal(out, [d.conv_float(x.strip()) for x in frame.split(',')])
+
+    def test_malformed(self):
+        """Invalid and missing fields are set to NaN, and counted."""
+        out = np.zeros(4)
+        self.assertEqual(d.FrameParser().parse("1.0V,OVR,3.0C", out), 2)
+        np.testing.assert_array_equal(out[[0, 2]], [1.0, 3.0])
+        self.assertTrue(np.isnan(out[1]) and np.isnan(out[3]))
+
+    def test_extra(self):
+        out = np.zeros(2)
+        self.assertEqual(d.FrameParser().parse("1.0V,2.0V,3.0V", out), 0)
+        np.testing.assert_array_equal(out, [1.0, 2.0])
+
+#===============================================================================================#
+#   Condition, ConditionMonitor                                                                 #
+#===============================================================================================#
+
+class TestCondition(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sensors = d.create_sensors()
+
+    def record(self, ch4):
+        """Return a raw record with the CH4 channel value (ch4)."""
+        rec = np.zeros(len(self.sensors))
+        rec[0] = ch4
+        return rec
+
+    def run_values(self, cond, values):
+        """Update the condition with the CH4 (values), one per second, and return the states."""
+        return [cond.update(float(t), self.record(v)) for t, v in enumerate(values)]
+
+    def test_parse(self):
+        for fields in (["LEVEL", "CH4", "1.0"], ["FOO", "CH4", "1.0"], ["ABOVE", "NOPE", "1.0"], ["ABOVE", "CH4", "X"], ["ABOVE", "CH4"]):
+            with self.assertRaises(ValueError):
+                d.Condition(fields)
+
+    def test_level(self):
+        cond = d.Condition(["LEVEL", "CH4", "1.0", "0.1"])
+        self.assertEqual(self.run_values(cond, [0.5, 0.95, 1.05, 1.2]), [False, True, True, False])
+        self.assertEqual(cond.value, 1.2)
+        self.assertEqual((cond.event(True), cond.event(False)), ("IN", "OUT"))
+
+    def test_hysteresis(self):
+        above = d.Condition(["ABOVE", "CH4", "1.0", "0.2"])
+        self.assertEqual(self.run_values(above, [0.9, 1.1, 0.9, 0.8, 0.79, 0.9]), [False, True, True, True, False, False])
+        below = d.Condition(["BELOW", "CH4", "1.0", "0.2"])
+        self.assertEqual(self.run_values(below, [1.1, 0.9, 1.1, 1.2, 1.21]), [False, True, True, True, False])
+
+    def test_peak(self):
+        """A peak is detected on the record where the value fell back by the prominence."""
+        cond = d.Condition(["PEAK", "CH4", "0.5"])
+        states = self.run_values(cond, [1.0, 0.8, 1.2, 1.6, 2.0, 1.8, 1.4, 1.0, 1.2, 1.4])
+        self.assertEqual(states.index(True), 6)
+        self.assertEqual(states.count(True), 1)
+        self.assertEqual(cond.value, 2.0)
+        self.assertEqual((cond.event(True), cond.event(False)), ("PEAK", None))
+
+    def test_drift(self):
+        """The drift is evaluated on the buffer with :CMD:BASE:DRIFT?, once per DRIFT_PERIOD."""
+        d.buf = d.RingBuffer(1000, len(self.sensors), 1000.0)
+        d.stats = d.RollingStats(len(self.sensors), ())
+        self.addCleanup(delattr, d, "buf")
+        self.addCleanup(delattr, d, "stats")
+        cond = d.Condition(["DRIFT", "CH4", "0.1", "60"])
+        states = []
+        for i in range(900):
+            t = i * 0.1
+            rec = self.record(1.0 + t * 0.001)      # 0.06 units/minute
+            d.buf.append(i, t, rec)
+            states.append(cond.update(t, rec))
+        self.assertAlmostEqual(cond.value, 0.06, places = 6)
+        self.assertTrue(all(states))
+        # the state is kept until the next evaluation
+        cond.limit = 0.05
+        self.assertTrue(cond.update(d.buf.tmax, self.record(1.0899)))
+        t = cond._next
+        d.buf.append(900, t, self.record(1.0 + t * 0.001))
+        self.assertFalse(cond.update(t, self.record(1.0 + t * 0.001)))
+
+class TestConditionMonitor(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sensors = d.create_sensors()
+
+    def update(self, monitor, values):
+        """Update the monitor with the CH4 (values), one per second."""
+        for t, v in enumerate(values):
+            rec = np.zeros(len(self.sensors))
+            rec[0] = v
+            monitor.update(float(t), rec)
+
+    def test_once(self):
+        """A once watch fires when all conditions are true on the same record, and is removed."""
+        monitor = d.ConditionMonitor()
+        calls = []
+        monitor.add([d.Condition(["ABOVE", "CH4", "1.0"]), d.Condition(["BELOW", "CH4", "2.0"])], lambda t, state, values: calls.append((t, state, values)))
+        self.update(monitor, [0.5, 2.5, 1.5, 1.8])
+        self.assertEqual(calls, [(2.0, True, [1.5, 1.5])])
+        self.assertEqual(monitor.watches, 0)
+
+    def test_persistent(self):
+        """A persistent watch fires on each change of state, starting with the first record."""
+        monitor = d.ConditionMonitor()
+        calls = []
+        watch = monitor.add([d.Condition(["ABOVE", "CH4", "1.0"])], lambda t, state, values: calls.append((t, state)), once = False)
+        self.update(monitor, [0.5, 0.6, 1.5, 1.6, 0.5])
+        self.assertEqual(calls, [(0.0, False), (2.0, True), (4.0, False)])
+        monitor.remove(watch)
+        monitor.remove(watch)
+        self.assertEqual(monitor.watches, 0)
+
+    def test_failing_watch(self):
+        """A watch that raises is removed with its error, and the other watches are still evaluated."""
+        monitor = d.ConditionMonitor()
+        calls, errors = [], []
+        def closed(t, state, values):
+            raise RuntimeError('Event loop is closed')
+        failing = monitor.add([d.Condition(["ABOVE", "CH4", "1.0"])], closed, errback = errors.append)
+        monitor.add([d.Condition(["ABOVE", "CH4", "1.0"])], lambda t, state, values: calls.append(t), once = False)
+        self.update(monitor, [0.5, 1.5, 0.5, 1.5])
+        self.assertEqual(calls, [0.0, 1.0, 2.0, 3.0])
+        self.assertEqual(errors, ['RuntimeError: Event loop is closed'])
+        self.assertEqual((failing.error, monitor.errors, monitor.watches), (errors[0], 1, 1))
+
+    def test_out_of_domain(self):
+        """An out of domain reading evaluates the condition to false, with a NaN value, and does not raise."""
+        monitor = d.ConditionMonitor()
+        cond = d.Condition(["LEVEL", "PT100", "25.0", "1.0"])
+        calls = []
+        monitor.add([cond], lambda t, state, values: calls.append(state), once = False)
+        rec = np.zeros(len(self.sensors))
+        rec[list(d.Sensor.labels()).index("PT100")] = 10.0
+        monitor.update(0.0, rec)
+        self.assertEqual((calls, monitor.errors), ([False], 0))
+        self.assertTrue(np.isnan(cond.value))
+
+#===============================================================================================#
+#   capture_rows                                                                                #
+#===============================================================================================#
+
+class TestCaptureRows(unittest.TestCase):
+
+    def setUp(self):
+        self.sensors = d.create_sensors()
+        n = len(self.sensors)
+        d.buf, d.stats, d.monitor = d.RingBuffer(100, n, 100.0), d.RollingStats(n, (1.0,)), d.ConditionMonitor()
+        for name in ("buf", "stats", "monitor"):
+            self.addCleanup(delattr, d, name)
+
+    def rows(self, values):
+        """Return SampleRing rows with the CH4 (values), one per second."""
+        rows = np.zeros((len(values), 3 + len(self.sensors)))
+        rows[:, 1] = np.arange(len(values))
+        rows[:, 2] = np.arange(len(values), dtype=np.float64)
+        rows[:, 3] = values
+        return rows
+
+    def test_capture(self):
+        d.buf.reset_time(1.0)
+        records = d.capture_rows(self.rows([0.5, 1.5, 2.5]))
+        self.assertEqual([(r, t) for r, t, _ in records], [(0, -1.0), (1, 0.0), (2, 1.0)])
+        self.assertEqual((len(d.buf), d.stats.window(0, 1.0).max), (3, 2.5))
+
+    def test_failing_subscription(self):
+        """A raising event condition does not cost any buffered record, and the other subscriptions keep their events."""
+        class Failing(d.Condition):
+            def update(self, t, record):
+                if t >= 2.0: raise ValueError('math domain error')
+                return super().update(t, record)
+        events, errors = [], []
+        d.monitor.add([Failing(["ABOVE", "CH4", "1.0"])], lambda t, state, values: events.append(('F', t, state)), once = False, errback = errors.append)
+        d.monitor.add([d.Condition(["ABOVE", "CH4", "1.0"])], lambda t, state, values: events.append(('C', t, state)), once = False)
+        records = d.capture_rows(self.rows([0.5, 1.5, 0.5, 1.5, 2.5]))
+        self.assertEqual(len(records), 5)
+        np.testing.assert_array_equal(d.buf.column(0), [0.5, 1.5, 0.5, 1.5, 2.5])
+        self.assertEqual(errors, ['ValueError: math domain error'])
+        self.assertEqual([x for x in events if x[0] == 'F'], [('F', 0.0, False), ('F', 1.0, True)])
+        self.assertEqual([x for x in events if x[0] == 'C'], [('C', 0.0, False), ('C', 1.0, True), ('C', 2.0, False), ('C', 3.0, True)])
+        self.assertEqual(d.monitor.watches, 1)
+
+#===============================================================================================#
+#   DataRecord                                                                                  #
+#===============================================================================================#
+
+class TestDataRecord(unittest.TestCase):
+
+    def setUp(self):
+        self.sensors = d.create_sensors()
+        d.DataRecord.configure()
+        self.values = [0.5 + i / 8 for i in range(len(self.sensors))]
+        self.record = d.DataRecord(42, 1.25, self.values)
+
+    def test_ascii(self):
+        """The ASC frame is the text record formatted with the sensors format strings."""
+        expected = '1.250000s,' + ','.join((s.fmt + s.unit).format(x) for s, x in zip(self.sensors, self.values))
+        self.assertEqual(self.record.frame(), expected.encode())
+        self.assertEqual(self.record.frame("ASC"), expected.encode())
+
+    def test_binary(self):
+        """The BIN frames are fixed width little-endian records, as described by the header line."""
+        n = len(self.sensors)
+        for bits, code in ((32, 'f'), (64, 'd')):
+            with self.subTest(bits = bits):
+                header = d.DataRecord.header(bits).decode()
+                self.assertTrue(header.endswith('\n'))
+                fields = header.rstrip('\n').split(',')
+                self.assertEqual(fields[:3], ['#BIN', f'<Qd{n}{code}', str(8 + 8 + n * bits // 8)])
+                self.assertEqual(fields[3:], ['RECNO', 'TIME[s]'] + [f'{s.label}[{s.unit}]' for s in self.sensors])
+                frame = self.record.frame("BIN", bits)
+                self.assertEqual(len(frame), int(fields[2]))
+                recno, wavetime, *values = struct.unpack(fields[1], frame)
+                self.assertEqual((recno, wavetime), (42, 1.25))
+                np.testing.assert_allclose(values, self.values, rtol = 1e-6 if bits == 32 else 0.0)
+
+    def test_cache(self):
+        """Each frame format is encoded once, and shared by the listeners of the record."""
+        a = self.record.frame("BIN", 32)
+        self.assertIs(self.record.frame("BIN", 32), a)
+        self.assertIsNot(self.record.frame("BIN", 64), a)
+        self.assertIs(self.record.frame("ASC"), self.record.frame("ASC"))
+        self.assertEqual(set(self.record._frames), {32, 64, "ASC"})
+
+#===============================================================================================#
+#   :DATA:READ?                                                                                 #
+#===============================================================================================#
+
+class TestDataRead(unittest.TestCase):
+    """The :DATA:READ? response of a data_handler thread, on a socket pair, from a wrapped around buffer."""
+
+    def setUp(self):
+        self.sensors = d.create_sensors()
+        n = len(self.sensors)
+        d.arg = d.defaults()
+        d.arg.read_chunk = 3
+        d.buf, d.stats, d.monitor = d.RingBuffer(8, n, 100.0), d.RollingStats(n, (1.0,)), d.ConditionMonitor()
+        for name in ("arg", "buf", "stats", "monitor"):
+            self.addCleanup(delattr, d, name)
+        rows = np.full((12, 3 + n), 0.5)
+        rows[:, 1] = np.arange(12)
+        rows[:, 2] = np.arange(12, dtype=np.float64)
+        rows[:, 3] = np.arange(12) / 10.0
+        d.buf.reset_time(0.0)
+        d.capture_rows(rows)
+        self.client, server = socket.socketpair()
+        self.client.settimeout(5.0)
+        self.thread = threading.Thread(target = d.data_handler, args = (server, "test", [], d.Broadcast(8), queue.Queue(), queue.Queue()), daemon = True)
+        self.thread.start()
+        self.addCleanup(server.close)
+
+    def tearDown(self):
+        self.client.close()
+        self.thread.join(5.0)
+
+    def read(self, cmd: str) -> list[str]:
+        """Send the (cmd) and return the response lines, up to the last "OK" or "ERR" line."""
+        self.client.sendall(cmd.encode())
+        rx = b''
+        while not (rx.endswith(b'OK') or (b'ERR' in rx.rpartition(b'\n')[2])):
+            data = self.client.recv(65536)
+            if not data: break
+            rx += data
+        return rx.decode().split('\n')
+
+    def expected(self, t0: int, t1: int) -> list[str]:
+        """Return the text records with the times from (t0) to (t1) seconds."""
+        rowfmt = d.Sensor.record_fmt()
+        rows = [[0.1 * t] + [0.5] * (len(self.sensors) - 1) for t in range(t0, t1 + 1)]
+        return [rowfmt.format(float(t), *v) for t, v in zip(range(t0, t1 + 1), d.Sensor.val_records(rows).tolist())]
+
+    def test_window(self):
+        """The records of the window are sent in chunks, across the buffer wraparound, and finish with "OK"."""
+        self.assertEqual(self.read(":DATA:READ? 5, 10"), self.expected(5, 10) + ["OK"])
+
+    def test_single(self):
+        self.assertEqual(self.read(":DATA:READ? 7"), self.expected(7, 7) + ["OK"])
+
+    def test_overwritten(self):
+        """Records no longer in the buffer are not sent."""
+        self.assertEqual(self.read(":DATA:READ? 0, 5"), self.expected(4, 5) + ["OK"])
+
+#===============================================================================================#
+#   SCPI writes joining                                                                         #
+#===============================================================================================#
+
+class TestJoinWrites(unittest.TestCase):
+
+    def pending(self, *cmds):
+        """Return a pending commands heap with the DAQLink requests (cmds), in order."""
+        heap = []
+        for seqno, x in enumerate(cmds):
+            cmd, _, wait = x.partition('@')
+            heapq.heappush(heap, (d.DAQLink.PRIO_NORMAL, seqno, Namespace(cmd = cmd, req_id = seqno, wait = float(wait or 0.0))))
+        return heap
+
+    def test_coalescible(self):
+        """Only plain writes, with no query, wait, reset, EEPROM or pseudo command, are joined."""
+        for cmd, expected in ((':pwm3:outp:ena', True), (':DOUT0.2:WRITE 1', True), (':ch0:read?', False), ('*rst', False),
+                              (':SAV 1', False), (':RCL 1', False), (':CMD:TIME:RST', False), ('pwm3', False)):
+            with self.subTest(cmd = cmd):
+                self.assertEqual(d.coalescible(Namespace(cmd = cmd, req_id = 1, wait = 0.0)), expected)
+        self.assertFalse(d.coalescible(Namespace(cmd = ':pwm3:outp:ena', req_id = 1, wait = 0.5)))
+        self.assertFalse(d.coalescible(Namespace(cmd = ':pwm3:outp:ena')))
+
+    def test_join(self):
+        """Consecutive writes are joined up to the first command that is not a plain write."""
+        pending = self.pending(':a 1', ':b 2', ':c 3', ':d?', ':e 5')
+        _, _, cmd = heapq.heappop(pending)
+        cmds = d.join_writes(pending, cmd, 16, 128)
+        self.assertEqual([x.cmd for x in cmds], [':a 1', ':b 2', ':c 3'])
+        self.assertEqual([x[2].cmd for x in pending], [':d?', ':e 5'])
+
+    def test_limits(self):
+        """The joined line is limited in length and in number of commands."""
+        pending = self.pending(*[f':dout0.{i}:write 1' for i in range(8)])      # 16 characters each
+        _, _, cmd = heapq.heappop(pending)
+        cmds = d.join_writes(pending, cmd, 16, 16 * 3 + 2)
+        self.assertEqual(len(';'.join(x.cmd for x in cmds)), 50)
+        self.assertEqual(len(cmds), 3)
+        _, _, cmd = heapq.heappop(pending)
+        self.assertEqual(len(d.join_writes(pending, cmd, 2, 128)), 2)
+        self.assertEqual(len(pending), 3)
+        self.assertEqual(d.join_writes([], cmd, 16, 4), [cmd])
+
+#===============================================================================================#
+#   :CMD:READ?, :CMD:BASE:DRIFT? items                                                          #
+#===============================================================================================#
+
+class TestCmdItems(unittest.IsolatedAsyncioTestCase):
+    """The multi-item :CMD:READ? and :CMD:BASE:DRIFT? responses of a cmd_handler connection."""
+
+    async def asyncSetUp(self):
+        self.sensors = d.create_sensors()
+        n = len(self.sensors)
+        d.arg = d.defaults()
+        d.buf, d.stats = d.RingBuffer(10000, n, 1000.0), d.RollingStats(n, (1.0,))
+        for name in ("arg", "buf", "stats"):
+            self.addCleanup(delattr, d, name)
+        self.labels = list(d.Sensor.labels())
+        self.ramp = self.labels.index("SERVO")
+        for i in range(1200):
+            self.append(i, i * 0.1)
+        daq = d.DAQLink(queue.Queue(), queue.Queue())
+        self.addCleanup(daq.close)
+        server = await asyncio.start_server(lambda r, w: d.cmd_handler(r, w, [], daq, asyncio.Lock(), queue.Queue(), queue.Queue()), '127.0.0.1', 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        self.reader, self.writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+
+    async def asyncTearDown(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    def append(self, i, t):
+        """Append the record (i) at the time (t): all the pwm channels read (i) % 100, and SERVO ramps by 0.5/s."""
+        record = np.full(len(self.sensors), 0.5)
+        record[-4:] = i % 100
+        record[self.ramp] = 0.5 * t
+        with d.buf_lock:
+            d.buf.append(i, t, record)
+            d.stats.update(t, record)
+
+    async def ask(self, cmd: str) -> str:
+        self.writer.write(cmd.encode())
+        return (await self.reader.read(2048)).decode()
+
+    async def test_read(self):
+        """The items are answered in order, each as a single item request."""
+        items = ("CH4_PID", "SERVO, 50.0", "SERVO, 50.0, 2.0", "HOTPLATE_PID, MAX")
+        single = [await self.ask(f':CMD:READ? {x}') for x in items]
+        self.assertEqual(single[1:3], ['25.00%', '24.50%'])
+        self.assertEqual(await self.ask(':CMD:READ? ' + '; '.join(items)), ','.join(single))
+
+    async def test_unavailable(self):
+        """The response is "ERR" if any item is not available."""
+        self.assertEqual(await self.ask(':CMD:READ? CH4_PID; NOPE'), 'ERR')
+        self.assertEqual(await self.ask(':CMD:READ? CH4_PID; SERVO, 500.0'), 'ERR')
+        self.assertEqual(await self.ask(':CMD:BASE:DRIFT? SERVO; NOPE, 10.0'), 'ERR')
+
+    async def test_drift(self):
+        single = [await self.ask(f':CMD:BASE:DRIFT? {x}') for x in ("SERVO, 30.0", "CH4_PID")]
+        self.assertAlmostEqual(float(single[0]), 30.0, delta = 1.0)
+        self.assertEqual(await self.ask(':CMD:BASE:DRIFT? SERVO, 30.0; CH4_PID'), ','.join(single))
+
+    async def test_snapshot(self):
+        """The items are read from the same record, while records are appended."""
+        stop = threading.Event()
+        def feeder():
+            i = 1200
+            while not stop.is_set():
+                self.append(i, i * 0.1)
+                i += 1
+        th = threading.Thread(target = feeder)
+        th.start()
+        try:
+            for _ in range(50):
+                values = (await self.ask(':CMD:READ? COLDPLATE_PID; HOTPLATE_PID; CH4_PID')).split(',')
+                self.assertEqual(len(set(values)), 1, values)
+        finally:
+            stop.set()
+            th.join()
+
+if __name__ == '__main__':
+    unittest.main()
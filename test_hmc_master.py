@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+#   Unit tests of the hmc_master CMD port connection, against a local stub of the DAQ server CMD port.
+#   The tests need no DAQ server, and run with the standard unittest runner or pytest.
+#
+#   usage: python -m unittest test_hmc_master
+
+import unittest
+import socket
+import threading
+import time
+import hmc_master as h
+
+class StubServer():
+    """
+        Minimal framed CMD port: accepts ":CMD:FRAME ON", and answers each "<id> <command>\n" request
+        with "<id> R<command>\n". A "SLOW" command is answered after (delay) seconds, and "CLOSE"
+        closes the connection without answer. All the requests received are kept in (requests).
+    """
+    def __init__(self, delay: float = 0.5):
+        self.delay = delay
+        self.requests = []
+        self.connections = 0
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        with conn:
+            if conn.recv(1024) != b':CMD:FRAME ON': return
+            conn.sendall(b'OK')
+            rx = b''
+            while data := conn.recv(1024):
+                rx += data
+                while b'\n' in rx:
+                    line, rx = rx.split(b'\n', 1)
+                    self.requests.append(line)
+                    id, _, cmd = line.partition(b' ')
+                    if cmd == b'CLOSE': return
+                    if cmd == b'SLOW': time.sleep(self.delay)
+                    conn.sendall(id + b' R' + cmd + b'\n')
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)    # wake up the accept() of the serve thread
+        except OSError:
+            pass
+        self.sock.close()
+
+class TestCmdConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.conn = h.CmdConnection('127.0.0.1', self.server.port, timeout = 0.2)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.close()
+
+    def test_persistent(self):
+        """The connection is opened on the first request, and kept open."""
+        self.assertEqual(self.conn.ask('A'), 'RA')
+        self.assertEqual(self.conn.ask('B'), 'RB')
+        self.assertEqual((self.server.connections, self.conn.reconnects), (1, 1))
+
+    def test_reconnect(self):
+        """A connection closed by the server is reopened before the next request."""
+        self.assertEqual(self.conn.ask('A'), 'RA')
+        with self.assertRaises(ConnectionError):
+            self.conn.ask('CLOSE')
+        self.assertEqual(self.conn.ask('B'), 'RB')
+        self.assertEqual(self.conn.reconnects, 2)
+        self.assertEqual([x.split()[1] for x in self.server.requests], [b'A', b'CLOSE', b'B'])
+
+    def test_timeout(self):
+        """A request that was sent is not sent again after a response timeout."""
+        with self.assertRaises(TimeoutError):
+            self.conn.ask('SLOW')
+        self.assertEqual([x.split()[1] for x in self.server.requests], [b'SLOW'])
+
+    def test_stale_response(self):
+        """The late response of a timed out request is discarded, by the health check or by its request id."""
+        self.server.delay = 0.3
+        with self.assertRaises(TimeoutError):
+            self.conn.ask('SLOW')
+        # the late response arrives while waiting for the next response
+        self.assertEqual(self.conn.ask('A'), 'RA')
+        with self.assertRaises(TimeoutError):
+            self.conn.ask('SLOW')
+        time.sleep(0.3)
+        # the late response is already received before the next request
+        self.assertEqual(self.conn.ask('B'), 'RB')
+        self.assertEqual(self.conn.reconnects, 1)
+
+    def test_framing(self):
+        """Each request is a line with a new request id."""
+        for x in ('A', 'B', ':CMD:READ? ch4, max, 2.0; h2, max, 2.0'):
+            self.assertEqual(self.conn.ask(x), 'R' + x)
+        self.assertEqual([x.partition(b' ')[0] for x in self.server.requests], [b'1', b'2', b'3'])
+
+    def test_send(self):
+        """send() returns the error message of a failed request, and send_values() all NaN."""
+        # a free port, with no listener
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        conn = h.CmdConnection('127.0.0.1', port, timeout = 0.2)
+        self.assertIn('refused', h.send(conn, 'A').lower())
+        self.assertTrue(all(x != x for x in h.send_values(conn, 'A; B', 2)))
+
+if __name__ == '__main__':
+    unittest.main()
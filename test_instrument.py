@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+#   Unit tests of the Instrument serial and usbtmc paths, against fake ports.
+#   The tests need no instrument, and run with the standard unittest runner or pytest.
+#
+#   usage: python -m unittest test_instrument
+
+import unittest
+from unittest import mock
+import tempfile
+import json
+import os
+import time
+import instrument
+from instrument import Instrument
+
+VISA_SER = "USBSER::0x1234::0x5678::*::INSTR"
+IDN = "GVS,DAQ,SN001,1.0"
+
+class FakeSerial():
+    """
+        Fake pyserial port. Each line written is answered by the (responder) function, and the answer bytes
+        are read back up to (chunk) bytes per read. A read with no bytes waiting returns b'' after a short
+        sleep, as a port timeout. All the lines written are kept in (lines), and the opened ports in (opened).
+        The ports in (silent) do not answer.
+    """
+    opened = []
+    silent = set()
+
+    def __init__(self):
+        self.port = None
+        self.baudrate = None
+        self.timeout = None
+        self.is_open = False
+        self.rx = bytearray()
+        self.lines = []
+        self.chunk = 4096
+        self.responder = self.respond
+
+    @staticmethod
+    def respond(line: str) -> bytes:
+        """Default responder: answer '*IDN?' and '*OPC?', and nothing to the other commands."""
+        cmds = line.upper().split(';')
+        if cmds[-1] == "*IDN?": return (IDN + "\r\n").encode()
+        if cmds[-1] == "*OPC?": return b"1\r\n"
+        return b''
+
+    def open(self):
+        self.is_open = True
+        FakeSerial.opened.append(self)
+
+    def close(self):
+        self.is_open = False
+
+    def write(self, data: bytes):
+        for line in data.decode().split('\r\n')[:-1]:
+            self.lines.append(line)
+            if self.port not in FakeSerial.silent: self.rx += self.responder(line)
+
+    @property
+    def in_waiting(self):
+        return min(len(self.rx), self.chunk)
+
+    def read(self, n: int) -> bytes:
+        if not self.rx:
+            time.sleep(0.01)
+            return b''
+        n = min(n, self.chunk)
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        return data
+
+    def reset_input_buffer(self):
+        self.rx.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+class SerialTestCase(unittest.TestCase):
+    """Base class of the tests with an Instrument on a FakeSerial port."""
+
+    def setUp(self):
+        FakeSerial.opened = []
+        FakeSerial.silent = set()
+        patcher = mock.patch.object(instrument.serial, "Serial", FakeSerial)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open(self, adaptive: bool = True, **kwargs) -> Instrument:
+        instr = Instrument(VISA_SER, baudrate=115200, timeout=0.1, wait=0.0, adaptive=adaptive, portname="/dev/fake0", **kwargs)
+        self.assertIsNotNone(instr)
+        return instr
+
+#===============================================================================================#
+#   serial_frame, serial_drain                                                                  #
+#===============================================================================================#
+
+class TestSerialFrame(SerialTestCase):
+
+    def test_idn(self):
+        instr = self.open()
+        self.assertEqual(instr.idn, IDN + "\r")
+        self.assertEqual(instr.serial_number(), "SN001")
+
+    def test_frames(self):
+        """Several frames received in one read are split from the receive buffer, with a single port read."""
+        instr = self.open()
+        instr.instr.rx += b"1.0V,2.0V\r\n3.0V,4.0V\r\n5.0V"
+        self.assertEqual(instr.read(), "1.0V,2.0V\r")
+        self.assertEqual(instr.instr.rx, b'')
+        self.assertEqual(instr.read(), "3.0V,4.0V\r")
+        instr.instr.rx += b",6.0V\r\n"
+        self.assertEqual(instr.read(), "5.0V,6.0V\r")
+
+    def test_partial_frames(self):
+        """A frame received in small chunks is assembled in the receive buffer."""
+        instr = self.open()
+        instr.instr.chunk = 3
+        instr.instr.rx += b"12.345V,6.789C\r\n"
+        self.assertEqual(instr.read(), "12.345V,6.789C\r")
+
+    def test_timeout(self):
+        """A port timeout returns the partial frame received, and an empty frame with no bytes."""
+        instr = self.open()
+        instr.instr.rx += b"12.3"
+        self.assertEqual(instr.serial_frame(), b"12.3")
+        self.assertEqual(instr.serial_frame(), b"")
+        self.assertEqual(instr.serial_frame(0.05), b"")
+
+    def test_drain(self):
+        """drain() discards the receive buffer and the port input, and counts the bytes discarded."""
+        instr = self.open()
+        instr.instr.rx += b"1\r\n2\r\n3\r\n"
+        self.assertEqual(instr.read(), "1\r")
+        instr.instr.rx += b"4\r\n"
+        instr.instr.chunk = 2
+        self.assertEqual(instr.drain(quiet=0.02), 9)
+        self.assertEqual(instr.serial_frame(), b"")
+
+#===============================================================================================#
+#   adaptive write/ask                                                                          #
+#===============================================================================================#
+
+class FakeUsbtmc():
+    """Fake usbtmc instrument, answering the queries with the (responder) function."""
+    def __init__(self, visa_str: str):
+        self.lines = []
+        self.responder = lambda line: IDN if line.upper() == "*IDN?" else "1"
+
+    def ask(self, line: str) -> str:
+        self.lines.append(line)
+        return self.responder(line)
+
+    def write(self, line: str):
+        self.lines.append(line)
+
+    def close(self):
+        pass
+
+class TestAdaptive(SerialTestCase):
+
+    def test_opc_write(self):
+        """An '*OPC?' confirmed write is sent in one line, and learns the command latency."""
+        instr = self.open()
+        instr.write(":PWM1:VAL 50", opc=True)
+        self.assertEqual(instr.instr.lines[-1], ":PWM1:VAL 50;*OPC?")
+        self.assertIn(":PWM1:VAL", instr.latency)
+
+    def test_opc_after_failed_ask(self):
+        """After a failed ask, the forced '*OPC?' write skips the late response, and confirms with its own reply."""
+        instr = self.open()
+        instr.instr.responder = lambda line: b''
+        self.assertEqual(instr.ask(":ADC0:READ?"), "")
+        instr.instr.rx += b"1.234V\r\n"                # the late response of the failed ask
+        instr.instr.responder = FakeSerial.respond
+        instr.write(":DOUT0:WRITE 1", opc=True)
+        self.assertEqual(instr.instr.rx, b'')
+
+    def test_opc_not_confirmed(self):
+        """A write without '*OPC?' reply raises, and the input is discarded."""
+        instr = self.open()
+        instr.instr.responder = lambda line: b''
+        with self.assertRaises(RuntimeError):
+            instr.write(":DOUT0:WRITE 1", opc=True)
+        instr.instr.responder = lambda line: b"0\r\n" * 50
+        with self.assertRaises(RuntimeError):
+            instr.write(":DOUT0:WRITE 1", opc=True)
+        self.assertEqual((bytes(instr.instr.rx), instr.serial_frame()), (b'', b''))
+
+    def test_pacing(self):
+        """A write without confirmation delays the next command by the learned latency."""
+        instr = self.open()
+        instr.latency[":PWM1:MOVE"] = 0.2
+        t0 = time.perf_counter()
+        instr.write(":PWM1:MOVE MAX, 100")
+        instr.ask("*IDN?")
+        self.assertGreaterEqual(time.perf_counter() - t0, 0.2)
+
+    def test_usb_opc(self):
+        with mock.patch.object(instrument.usbtmc, "Instrument", FakeUsbtmc):
+            instr = Instrument("USB::0x1234::0x5678::*::INSTR", adaptive=True)
+            self.assertIsNotNone(instr)
+            instr.write(":DOUT0:WRITE 1", opc=True)
+            self.assertEqual(instr.instr.lines[-1], ":DOUT0:WRITE 1;*OPC?")
+            instr.instr.responder = lambda line: "0"
+            with self.assertRaises(RuntimeError):
+                instr.write(":DOUT0:WRITE 1", opc=True)
+
+#===============================================================================================#
+#   latency profile, wait_ready                                                                 #
+#===============================================================================================#
+
+class TestProfile(SerialTestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "profile.json")
+
+    def test_round_trip(self):
+        """The learned latencies are saved for the instrument serial number, keeping the other instruments."""
+        with open(self.path, "w") as f:
+            json.dump({"SN999": {"*RST": 1.5}}, f)
+        instr = self.open()
+        instr.latency = {"*RST": 0.75, ":PWM1:MOVE": 0.0123456789}
+        instr.save_profile(self.path)
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+        other = self.open()
+        other.latency.clear()
+        self.assertTrue(other.load_profile(self.path))
+        self.assertEqual(other.latency, {"*RST": 0.75, ":PWM1:MOVE": 0.012346})
+        with open(self.path, "r") as f:
+            self.assertEqual(json.load(f)["SN999"], {"*RST": 1.5})
+
+    def test_missing(self):
+        instr = self.open()
+        self.assertFalse(instr.load_profile(self.path))
+        with open(self.path, "w") as f:
+            f.write("{not json")
+        self.assertFalse(instr.load_profile(self.path))
+        instr.latency = {"*RST": 0.5}
+        instr.save_profile(self.path)
+        self.assertTrue(self.open().load_profile(self.path))
+
+    def test_wait_ready(self):
+        """wait_ready() discards the stale input, polls '*OPC?' and learns the completion time."""
+        instr = self.open()
+        instr.instr.rx += b"1\r\n1.0V,2.0V\r\n"     # stale frames, not '*OPC?' replies
+        polls = []
+        def respond(line):
+            polls.append(line)
+            return b"1\r\n" if len(polls) >= 3 else b""
+        instr.instr.responder = respond
+        latency = instr.wait_ready("*RST", timeout=2.0, poll=0.02)
+        self.assertEqual(polls, ["*OPC?"] * 3)
+        self.assertEqual(instr.latency["*RST"], latency)
+
+    def test_wait_ready_timeout(self):
+        """A timed out wait_ready() discards the late replies, so they are not taken by the next command."""
+        instr = self.open()
+        instr.instr.responder = lambda line: b"0\r\n0\r\n"     # each poll leaves a reply behind
+        self.assertEqual(instr.wait_ready("*RST", timeout=0.1, poll=0.02), 0.1)
+        self.assertNotIn("*RST", instr.latency)
+        instr.instr.responder = FakeSerial.respond
+        self.assertEqual(instr.ask("*IDN?"), IDN + "\r")
+        # a stale reply before the command is not taken as the '*OPC?' reply
+        instr.instr.rx += b"1\r\n"
+        instr.instr.responder = lambda line: b""
+        self.assertEqual(instr.wait_ready("*RST", timeout=0.1, poll=0.02), 0.1)
+
+#===============================================================================================#
+#   discover                                                                                    #
+#===============================================================================================#
+
+class TestDiscover(SerialTestCase):
+
+    CANDIDATES = ("USBSER::0x1234::0x0001::*::INSTR", VISA_SER)
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = os.path.join(tmp.name, "ports.json")
+        self.ports = [mock.Mock(device="/dev/ttyACM0", vid=0x0403, pid=0x6001),
+                      mock.Mock(device="/dev/ttyACM1", vid=0x1234, pid=0x5678),
+                      mock.Mock(device="/dev/ttyACM2", vid=0x1234, pid=0x5678)]
+        patcher = mock.patch.object(instrument.lp, "comports", lambda: self.ports)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def discover(self):
+        return Instrument.discover(self.CANDIDATES, cache=self.cache, baudrate=115200, timeout=0.1, adaptive=True)
+
+    def cached(self):
+        with open(self.cache, "r") as f:
+            return json.load(f)
+
+    def test_cold(self):
+        """With no cache, the first port matching a candidate is probed, and the cache is written."""
+        instr = self.discover()
+        self.assertEqual((instr.visa_str, instr.portname), (VISA_SER, "/dev/ttyACM1"))
+        self.assertEqual([x.port for x in FakeSerial.opened], ["/dev/ttyACM1"])
+        self.assertEqual(self.cached(), {VISA_SER: {"port": "/dev/ttyACM1", "idn": IDN}})
+
+    def test_warm(self):
+        """The cached port is verified first."""
+        with open(self.cache, "w") as f:
+            json.dump({VISA_SER: {"port": "/dev/ttyACM2", "idn": IDN}}, f)
+        instr = self.discover()
+        self.assertEqual(instr.portname, "/dev/ttyACM2")
+        self.assertEqual([x.port for x in FakeSerial.opened], ["/dev/ttyACM2"])
+
+    def test_stale_port(self):
+        """A cached port now assigned to another device is not opened, and the ports are probed again."""
+        with open(self.cache, "w") as f:
+            json.dump({VISA_SER: {"port": "/dev/ttyACM0", "idn": IDN}}, f)
+        instr = self.discover()
+        self.assertEqual(instr.portname, "/dev/ttyACM1")
+        self.assertNotIn("/dev/ttyACM0", [x.port for x in FakeSerial.opened])
+        self.assertEqual(self.cached()[VISA_SER]["port"], "/dev/ttyACM1")
+
+    def test_silent_port(self):
+        """A cached port that does not answer is closed, and the ports are probed again."""
+        with open(self.cache, "w") as f:
+            json.dump({VISA_SER: {"port": "/dev/ttyACM2", "idn": IDN}}, f)
+        FakeSerial.silent = {"/dev/ttyACM2"}
+        instr = self.discover()
+        self.assertEqual(instr.portname, "/dev/ttyACM1")
+        self.assertEqual([(x.port, x.is_open) for x in FakeSerial.opened], [("/dev/ttyACM2", False), ("/dev/ttyACM1", True)])
+        self.assertEqual(self.cached()[VISA_SER]["port"], "/dev/ttyACM1")
+
+    def test_not_found(self):
+        FakeSerial.silent = {"/dev/ttyACM1"}
+        self.assertIsNone(self.discover())
+        self.assertFalse(os.path.exists(self.cache))
+
+if __name__ == '__main__':
+    unittest.main()